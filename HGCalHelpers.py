@@ -1,8 +1,12 @@
-"""Analysis helper tools for HGCal ntuples on EOS."""
-import ROOT
+"""Analysis helper tools for HGCal ntuples on EOS.
+
+ROOT is imported only by the functions that need it, so that the geometry
+parsing works without it (e.g. in the synthetic events and benchmarks).
+"""
 import os
 import math
 import logging
+import numpy as np
 
 
 class NullHandler(logging.Handler):
@@ -23,6 +27,7 @@ def createOutputDir(outDir):
 
 def saveHistograms(histDict, canvas, outDir, imgType, logScale=False, doFit=False, rootOnly=False, plotsOnly=False):
     """Save all the histograms as ROOT file and image files, optionally fit Gaussian."""
+    import ROOT
     # also store histograms in ROOT file
     outFileName = "%s.root" % outDir
     outFile = None
@@ -102,6 +107,7 @@ def saveHistograms(histDict, canvas, outDir, imgType, logScale=False, doFit=Fals
 
 def getGenParticles(event, histDict, dvzCut):
     """select GenParticles based on dvzCut and save also in histogram."""
+    import ROOT
     vGenParticleTLV = []
     for particle in event.particles:
         nonConverted = False
@@ -129,6 +135,7 @@ def getGenParticles(event, histDict, dvzCut):
 
 def getMultiClusters(clusters, histDict, prefix, dRCut, energyCut, matchesGen):
     """get MultiClusters with option of applying cuts."""
+    import ROOT
     vMulticlusterTLV = []
     usedCluster = [False] * len(clusters)
     for j, simCl1 in enumerate((clusters)):
@@ -268,6 +275,30 @@ def deltad2(tlv, p2, geometry):
     return dd
 
 
+def associateRecHits(recHitDetIds, simClusterHitOffsets, simClusterHits):
+    """associate the rechits of an event to its SimClusters by detid, with one sorted search for all SimClusters.
+
+    the hits (detids) of SimCluster i are simClusterHits[simClusterHitOffsets[i]:simClusterHitOffsets[i+1]].
+    returns a CSR mapping (offsets, recHitIndices): the indices (in recHitDetIds) of the rechits of SimCluster i
+    are recHitIndices[offsets[i]:offsets[i+1]], in increasing order as np.nonzero(np.in1d(recHitDetIds, hits)).
+    """
+    recHitDetIds = np.asarray(recHitDetIds, dtype=np.int64)
+    simClusterHitOffsets = np.asarray(simClusterHitOffsets, dtype=np.int64)
+    nSimClusters = len(simClusterHitOffsets) - 1
+    order = np.argsort(recHitDetIds, kind='mergesort')
+    sortedDetIds = recHitDetIds[order]
+    # range of the rechits with the detid of each SimCluster hit (usually one or none)
+    first = np.searchsorted(sortedDetIds, simClusterHits, side='left')
+    counts = np.searchsorted(sortedDetIds, simClusterHits, side='right') - first
+    simCluster = np.repeat(np.repeat(np.arange(nSimClusters), np.diff(simClusterHitOffsets)), counts)
+    position = np.arange(counts.sum()) + np.repeat(first - np.cumsum(counts) + counts, counts)
+    # sorted by SimCluster and rechit index, each rechit once per SimCluster
+    pairs = np.unique(simCluster*len(recHitDetIds) + order[position])
+    simCluster = pairs//max(len(recHitDetIds), 1)
+    offsets = np.r_[0, np.cumsum(np.bincount(simCluster, minlength=nSimClusters))].astype(np.int64)
+    return offsets, pairs - simCluster*len(recHitDetIds)
+
+
 class Geometry(object):
     """Sample class to get ROOT Chain and individual files."""
 
@@ -282,6 +313,8 @@ class Geometry(object):
         # drop the b in lambda
         self.lamda_cumulative = {}
         self.lamda = {}
+        # dense z_abs per layer number (NaN for missing layers), see buildLayerTable
+        self.z_table = np.zeros(0)
 
     def addLayer(self, layerGeo):
         """add geometry for a layer following structure in file."""
@@ -298,6 +331,12 @@ class Geometry(object):
         self.lamda_cumulative[layer] = float(layerGeo[7])
         self.lamda[layer] = float(layerGeo[8])
 
+    def buildLayerTable(self):
+        """build the dense z_abs table of the layers, used by the array-based projections."""
+        self.z_table = np.full(max(self.z_abs.keys()) + 1 if self.z_abs else 0, np.nan)
+        for layer, z_abs in self.z_abs.items():
+            self.z_table[layer] = z_abs
+
     def layerToZ(self, layer, eta):
         """convert layer with eta-information to z value."""
         # if (layer not in self.z_abs):
@@ -327,12 +366,32 @@ class Geometry(object):
             y = z * 2 * t * math.sin(phi)/(1 - t*t)
         return y
 
+    def layersToZ(self, layer, eta):
+        """convert arrays of layers with eta-information to z values (as layerToZ)."""
+        layer = np.asarray(layer)
+        outside = (layer < 0) | (layer >= len(self.z_table))
+        z_abs = self.z_table[np.clip(layer, 0, len(self.z_table) - 1)]
+        missing = outside | np.isnan(z_abs)
+        if missing.any():
+            raise KeyError("no geometry for layer(s) %s" % np.unique(layer[missing]).tolist())
+        return np.where(np.asarray(eta) < 0, -z_abs, z_abs)
+
+    def layerEtaPhiToXY(self, layer, eta, phi):
+        """return absolute X and Y values of arrays of layers, eta and phi (as layerEtaPhiToX and layerEtaPhiToY, together)."""
+        z = self.layersToZ(layer, eta)
+        t = np.exp(-1. * np.asarray(eta, dtype=np.float64))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rz = z * 2 * t
+            x = np.where(t == 1, 0., rz * np.cos(phi)/(1 - t*t))
+            y = np.where(t == 1, 0., rz * np.sin(phi)/(1 - t*t))
+        return x, y
+
 
 def parseGeometry(geoFilename):
     """use regular expressions to parse geometry file."""
     import re
     fpg = "([0-9]*\.?[0-9]+)"  # floating point group
-    regex = ur"S[a-z]\s*(\d+): z=\({}\)\s*({})\s*mm;\s*X0=\(\s*{}\)\s*{}; dEdx=\(\s*{}\)\s*{};\s*l=\(\s*{}\)\s*{}".replace("{}", fpg)
+    regex = ur"S[a-z]\s*(\d+): z=\({}\)\s*{}\s*mm;\s*X0=\(\s*{}\)\s*{}; dEdx=\(\s*{}\)\s*{};\s*l=\(\s*{}\)\s*{}".replace("{}", fpg)
     # test_str = (u"Si 39: z=(4078.1) 46.8 mm; X0=(60.34) 2.81; dEdx=(903.87) 49.54; l=(4.813) 0.261\n"
     #             u"Si  0: z=(3207.5)    0 mm; X0=( 0.88) 0.88; dEdx=( 21.32) 21.32; l=(0.181) 0.181")
 
@@ -344,6 +403,7 @@ def parseGeometry(geoFilename):
             for matchNum, match in enumerate(matches):
                 logging.debug("{}".format(match.groups()))
                 geometry.addLayer(match.groups())
+    geometry.buildLayerTable()
 
     return geometry
 
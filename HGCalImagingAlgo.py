@@ -2,30 +2,64 @@
 # Implementation of HGCalImagingAlgo functionality (stand-alone)
 # based on the CMSSW implementation mainly in RecoLocalCalo/HGCalRecAlgos
 ##############################################################################
-# needed for ROOT funcs/types
-import ROOT
+# no ROOT needed: positions are plain ClusterPoint tuples (HGCalROOT converts them to ROOT types)
 import math
+import collections
+# needed for the instrumentation
+import time
+import json
 # needed for KDTree indexing & searches
 import numpy as np
 from scipy import spatial
-# needed to extend the maximum recursion limit, for large data sets
-import sys
-sys.setrecursionlimit(100000)
+# needed for the parallel clustering of layers
+import multiprocessing
+import multiprocessing.pool
+# kernels of the sequential steps (NumPy, or compiled with numba if available)
+import HGCalKernels
 
 ## basic setup for testing
 # 2D clustering
 delta_c = 2.0
 kappa = 10.
 ecut = 0.060
+# flag the hexels of a cluster with density below its border density as halo (not counted in the cluster energy and position)
+haloExclusion = False # disabled until debugged (it seems that it does not work for eta<0)
 # multi-clustering
 multiclusterRadius = 0.015
 realSpaceCone = False
+multiclusterPhiWrap = False # wrap the phi difference into [-pi, pi] in the eta/phi cone (not done by distanceDR2)
 minClusters = 3
 # det. layers to consider
 det_layers = 40
+# first layer of the FH and of the BH (layers numbered from 1 as in the ntuple, v33-withBH.txt counts from 0), e.g. for delta_c per subdetector
+firstFHLayer = 29
+firstBHLayer = 41
+# spatial index of the hexels in each layer: "kdtree" or "tiles" (see spatialIndexTypes)
+spatialIndex = "kdtree"
+# leaf size of the per-layer KDTree (fastest for 1k-100k hits per layer, see benchmarkClustering.benchmarkLeafSize)
+kdtreeLeafSize = 32
+# max. number of candidate hits handled at once in the bulk queries of the spatial indices (limits the memory)
+maxQuerySize = 1<<22
+# distance (cm) between the groups of hexels (layers of different events) in the KDTree of a batch, larger than any layer
+groupSpacing = 1e6
+# parallel clustering of layers in a pool made once by makeLayerPool (makeClusters is serial without a pool): number of workers and
+# type of pool, "threads" (the numba kernels and the KDTree queries release the GIL) or "processes" (each layer and its result are
+# pickled, only worth it for layers of many thousand hits); see benchmarkClustering.benchmarkLayerPool for the occupancy at which
+# each beats the serial clustering on a given machine
+layerWorkers = 4
+layerPoolType = "threads"
 # others
+kernelBackend = HGCalKernels.defaultBackend # "numpy", or "numba" (default if numba can be imported), see HGCalKernels
+
+# initial capacity (hits, 2D clusters) of the buffers of CompactClusters, grown only for larger events
+compactMaxHits = 1<<16
+compactMaxClusters = 1<<13
+
 verbosityLevel = 0 # 0 - only basic info (default); 1 - additional info; 2 - detailed info printed
 
+# position of a cluster (cm), with its eta and phi, as returned by the clustering (see HGCalROOT.toXYZPoint for a ROOT point)
+ClusterPoint = collections.namedtuple("ClusterPoint", ["x", "y", "z", "eta", "phi"])
+
 # definition of Hexel element
 class Hexel:
     def __init__(self, rHit = None):
@@ -55,6 +89,86 @@ class Hexel:
     def __gt__(self, other_rho):
         return self.rho > other_rho
 
+# definition of columnar (struct-of-arrays) store of all hexels in one layer
+# (or in many layers, e.g. of many events: then each hexel has the index of its layer in group, sorted, see makeClustersBatch)
+class HexelLayer:
+    def __init__(self, rHits = None):
+        if rHits is None: rHits = []
+        self.setColumns([rHit.x for rHit in rHits], [rHit.y for rHit in rHits], [rHit.energy for rHit in rHits],
+                        z = [rHit.z for rHit in rHits], eta = [rHit.eta for rHit in rHits], phi = [rHit.phi for rHit in rHits],
+                        detid = [rHit.detid for rHit in rHits])
+    # set the hexel columns (missing ones are set to zero) and reset the clustering results
+    def setColumns(self, x, y, weight, z = None, eta = None, phi = None, detid = None, group = None):
+        nHits = len(weight)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.weight = np.asarray(weight, dtype=np.float64)
+        self.z = np.zeros(nHits) if z is None else np.asarray(z, dtype=np.float64)
+        self.eta = np.zeros(nHits) if eta is None else np.asarray(eta, dtype=np.float64)
+        self.phi = np.zeros(nHits) if phi is None else np.asarray(phi, dtype=np.float64)
+        self.detid = np.zeros(nHits, dtype=np.int64) if detid is None else np.asarray(detid, dtype=np.int64)
+        self.rho = np.zeros(nHits, dtype=np.float64)
+        self.delta = np.zeros(nHits, dtype=np.float64)
+        self.nearestHigher = np.full(nHits, -1, dtype=np.int64)
+        self.clusterIndex = np.full(nHits, -1, dtype=np.int64)
+        self.isBorder = np.zeros(nHits, dtype=bool)
+        self.isHalo = np.zeros(nHits, dtype=bool)
+        self.nClusters = 0
+        self.group = None if group is None else np.asarray(group, dtype=np.int64)
+    def __len__(self):
+        return len(self.weight)
+    # group of each hexel (all in group 0 for a single layer)
+    def getGroups(self):
+        return np.zeros(len(self), dtype=np.int64) if self.group is None else self.group
+    # first hexel of each group
+    def getGroupStarts(self):
+        return findRunStarts(self.getGroups())
+    # Hexel view of the i-th element (created on demand, not kept in the store)
+    def getHexel(self, i):
+        iNode = Hexel()
+        iNode.eta = self.eta[i]
+        iNode.phi = self.phi[i]
+        iNode.x = self.x[i]
+        iNode.y = self.y[i]
+        iNode.z = self.z[i]
+        iNode.weight = self.weight[i]
+        iNode.detid = self.detid[i]
+        iNode.rho = self.rho[i]
+        iNode.delta = self.delta[i]
+        iNode.nearestHigher = self.nearestHigher[i]
+        iNode.isBorder = self.isBorder[i]
+        iNode.isHalo = self.isHalo[i]
+        iNode.clusterIndex = self.clusterIndex[i]
+        return iNode
+    # indices of hexels sorted by cluster (in the original hexel order within each cluster), and the offsets of each cluster in them
+    def getClusterHits(self):
+        order = np.argsort(self.clusterIndex, kind='mergesort')
+        counts = np.bincount(self.clusterIndex[self.clusterIndex >= 0], minlength=self.nClusters)
+        first = len(self) - counts.sum() # unassigned hexels (clusterIndex -1) come first
+        return order[first:], np.r_[0, np.cumsum(counts)].astype(np.int64)
+    # indices of hexels per cluster (in the original hexel order)
+    def getClusterIndices(self):
+        hits, offsets = self.getClusterHits()
+        return np.split(hits, offsets[1:-1]) if self.nClusters > 0 else []
+    # list of clusters, each as a list of Hexel views
+    def getClusters(self):
+        return [[self.getHexel(i) for i in indices] for indices in self.getClusterIndices()]
+
+# hexels of one cluster of a hexel store as a sequence of Hexel views, each created only when accessed (e.g. as thisCluster of a BasicCluster)
+class ClusterHexels:
+    def __init__(self, hexels, indices):
+        self.hexels = hexels
+        self.indices = indices
+    def __len__(self):
+        return len(self.indices)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.hexels.getHexel(j) for j in self.indices[i]]
+        return self.hexels.getHexel(self.indices[i])
+    def __iter__(self):
+        for j in self.indices:
+            yield self.hexels.getHexel(j)
+
 # definition of basic cluster (based on a set of sub-clusters or set of hexels)
 class BasicCluster:
     def __init__(self, energy = None, position = None, thisCluster = None, algoId = None, caloId = None):
@@ -69,7 +183,9 @@ class BasicCluster:
         self.caloId = None
         if energy is not None:
             self.energy = energy
-        if position is not None:
+        if isinstance(position, ClusterPoint):
+            self.setPosition(*position)
+        elif position is not None: # ROOT point
             self.eta = position.eta()
             self.phi = position.phi()
             self.x = position.x()
@@ -81,6 +197,37 @@ class BasicCluster:
             self.caloId = caloId
         if thisCluster is not None:
             self.thisCluster = thisCluster
+    # set the position from its coordinates (instead of from a ROOT point)
+    def setPosition(self, x, y, z, eta, phi):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.eta = eta
+        self.phi = phi
+    # position as ClusterPoint
+    def getPosition(self):
+        return ClusterPoint(self.x, self.y, self.z, self.eta, self.phi)
+
+# energy, position and size (number of hexels or of 2D clusters) of many clusters, as arrays (points only made on request)
+class ClusterPositions:
+    def __init__(self, energy, x, y, z, size):
+        self.energy = energy
+        self.x = x
+        self.y = y
+        self.z = z
+        self.eta = etaFromXYZ(x, y, z)
+        self.phi = phiFromXY(x, y)
+        self.size = size
+    def __len__(self):
+        return len(self.energy)
+    # position of the i-th cluster as ClusterPoint
+    def getPoint(self, i):
+        return ClusterPoint(float(self.x[i]), float(self.y[i]), float(self.z[i]), float(self.eta[i]), float(self.phi[i]))
+    # the i-th cluster as BasicCluster (with the given list of hexels or 2D clusters)
+    def getBasicCluster(self, i, thisCluster = None):
+        cluster = BasicCluster(energy = self.energy[i], thisCluster = thisCluster)
+        cluster.setPosition(self.x[i], self.y[i], self.z[i], self.eta[i], self.phi[i])
+        return cluster
 
 # distance squared (in eta/phi) between the two objects (hexels, clusters)
 def distanceDR2(Hex1, Hex2):
@@ -90,224 +237,790 @@ def distanceDR2(Hex1, Hex2):
 def distanceReal2(clust1, clust2):
     return (pow(clust2.x - clust1.x,2) + pow(clust2.y - clust1.y,2))
 
+# pseudorapidity of the points, with the conventions of ROOT.Math (points on the beam axis get z +- etaMax)
+etaMax = 22756.0
+etaTaylorLimit = pow(np.finfo(np.float64).eps, -0.25) # above this |z/rho|, the sqrt is replaced by its expansion (as in ROOT.Math)
+def etaFromXYZ(x, y, z):
+    rho = np.sqrt(x*x + y*y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zScaled = z/rho
+        eta = np.where(np.abs(zScaled) < etaTaylorLimit, np.log(zScaled + np.sqrt(zScaled*zScaled + 1.0)),
+                       np.where(z > 0, np.log(2.0*zScaled + 0.5/zScaled), -np.log(-2.0*zScaled)))
+    return np.where(rho > 0, eta, np.where(z == 0, 0., np.where(z > 0, z + etaMax, z - etaMax)))
+
+# azimuthal angle of the points, with the conventions of ROOT.Math (0 on the beam axis)
+def phiFromXY(x, y):
+    return np.where((x == 0) & (y == 0), 0., np.arctan2(y, x))
+
+# energy and position (based on hexels positions weighted by the energy) of all clusters in the hexel store
+# the non-halo hexels are summed in the hexel order, as the loop over the hexels of each cluster did
+def calculateClusterPositions(hexels):
+    assigned = hexels.clusterIndex != -1
+    counted = assigned & ~hexels.isHalo
+    clusterIndex = hexels.clusterIndex[counted]
+    weight = hexels.weight[counted]
+    energy = np.bincount(clusterIndex, weights=weight, minlength=hexels.nClusters)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.bincount(clusterIndex, weights=hexels.x[counted]*weight, minlength=hexels.nClusters)/energy
+        y = np.bincount(clusterIndex, weights=hexels.y[counted]*weight, minlength=hexels.nClusters)/energy
+        z = np.bincount(clusterIndex, weights=hexels.z[counted]*weight, minlength=hexels.nClusters)/energy
+    size = np.bincount(hexels.clusterIndex[assigned], minlength=hexels.nClusters)
+    return ClusterPositions(energy, x, y, z, size)
+
 # position of the cluster, based on hexels positions weighted by the energy
 def calculatePosition(cluster):
-    total_weight = 0.
-    x = 0.
-    y = 0.
-    z = 0.
-    for iNode in cluster:
-        if(not iNode.isHalo):
-            total_weight += iNode.weight
-            x += iNode.x*iNode.weight
-            y += iNode.y*iNode.weight
-            z += iNode.z*iNode.weight
-    return ROOT.Math.XYZPoint( x/total_weight, y/total_weight, z/total_weight ) # return as ROOT.Math.XYZPoint
-#    return x/total_weight, y/total_weight, z/total_weight
+    hexels = HexelLayer()
+    hexels.setColumns([iNode.x for iNode in cluster], [iNode.y for iNode in cluster], [iNode.weight for iNode in cluster], z = [iNode.z for iNode in cluster])
+    hexels.isHalo = np.array([iNode.isHalo for iNode in cluster], dtype=bool)
+    hexels.clusterIndex[:] = 0
+    hexels.nClusters = 1
+    return calculateClusterPositions(hexels).getPoint(0) # return as ClusterPoint
+
+# KDTree spatial index of the hexels in one layer, built once and shared by all clustering stages
+# hexels of many layers (group) are kept apart by a third coordinate, equal within a layer so that the distances in it are exact
+class KDTreeIndex:
+    def __init__(self, x, y, group = None, leafsize = kdtreeLeafSize, backend = kernelBackend):
+        self.x = x
+        self.y = y
+        self.group = group
+        self.backend = backend
+        points = np.column_stack((x, y)) if group is None else np.column_stack((x, y, group*groupSpacing))
+        self.tree = spatial.cKDTree(points, leafsize=leafsize)
+        self.neighbourPairs = {}
+    # pairs of hits closer than radius, found on first use and kept for the later stages
+    def getNeighbourPairs(self, radius):
+        if radius not in self.neighbourPairs:
+            self.neighbourPairs[radius] = findNeighbourPairs(self.x, self.y, self.tree, radius)
+        return self.neighbourPairs[radius]
+    # nearest hit with higher density, for hits sorted by decreasing density (within each group)
+    def searchNearestHigher(self, order):
+        return searchNearestHigher(self.x, self.y, order, self.tree, group = self.group, backend = self.backend)
+    # indices of the hits within radius of the i-th hit
+    def queryHit(self, i, radius):
+        return np.array(self.tree.query_ball_point(self.tree.data[i], radius), dtype=np.int64)
+
+# fixed-grid tile index of the hexels in one layer, alternative to the KDTree for searches within a fixed radius
+# hexels of many layers (group) get separate grids of tiles
+class TileIndex:
+    def __init__(self, x, y, group = None, tileSize = None, backend = kernelBackend):
+        if tileSize is None:
+            tileSize = delta_c*(1. + 1e-6) # just above delta_c, so that all hits within delta_c are in the adjacent tiles
+        self.x = x
+        self.y = y
+        self.group = group
+        self.backend = backend
+        self.tileSize = tileSize
+        self.neighbourPairs = {}
+        ix = np.floor(x/tileSize).astype(np.int64)
+        iy = np.floor(y/tileSize).astype(np.int64)
+        self.ixMin = ix.min() if len(x) > 0 else 0
+        self.iyMin = iy.min() if len(y) > 0 else 0
+        self.ix = ix - self.ixMin
+        self.iy = iy - self.iyMin
+        self.nx = self.ix.max() + 1 if len(x) > 0 else 1
+        self.ny = self.iy.max() + 1 if len(y) > 0 else 1
+        self.tileGroup = np.zeros(len(x), dtype=np.int64) if group is None else group
+        self.maxGroupSize = np.bincount(self.tileGroup).max() if len(x) > 0 else 0
+        tile = (self.tileGroup*self.nx + self.ix)*self.ny + self.iy
+        self.hits = np.argsort(tile, kind='mergesort') # hit indices sorted by tile
+        self.tiles = tile[self.hits]
+    # tile offsets (in x and y) of the square of tiles within w tiles, or of its upper half (including the central tile)
+    def getTileOffsets(self, w, half = False):
+        dx, dy = np.meshgrid(np.arange(-w, w+1), np.arange(-w, w+1), indexing='ij')
+        dx = dx.ravel()
+        dy = dy.ravel()
+        if half:
+            upper = (dx > 0) | ((dx == 0) & (dy >= 0))
+            return dx[upper], dy[upper]
+        return dx, dy
+    # first and last+1 position in self.hits of the hits in the tiles at the given offsets from the given tiles (of the given groups)
+    def findTileRanges(self, ix, iy, group, offsets):
+        tx = ix[:,None] + offsets[0][None,:]
+        ty = iy[:,None] + offsets[1][None,:]
+        tile = (group[:,None]*self.nx + tx)*self.ny + ty
+        start = np.searchsorted(self.tiles, tile)
+        end = np.searchsorted(self.tiles, tile + 1)
+        inside = (tx >= 0) & (tx < self.nx) & (ty >= 0) & (ty < self.ny)
+        return start, np.where(inside, end, start)
+    # candidate hits in the tiles at the given offsets from each query hit (all hits of its group if offsets is None), in chunks of about maxQuerySize
+    # yields the query hits of the chunk, and the (position of the query hit in the chunk, candidate hit) pairs
+    def gatherCandidates(self, queries, offsets):
+        nTiles = 1 if offsets is None else len(offsets[0])
+        blockSize = max(1, maxQuerySize//max(nTiles, self.maxGroupSize if offsets is None else 1))
+        for blockStart in range(0, len(queries), blockSize):
+            block = queries[blockStart:blockStart+blockSize]
+            if offsets is None:
+                groupTiles = self.nx*self.ny
+                start = np.searchsorted(self.tiles, self.tileGroup[block]*groupTiles)[:,None]
+                end = np.searchsorted(self.tiles, (self.tileGroup[block] + 1)*groupTiles)[:,None]
+            else:
+                start, end = self.findTileRanges(self.ix[block], self.iy[block], self.tileGroup[block], offsets)
+            counts = end - start
+            total = np.cumsum(counts.sum(axis=1))
+            first = 0
+            while(first < len(block)):
+                done = total[first-1] if first > 0 else 0
+                last = max(first+1, np.searchsorted(total, done + maxQuerySize, side='right'))
+                chunkCounts = counts[first:last].ravel()
+                position = np.repeat(np.arange(last-first), nTiles)
+                position = np.repeat(position, chunkCounts)
+                inRange = np.arange(chunkCounts.sum()) - np.repeat(np.cumsum(chunkCounts) - chunkCounts, chunkCounts)
+                yield block[first:last], position, self.hits[np.repeat(start[first:last].ravel(), chunkCounts) + inRange]
+                first = last
+    # pairs of hits closer than radius, found on first use and kept for the later stages
+    def getNeighbourPairs(self, radius):
+        if radius not in self.neighbourPairs:
+            w = int(np.ceil(radius/self.tileSize*(1. + 1e-9)))
+            pairs = []
+            # only the upper half of the neighbouring tiles, so that each pair of tiles is visited once
+            for hits, position, found in self.gatherCandidates(np.arange(len(self.x)), self.getTileOffsets(w, half = True)):
+                first = hits[position]
+                once = (first < found) | (self.ix[first] != self.ix[found]) | (self.iy[first] != self.iy[found]) # each pair once
+                pairs.append((np.minimum(first[once], found[once]), np.maximum(first[once], found[once]))) # as i < j, like the KDTree
+            first = np.concatenate([pair[0] for pair in pairs] + [np.zeros(0, dtype=np.int64)])
+            second = np.concatenate([pair[1] for pair in pairs] + [np.zeros(0, dtype=np.int64)])
+            dist2 = pow(self.x[second] - self.x[first],2) + pow(self.y[second] - self.y[first],2)
+            close = dist2 < radius*radius
+            self.neighbourPairs[radius] = (first[close], second[close], dist2[close])
+        return self.neighbourPairs[radius]
+    # nearest hit with higher density, for hits sorted by decreasing density (within each group), searching in squares of tiles of increasing size
+    def searchNearestHigher(self, order):
+        nHits = len(order)
+        rank = np.empty(nHits, dtype=np.int64)
+        rank[order] = np.arange(nHits)
+        nearestHigher = np.full(nHits, -1, dtype=np.int64)
+        dist2 = np.zeros(nHits, dtype=np.float64)
+        todo = np.delete(order, findGroupTops(order, self.group)) # the top density hits have no higher hit, they are treated by the caller
+        kernels = HGCalKernels.getKernels(self.backend)
+        w = 1
+        while(len(todo) > 0):
+            # once the square of tiles is larger than the layer (or holds as many tiles as there are hits), compare to all hits of the layer
+            if(w >= max(self.nx, self.ny) or (2*w+1)*(2*w+1) >= self.maxGroupSize):
+                w = None
+            left = []
+            for hits, position, found in self.gatherCandidates(todo, None if w is None else self.getTileOffsets(w)):
+                # each hit is its own candidate, so the candidates of every hit form one non-empty contiguous group
+                offsets = np.r_[findRunStarts(position), len(position)]
+                bestDist2, bestRank = kernels.selectNearestHigher(self.x, self.y, rank, hits, offsets, found)
+                done = np.isfinite(bestDist2)
+                if w is not None:
+                    done &= bestDist2 < pow(w*self.tileSize,2)*(1. - 1e-9)
+                nearestHigher[hits[done]] = order[bestRank[done]]
+                dist2[hits[done]] = bestDist2[done]
+                left.append(hits[~done])
+            todo = np.concatenate(left) if len(left) > 0 else todo[:0]
+            w = 2*w if w is not None else w
+        return nearestHigher, dist2
+    # indices of the hits within radius of the i-th hit
+    def queryHit(self, i, radius):
+        w = int(np.ceil(radius/self.tileSize*(1. + 1e-9)))
+        start, end = self.findTileRanges(self.ix[i:i+1], self.iy[i:i+1], self.tileGroup[i:i+1], self.getTileOffsets(w))
+        found = np.concatenate([self.hits[first:last] for first, last in zip(start[0], end[0])] + [np.zeros(0, dtype=np.int64)])
+        return found[pow(self.x[found] - self.x[i],2) + pow(self.y[found] - self.y[i],2) <= radius*radius]
+
+# available spatial indices of the hexels in one layer
+spatialIndexTypes = {"kdtree": KDTreeIndex, "tiles": TileIndex}
+
+# indices sorted by decreasing value (stable, ties keep the original order as with sorted(..., reverse=True)), within each group if given
+def sortedDecreasing(values, group = None):
+    if group is None:
+        return np.argsort(-values, kind='mergesort')
+    return np.lexsort((-values, group))
+
+# first position of each run of equal values (e.g. of the groups of sorted hexels)
+def findRunStarts(values):
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]]) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+
+# positions in the order of decreasing density of the top density hit of each group (just the first position without groups)
+def findGroupTops(order, group = None):
+    if group is None:
+        return np.arange(min(1, len(order)))
+    return findRunStarts(group[order])
+
+# all pairs of hits closer than radius (each pair once), from one query on the whole layer
+# returns the two hit indices of each pair and their squared distance
+def findNeighbourPairs(x, y, lp, radius):
+    # slightly larger search radius, so that the (strict) cut below decides on the exact same distance as distanceReal2
+    pairs = lp.query_pairs(radius*(1. + 1e-9), output_type='ndarray')
+    first = pairs[:,0]
+    second = pairs[:,1]
+    dist2 = pow(x[second] - x[first],2) + pow(y[second] - y[first],2)
+    close = dist2 < radius*radius
+    return first[close], second[close], dist2[close]
+
+# pairs of hits closer than delta_c (one value, or the value for each hit: then the pairs within the largest one are cut to it)
+def getCloseNeighbourPairs(lp, delta_c):
+    if (np.ndim(delta_c) == 0):
+        return lp.getNeighbourPairs(delta_c)
+    first, second, dist2 = lp.getNeighbourPairs(np.max(delta_c))
+    close = dist2 < delta_c[first]*delta_c[first] # the two hits of a pair are in the same layer
+    return first[close], second[close], dist2[close]
 
 # calculate max local density in a 2D plane of hexels
-def calculateLocalDensity(nd, lp):
-    maxdensity = 0
-    for iNode in nd:
-        # search in a circle of radius delta_c (not identical to search in the box delta_c)
-        found = lp.query_ball_point([iNode.x,iNode.y],delta_c)
-        for j in found:
-            if(distanceReal2(iNode,nd[j]) < delta_c*delta_c):
-                iNode.rho += nd[j].weight
-                if(iNode.rho > maxdensity):
-                    maxdensity = iNode.rho
-    return maxdensity
+# delta_c: one value, or the value for each hexel (e.g. of its layer)
+def calculateLocalDensity(hexels, lp, delta_c = delta_c):
+    if(len(hexels) == 0):
+        return 0
+    # search in a circle of radius delta_c (not identical to search in the box delta_c)
+    first, second, dist2 = getCloseNeighbourPairs(lp, delta_c)
+    # each hit gets the weight of all hits closer than delta_c (itself included), summed in increasing hit index,
+    # so that the density does not depend on the order in which the neighbours are found
+    hits = np.concatenate((np.arange(len(hexels)), first, second))
+    neighbours = np.concatenate((np.arange(len(hexels)), second, first))
+    order = np.argsort(neighbours, kind='mergesort')
+    hexels.rho = np.bincount(hits[order], weights=hexels.weight[neighbours[order]], minlength=len(hexels))
+    if hexels.group is not None:
+        return np.maximum.reduceat(hexels.rho, hexels.getGroupStarts()) # max density of each group
+    return hexels.rho.max()
+
+# find the nearest hit with higher density for all hits, with k-nearest-neighbour queries of increasing k
+# order: hit indices sorted by decreasing density, only hits coming BEFORE in this order count as higher
+# group: layer of each hit if the tree holds many layers (order is then sorted by group first, and only hits of the same group count)
+# returns the nearestHigher index (-1 for the top density hit) and squared distance for every hit
+def searchNearestHigher(x, y, order, lp, k = 8, group = None, backend = kernelBackend):
+    nHits = len(order)
+    rank = np.empty(nHits, dtype=np.int64) # position of each hit in the order of decreasing density
+    rank[order] = np.arange(nHits)
+    nearestHigher = np.full(nHits, -1, dtype=np.int64)
+    dist2 = np.zeros(nHits, dtype=np.float64)
+    todo = np.delete(order, findGroupTops(order, group)) # the top density hits have no higher hit, they are treated by the caller
+    kernels = HGCalKernels.getKernels(backend)
+    while(len(todo) > 0):
+        k = min(k, nHits)
+        chunk = max(1, maxQuerySize//k) # limit the memory used by a single query
+        left = []
+        for start in range(0, len(todo), chunk):
+            hits = todo[start:start+chunk]
+            kdist, found = lp.query(lp.data[hits], k=k)
+            kdist = kdist.reshape(len(hits), k)
+            found = found.reshape(len(hits), k)
+            found = np.where(found < nHits, found, hits[:,None]) # missing neighbours are marked with index nHits
+            if group is not None:
+                found = np.where(group[found] == group[hits][:,None], found, hits[:,None]) # as is any hit of another group
+            best, bestRank = kernels.selectNearestHigher(x, y, rank, hits, np.arange(0, len(hits)*k+1, k), found.ravel())
+            # the search is complete if all hits were returned, or if no hit beyond the k-th neighbour can be as close
+            done = np.isfinite(best) & ((k == nHits) | (best < pow(kdist[:,-1],2)*(1. - 1e-9)))
+            nearestHigher[hits[done]] = order[bestRank[done]]
+            dist2[hits[done]] = best[done]
+            left.append(hits[~done])
+        todo = np.concatenate(left)
+        k *= 2
+    return nearestHigher, dist2
 
-# calculate distance to the nearest hit with higher density (still does not use KDTree)
-def calculateDistanceToHigher(nd, lp):
-    #sort vector of Hexels by decreasing local density
-    rs = sorted(range(len(nd)), key=lambda k: nd[k].rho, reverse=True)
+# calculate distance to the nearest hit with higher density (nearest neighbours from the KDTree)
+def calculateDistanceToHigher(hexels, lp):
+    #sort vector of Hexels by decreasing local density (in each group)
+    rs = sortedDecreasing(hexels.rho, hexels.group)
 
     # intial values, and check if there are any hits
     maxdensity = 0.0
-    nearestHigher = -1
-    if(len(nd)>0):
-        maxdensity = nd[rs[0]].rho
+    if(len(hexels)>0):
+        tops = rs[findGroupTops(rs, hexels.group)] # the highest density hit of each group
+        maxdensity = hexels.rho[tops] if hexels.group is not None else hexels.rho[rs[0]]
     else:
         return maxdensity # there are no hits
 
-    #   start by setting delta for the highest density hit to the most distant hit - this is a convention
-    dist2 = 2500.0
-    for jNode in nd:
-        tmp = distanceReal2(nd[rs[0]], jNode)
-        if(tmp > dist2):
-            dist2 = tmp
-    nd[rs[0]].delta = pow(dist2,0.5)
-    nd[rs[0]].nearestHigher = nearestHigher
-            
-    # now we save the largest distance as a starting point
-    max_dist2 = dist2
     # calculate all remaining distances to the nearest higher density
-    for oi in range(1,len(nd)): # start from second-highest density
-        dist2 = max_dist2
-        # we only need to check up to oi since hits are ordered by decreasing density
-        # and all points coming BEFORE oi are guaranteed to have higher rho and the ones AFTER to have lower rho
-        for oj in range(0,oi):
-            tmp = distanceReal2(nd[rs[oi]], nd[rs[oj]])
-            if(tmp <= dist2): #this "<=" instead of "<" addresses the (rare) case when there are only two hits
-                dist2 = tmp
-                nearestHigher = rs[oj]
-        nd[rs[oi]].delta = pow(dist2,0.5)
-        nd[rs[oi]].nearestHigher = nearestHigher #this uses the original unsorted hitlist
+    hexels.nearestHigher, dist2 = lp.searchNearestHigher(rs) #this uses the original unsorted hitlist
+
+    #   set delta for the highest density hit to the most distant hit (of the same group) - this is a convention
+    groups = hexels.getGroups()
+    topDist2 = pow(hexels.x - hexels.x[tops][groups],2) + pow(hexels.y - hexels.y[tops][groups],2)
+    dist2[tops] = np.maximum(2500.0, np.maximum.reduceat(topDist2, hexels.getGroupStarts()))
+    hexels.delta = np.power(dist2,0.5)
 
     return maxdensity
 
+# cluster index of each hit from the first cluster center up its chain of nearestHigher hits (-1 if the chain ends at a top
+# density hit that is not a center), the same as copying it from the nearestHigher hit in order of decreasing density
+# (by pointer jumping with NumPy, or along each chain once with numba)
+def propagateClusterIndex(clusterIndex, nearestHigher, backend = kernelBackend):
+    return HGCalKernels.getKernels(backend).propagateClusterIndex(clusterIndex, nearestHigher)
+
 # find cluster centers that satisfy delta & maxdensity/kappa criteria, and assign coresponding hexels
-def findAndAssignClusters(nd, points_0, points_1, lp, maxdensity):
-    clusterIndex = 0
-    #sort Hexels by decreasing local density and by decreasing distance to higher
-    rs = sorted(range(len(nd)), key=lambda k: nd[k].rho, reverse=True) # indices sorted by decreasing rho
-    ds = sorted(range(len(nd)), key=lambda k: nd[k].delta, reverse=True) # sort in decreasing distance to higher
-    
-#    for i in range(0,len(nd)):
-#        print "index rs[i]: ", rs[i], ", rho: ", nd[rs[i]].rho, " delta: ", nd[rs[i]].delta, ", nearestHigher: ", nd[rs[i]].nearestHigher, ", eta: ", nd[rs[i]].eta, ", phi: ", nd[rs[i]].phi
-
-    for i in range(0,len(nd)):
-        if(nd[ds[i]].delta < delta_c):
-            break # no more cluster centers to be looked at
-        if(nd[ds[i]].rho < maxdensity/kappa):
-            continue # skip this as a potential cluster center because it fails the density cut
-        nd[ds[i]].clusterIndex = clusterIndex
-        if (verbosityLevel>=2):
-            print "Adding new cluster with index ", clusterIndex
-            print "Cluster center is hit ", ds[i], " with density rho: ", nd[ds[i]].rho, "and delta: ", nd[ds[i]].delta, "\n"
-        clusterIndex += 1
-        
+# with groups, maxdensity is given per group and the clusters are numbered group after group
+def findAndAssignClusters(hexels, lp, maxdensity, delta_c = delta_c, kappa = kappa, haloExclusion = haloExclusion, verbosityLevel = verbosityLevel):
+    # start from no clusters (the centers can be found again for other parameters, e.g. in scanParameters)
+    hexels.clusterIndex = np.full(len(hexels), -1, dtype=np.int64)
+    hexels.isBorder = np.zeros(len(hexels), dtype=bool)
+    hexels.isHalo = np.zeros(len(hexels), dtype=bool)
+
+    # cluster centers: all hits far enough from higher density, except those failing the density cut, numbered by decreasing delta
+    densityCut = np.take(np.divide(maxdensity, kappa), hexels.getGroups()) # maxdensity/kappa of the group of each hit
+    centers = np.flatnonzero((hexels.delta >= delta_c) & ~(hexels.rho < densityCut))
+    centers = centers[sortedDecreasing(hexels.delta[centers], None if hexels.group is None else hexels.group[centers])]
+    clusterIndex = len(centers)
+    hexels.clusterIndex[centers] = np.arange(clusterIndex)
+    if (verbosityLevel>=2):
+        for index, i in enumerate(centers):
+            print "Adding new cluster with index ", index
+            print "Cluster center is hit ", i, " with density rho: ", hexels.rho[i], "and delta: ", hexels.delta[i], "\n"
+
     # at this point clusterIndex is equal to the number of cluster centers - if it is zero we are done
+    hexels.nClusters = clusterIndex
     if(clusterIndex==0):
         return clusterIndex
-    current_clusters = [[] for i in range(0,clusterIndex)]
-
-    # assign to clusters, using the nearestHigher set from previous step (always set except for top density hit that is skipped)...
-    for oi in range(1,len(nd)):
-        ci = nd[rs[oi]].clusterIndex
-        if(ci == -1):
-            nd[rs[oi]].clusterIndex =  nd[nd[rs[oi]].nearestHigher].clusterIndex
-
-    # assign points closer than dc to other clusters to border region and find critical border density
-    rho_b = [0. for i in range(0,clusterIndex)]
-    lp = spatial.KDTree(zip(points_0, points_1), leafsize=1000) # new KDTree
-    # now loop on all hits again :( and check: if there are hits from another cluster within d_c -> flag as border hit
-    for iNode in nd:
-        ci = iNode.clusterIndex
-        flag_isolated = True
-        if(ci != -1):
-            found = lp.query_ball_point([iNode.x,iNode.y],delta_c)
-            for j in range(1,len(found)):
-                # check if the hit is not within d_c of another cluster
-                if(nd[j].clusterIndex!=-1):
-                    dist2 = distanceReal2(nd[j],iNode)
-                    if(dist2 < delta_c*delta_c and nd[j].clusterIndex!=ci):
-                        # in which case we assign it to the border
-                        iNode.isBorder = True
-                        break
-                    # because we are using two different containers, we have to make sure that we don't unflag the
-                    # hit when it finds *itself* closer than delta_c
-                    if(dist2 < delta_c*delta_c and dist2 != 0. and nd[j].clusterIndex==ci):
-                    # this is not an isolated hit
-                        flag_isolated = False
-            if(flag_isolated):
-                iNode.isBorder = True # the hit is more than delta_c from any of its brethren
-        # check if this border hit has density larger than the current rho_b and update
-        if(iNode.isBorder and rho_b[ci] < iNode.rho):
-            rho_b[ci] = iNode.rho
-
-    # flag points in cluster with density < rho_b as halo points, then fill the cluster vector
-    for iNode in nd:
-        ci = iNode.clusterIndex
-        if(ci!=-1 and iNode.rho < rho_b[ci]):
-            #iNode.isHalo = True
-            pass # temporarly disabled until debugged (it seems that it does not work for eta<0)
-        if(ci!=-1):
-            current_clusters[ci].append(iNode)
-            if (verbosityLevel>=2):
-                print "Pushing hit ", iNode, " into cluster with index ", ci
-                print "   rho_b[ci]: ", rho_b[ci], ", iNode.rho: ", iNode.rho, " iNode.isHalo: ", iNode.isHalo
-
-    return current_clusters
-
-# make 2D clusters out of rechists (need to introduce class with input params: delta_c, kappa, ecut, ...)
-def makeClusters(rHitsCollection, ecut = ecut):
+
+    # assign to clusters, using the nearestHigher set from previous step (always set except for top density hits that are skipped)...
+    hexels.clusterIndex = propagateClusterIndex(hexels.clusterIndex, hexels.nearestHigher, lp.backend)
+
+    # assign points closer than dc to other clusters to border region and find critical border density, flag halo points
+    rho_b = findBorderAndHalo(hexels, lp, delta_c, haloExclusion)
+    if (verbosityLevel>=2):
+        for i in np.flatnonzero(hexels.clusterIndex != -1):
+            ci = hexels.clusterIndex[i]
+            print "Pushing hit ", i, " into cluster with index ", ci
+            print "   rho_b[ci]: ", rho_b[ci], ", rho: ", hexels.rho[i], " isHalo: ", hexels.isHalo[i]
+
+    return clusterIndex
+
+# flag border hits (closer than delta_c to another cluster, or isolated) and find the critical border density rho_b of each cluster,
+# then flag the hits of each cluster with density below rho_b as halo (if haloExclusion is set), all from the pairs of hits closer than delta_c
+# returns rho_b of each cluster
+def findBorderAndHalo(hexels, lp, delta_c = delta_c, haloExclusion = haloExclusion):
+    first, second, dist2 = getCloseNeighbourPairs(lp, delta_c) # same pairs as for the local density
+    clusterIndex = hexels.clusterIndex
+    assigned = clusterIndex != -1
+    both = assigned[first] & assigned[second]
+    # hits within d_c of another cluster are border hits
+    cross = both & (clusterIndex[first] != clusterIndex[second])
+    hexels.isBorder[first[cross]] = True
+    hexels.isBorder[second[cross]] = True
+    # and so are the hits more than d_c from any of their brethren (hits at the same position do not count)
+    near = both & (dist2 != 0.)
+    hasNeighbour = np.zeros(len(hexels), dtype=bool)
+    hasNeighbour[first[near]] = True
+    hasNeighbour[second[near]] = True
+    hexels.isBorder |= assigned & ~hasNeighbour
+
+    # rho_b: max density of the border hits of each cluster (segmented max over the border hits sorted by cluster)
+    rho_b = np.zeros(hexels.nClusters)
+    border = np.flatnonzero(hexels.isBorder)
+    border = border[np.argsort(clusterIndex[border], kind='mergesort')]
+    if (len(border) > 0):
+        starts = findRunStarts(clusterIndex[border])
+        rho_b[clusterIndex[border[starts]]] = np.maximum(0., np.maximum.reduceat(hexels.rho[border], starts))
+
+    # flag points in cluster with density < rho_b as halo points
+    if (haloExclusion):
+        hexels.isHalo = np.zeros(len(hexels), dtype=bool)
+        hexels.isHalo[assigned] = hexels.rho[assigned] < rho_b[clusterIndex[assigned]]
+    return rho_b
+
+# wall time and counts of the clustering stages, per layer (None for the stages run on a whole event or batch), summed over events
+# filled when given to makeClusters, makeClustersBatch and makePreClusters (with stats = None nothing is measured)
+class PipelineStats:
+    def __init__(self):
+        self.nEvents = 0
+        self.stages = [] # in the order they were first seen
+        self.records = {} # (stage, layer): calls, total time, and total of each count
+    # add one call of a stage that started at the given time (None for counts only), returns the current time (start of the next stage)
+    def add(self, stage, layer, start, **counts):
+        now = time.time()
+        if stage not in self.stages:
+            self.stages.append(stage)
+        record = self.records.setdefault((stage, layer), {"calls": 0, "time": 0., "counts": {}})
+        if start is not None:
+            record["calls"] += 1
+            record["time"] += now - start
+        for name, value in counts.items():
+            record["counts"][name] = record["counts"].get(name, 0) + int(value)
+        return now
+    # add the calls and counts of another one (e.g. filled by a pool worker)
+    def merge(self, other):
+        self.nEvents += other.nEvents
+        for stage in other.stages:
+            if stage not in self.stages:
+                self.stages.append(stage)
+        for key, other_record in other.records.items():
+            record = self.records.setdefault(key, {"calls": 0, "time": 0., "counts": {}})
+            record["calls"] += other_record["calls"]
+            record["time"] += other_record["time"]
+            for name, value in other_record["counts"].items():
+                record["counts"][name] = record["counts"].get(name, 0) + value
+        return self
+    # total time ("time"), calls ("calls") or count of a stage, over all layers
+    def getTotal(self, stage, name = "time"):
+        return sum(self.getRecordValue(record, name) for (recordStage, layer), record in self.records.items() if recordStage == stage)
+    # time, calls or count of a stage in each layer (e.g. for a histogram)
+    def getLayerValues(self, stage, name = "time", det_layers = det_layers):
+        values = np.zeros(det_layers)
+        for (recordStage, layer), record in self.records.items():
+            if recordStage == stage and layer is not None and layer < det_layers:
+                values[layer] += self.getRecordValue(record, name)
+        return values
+    def getRecordValue(self, record, name):
+        return record[name] if name in ("time", "calls") else record["counts"].get(name, 0)
+    # all stages with their totals, per-event means and per-layer records, e.g. for json.dump
+    def toDict(self):
+        stages = {}
+        for stage in self.stages:
+            names = sorted(set(name for (recordStage, layer), record in self.records.items() if recordStage == stage for name in record["counts"]))
+            totals = dict((name, self.getTotal(stage, name)) for name in ["time", "calls"] + names)
+            layers = dict((str(layer), record) for (recordStage, layer), record in self.records.items() if recordStage == stage and layer is not None)
+            stages[stage] = {"total": totals, "perEvent": dict((name, value/float(max(self.nEvents, 1))) for name, value in totals.items()), "layers": layers}
+        return {"events": self.nEvents, "stageOrder": self.stages, "stages": stages}
+    def saveJSON(self, fileName):
+        with open(fileName, "w") as f:
+            json.dump(self.toDict(), f, indent = 1, sort_keys = True)
+    # table of the stages: time and counts per event
+    def printSummary(self):
+        print "%-16s %8s %12s  %s" % ("stage", "calls", "time/ev [s]", "counts/ev")
+        for stage in self.stages:
+            perEvent = self.toDict()["stages"][stage]["perEvent"]
+            print "%-16s %8d %12.5f  %s" % (stage, self.getTotal(stage, "calls"), perEvent["time"],
+                                            ", ".join("%s %.1f" % (name, perEvent[name]) for name in sorted(perEvent.keys()) if name not in ("time", "calls")))
+
+# spatial index of the hexels, of the given type ("kdtree" or "tiles"), for searches within delta_c (the largest one if per hexel)
+# the kernels of the given backend are used by all clustering steps on the index
+def makeSpatialIndex(hexels, spatialIndex = spatialIndex, delta_c = delta_c, backend = kernelBackend):
+    if (spatialIndexTypes[spatialIndex] is TileIndex):
+        return TileIndex(hexels.x, hexels.y, hexels.group, tileSize = np.max(delta_c)*(1. + 1e-6), backend = backend)
+    return spatialIndexTypes[spatialIndex](hexels.x, hexels.y, hexels.group, backend = backend)
+
+# cluster the hexels of one layer: local density, distance to higher, cluster centers and assignment (in place)
+# the stages are timed (and counted) in stats under the given layer, if stats is given
+def clusterLayer(hexels, spatialIndex = spatialIndex, delta_c = delta_c, kappa = kappa, haloExclusion = haloExclusion, verbosityLevel = verbosityLevel,
+                 backend = kernelBackend, stats = None, layer = None):
+    if (len(hexels) == 0): return hexels # protection
+    if stats is not None: start = time.time()
+    hit_index = makeSpatialIndex(hexels, spatialIndex, delta_c, backend) # create KDTree (or tiles), shared by all steps below
+    if stats is not None: start = stats.add("index", layer, start, hits = len(hexels))
+    maxdensity = calculateLocalDensity(hexels, hit_index, delta_c) # get the max density
+    if stats is not None: start = stats.add("density", layer, start, neighbourPairs = len(getCloseNeighbourPairs(hit_index, delta_c)[0]))
+    calculateDistanceToHigher(hexels, hit_index) # get distances to the nearest higher density
+    if stats is not None: start = stats.add("nearestHigher", layer, start)
+    findAndAssignClusters(hexels, hit_index, maxdensity, delta_c, kappa, haloExclusion, verbosityLevel) # get clusters per layer
+    if stats is not None: stats.add("assignment", layer, start, seeds = hexels.nClusters, borderHits = hexels.isBorder.sum(), haloHits = hexels.isHalo.sum())
+    return hexels
+
+# value of a parameter for the given layer (the same for all layers if it is a single number)
+def getLayerValue(values, layer):
+    return values if np.ndim(values) == 0 else values[layer]
+
+# clusterLayer with all arguments in one tuple, to be mapped over the layers by a pool of workers
+# returns the clustered hexels and the stats of the layer (filled in the worker)
+def clusterLayerArgs(args):
+    return clusterLayer(*args), args[7]
+
+# cluster a small layer once, so that the modules are loaded and the kernels compiled before the first event (e.g. in a new pool worker)
+def warmLayerWorker(spatialIndex = spatialIndex, backend = kernelBackend):
+    x, y = np.meshgrid(np.arange(8.), np.arange(8.))
+    hexels = HexelLayer()
+    hexels.setColumns(x.ravel(), y.ravel(), np.linspace(0.1, 1., x.size))
+    clusterLayer(hexels, spatialIndex, backend = backend)
+
+# persistent pool of workers to cluster the layers of events in parallel (given to makeClusters for each event, closed by the caller)
+# threads share the kernels warmed up here, each process is warmed up once when it starts
+def makeLayerPool(nWorkers = layerWorkers, poolType = layerPoolType, spatialIndex = spatialIndex, backend = kernelBackend):
+    if (poolType not in ("threads", "processes")):
+        raise ValueError("unknown pool type '%s', expected 'threads' or 'processes'" % poolType)
+    if (poolType == "threads"):
+        warmLayerWorker(spatialIndex, backend)
+        return multiprocessing.pool.ThreadPool(nWorkers)
+    return multiprocessing.Pool(nWorkers, warmLayerWorker, (spatialIndex, backend))
+
+# make 2D clusters out of rechists (the parameters can also be kept together in an ImagingAlgo)
+# returns the list of per-layer hexel stores, with the clusterIndex of each hexel set
+# layers are clustered serially, or in the given pool (from makeLayerPool, kept by the caller for all events) in the same order
+# delta_c: one value, or one per layer
+# stats: PipelineStats to add the time and counts of the stages of this event to (None to measure nothing)
+def makeClusters(rHitsCollection, ecut = ecut, spatialIndex = spatialIndex, pool = None, delta_c = delta_c, kappa = kappa,
+                 haloExclusion = haloExclusion, det_layers = det_layers, verbosityLevel = verbosityLevel, backend = kernelBackend, stats = None):
+    if stats is not None: start = time.time()
     # init 2D hexels lists
-    points = [[] for i in range(0,det_layers)] # initialise list of per-layer-lists of hexels
-    clusters = [[] for i in range(0,det_layers)] # initialise list of per-layer-clusters
+    rHits = [[] for i in range(0,det_layers)] # initialise list of per-layer-lists of rechits
 
-    # loop over all hits and create the Hexel structure, skip energies below ecut
+    # loop over all hits and sort them into layers, skip energies below ecut
     for rHit in rHitsCollection:
         if (rHit.layer >= det_layers): continue # current protection
         if(rHit.energy < ecut): continue
-        points[rHit.layer].append(Hexel(rHit))
-
-    # loop over all layers, and for each layer create a list of clusters
-    for layer in range(0, det_layers):
-        if (len(points[layer]) == 0): continue # protection
-        points_0 = [hex.x for hex in points[layer]] # list of hexels'coordinate 0 for current layer
-        points_1 = [hex.y for hex in points[layer]] # list of hexels'coordinate 1 for current layer
-        hit_kdtree = spatial.KDTree(zip(points_0, points_1), leafsize=1000) # create KDTree
-        maxdensity = calculateLocalDensity(points[layer], hit_kdtree) # get the max density
-        #print "layer: ", layer, ", max density: ", maxdensity, ", total hits: ", len(points[layer])
-        calculateDistanceToHigher(points[layer], hit_kdtree) # get distances to the nearest higher density
-        clusters[layer] = findAndAssignClusters(points[layer], points_0, points_1, hit_kdtree, maxdensity) # get clusters per layer
-        #print "found: ", len(clusters[layer]), " clusters."
-
-    # return the clusters list
-    return clusters
-
-# get basic clusters from the list of 2D clusters
-def getClusters(clusters):
+        rHits[rHit.layer].append(rHit)
+
+    # create the columnar Hexel structure per layer
+    points = [HexelLayer(rHits[layer]) for layer in range(0, det_layers)]
+    if stats is not None:
+        stats.nEvents += 1
+        stats.add("hexels", None, start, hitsIn = len(rHitsCollection), hitsAfterEcut = sum(len(hexels) for hexels in points))
+
+    # loop over all layers, and for each layer find the clusters
+    if (pool is None):
+        points = [clusterLayer(hexels, spatialIndex, getLayerValue(delta_c, layer), kappa, haloExclusion, verbosityLevel, backend, stats, layer)
+                  for layer, hexels in enumerate(points)]
+    else:
+        # the layers are independent until the multi-clustering, map returns them in the original order
+        # (each layer fills its own stats, added up here)
+        results = pool.map(clusterLayerArgs, [(hexels, spatialIndex, getLayerValue(delta_c, layer), kappa, haloExclusion, verbosityLevel, backend,
+                                               None if stats is None else PipelineStats(), layer) for layer, hexels in enumerate(points)], chunksize = 1)
+        points = [hexels for hexels, layerStats in results]
+        if stats is not None:
+            for hexels, layerStats in results:
+                stats.merge(layerStats)
+
+    # return the per-layer hexels, clustered
+    return points
+
+# 2D clusters of many events in compact array form (made by makeClustersBatch)
+class ClusterBatch:
+    def __init__(self, hexels, groupEvent, groupLayer, nEvents, det_layers = det_layers):
+        # hexels of all events (energy above ecut), sorted by event and layer, clusterIndex numbered over all events
+        self.hexels = hexels
+        # event and layer of each group of hexels
+        self.groupEvent = groupEvent
+        self.groupLayer = groupLayer
+        self.nEvents = nEvents
+        self.det_layers = det_layers
+        groupStarts = hexels.getGroupStarts()
+        self.groupOffsets = np.r_[groupStarts, len(hexels)].astype(np.int64) # hexels of group g: groupOffsets[g]:groupOffsets[g+1]
+        self.hitOffsets = self.groupOffsets[np.searchsorted(groupEvent, np.arange(nEvents+1))] # hexels of each event
+        # hexel indices of each cluster: clusterHits[clusterOffsets[c]:clusterOffsets[c+1]]
+        self.clusterHits, self.clusterOffsets = hexels.getClusterHits()
+        # event and layer of each cluster, and its energy, position and size (see ClusterPositions)
+        self.clusterGroup = hexels.group[self.clusterHits[self.clusterOffsets[:-1]]]
+        self.clusterEvent = groupEvent[self.clusterGroup]
+        self.clusterLayer = groupLayer[self.clusterGroup]
+        self.clusters = calculateClusterPositions(hexels)
+        # first cluster of each group and of each event
+        self.groupClusterOffsets = np.searchsorted(self.clusterGroup, np.arange(len(groupEvent)+1))
+        self.eventClusterOffsets = np.searchsorted(self.clusterEvent, np.arange(nEvents+1))
+    # per-layer hexel stores of one event, as returned by makeClusters (e.g. for getClusters and makePreClusters)
+    def getLayers(self, event):
+        layers = [HexelLayer() for layer in range(0, self.det_layers)]
+        hexels = self.hexels
+        for group in range(np.searchsorted(self.groupEvent, event), np.searchsorted(self.groupEvent, event, side='right')):
+            first, last = self.groupOffsets[group], self.groupOffsets[group+1]
+            layer = HexelLayer()
+            layer.setColumns(hexels.x[first:last], hexels.y[first:last], hexels.weight[first:last], z = hexels.z[first:last],
+                             eta = hexels.eta[first:last], phi = hexels.phi[first:last], detid = hexels.detid[first:last])
+            layer.rho = hexels.rho[first:last].copy()
+            layer.delta = hexels.delta[first:last].copy()
+            # indices relative to the layer (-1 stays -1)
+            nearestHigher = hexels.nearestHigher[first:last]
+            layer.nearestHigher = np.where(nearestHigher != -1, nearestHigher - first, -1)
+            clusterIndex = hexels.clusterIndex[first:last]
+            layer.clusterIndex = np.where(clusterIndex != -1, clusterIndex - self.groupClusterOffsets[group], -1)
+            layer.nClusters = self.groupClusterOffsets[group+1] - self.groupClusterOffsets[group]
+            layer.isBorder = hexels.isBorder[first:last].copy()
+            layer.isHalo = hexels.isHalo[first:last].copy()
+            layers[self.groupLayer[group]] = layer
+        return layers
+
+# flat arrays of the rechits of many events (rechit lists, e.g. one per event), as taken by makeClustersBatch
+# returns the event offsets, and the layer, x, y, energy, z, eta, phi and detid of all rechits
+def getRecHitArrays(rHitsCollections):
+    rHits = [rHit for rHitsCollection in rHitsCollections for rHit in rHitsCollection]
+    eventOffsets = np.r_[0, np.cumsum([len(rHitsCollection) for rHitsCollection in rHitsCollections])].astype(np.int64)
+    columns = [np.array([getattr(rHit, name) for rHit in rHits]) for name in ("layer", "x", "y", "energy", "z", "eta", "phi", "detid")]
+    return [eventOffsets] + columns
+
+# hexel store of many events, from flat arrays of rechits (e.g. read from the ntuple branches of many events)
+# the rechits of event i are at eventOffsets[i]:eventOffsets[i+1], and layer gives the layer of each rechit
+# returns the hexels (energy above ecut, sorted by event and layer, grouped by (event, layer)), the event and layer of each group, and the number of events
+def makeHexelBatch(eventOffsets, layer, x, y, energy, z = None, eta = None, phi = None, detid = None, ecut = ecut, det_layers = det_layers):
+    eventOffsets = np.asarray(eventOffsets, dtype=np.int64)
+    nEvents = len(eventOffsets) - 1
+    layer = np.asarray(layer, dtype=np.int64)
+    energy = np.asarray(energy, dtype=np.float64)
+    hits = np.arange(eventOffsets[0], eventOffsets[-1])
+    event = np.repeat(np.arange(nEvents), np.diff(eventOffsets))
+
+    # skip layers beyond det_layers and energies below ecut, and sort by event and layer (keeping the order of the rechits)
+    keep = (layer[hits] < det_layers) & ~(energy[hits] < ecut)
+    hits = hits[keep]
+    key = event[keep]*det_layers + layer[hits]
+    order = np.argsort(key, kind='mergesort')
+    hits = hits[order]
+    key = key[order]
+
+    # number the (event, layer) groups with hits
+    groupStarts = findRunStarts(key)
+    group = np.repeat(np.arange(len(groupStarts)), np.diff(np.r_[groupStarts, len(key)]))
+    groupEvent = key[groupStarts]//det_layers
+    groupLayer = key[groupStarts]%det_layers
+
+    column = lambda values: None if values is None else np.asarray(values)[hits]
+    hexels = HexelLayer()
+    hexels.setColumns(np.asarray(x)[hits], np.asarray(y)[hits], energy[hits], z = column(z), eta = column(eta), phi = column(phi),
+                      detid = column(detid), group = group)
+    return hexels, groupEvent, groupLayer, nEvents
+
+# make 2D clusters of many events at once, from flat arrays of rechits (see makeHexelBatch)
+# all (event, layer) groups are clustered in one pass, with the same results as makeClusters for each event (delta_c: one value, or one per layer)
+# stats: the stages are timed for the whole batch (layer None), the counts are also added per layer
+def makeClustersBatch(eventOffsets, layer, x, y, energy, z = None, eta = None, phi = None, detid = None, ecut = ecut, spatialIndex = spatialIndex,
+                      delta_c = delta_c, kappa = kappa, haloExclusion = haloExclusion, det_layers = det_layers, verbosityLevel = verbosityLevel,
+                      backend = kernelBackend, stats = None):
+    if stats is not None: start = time.time()
+    hexels, groupEvent, groupLayer, nEvents = makeHexelBatch(eventOffsets, layer, x, y, energy, z, eta, phi, detid, ecut, det_layers)
+    if stats is not None:
+        stats.nEvents += nEvents
+        stats.add("hexels", None, start, hitsIn = eventOffsets[-1] - eventOffsets[0], hitsAfterEcut = len(hexels))
+    # cluster all groups together, the spatial index keeps them apart
+    batchStats = None if stats is None else PipelineStats()
+    clusterLayer(hexels, spatialIndex, getHexelValues(delta_c, groupLayer, hexels), kappa, haloExclusion, verbosityLevel, backend, batchStats)
+    batch = ClusterBatch(hexels, groupEvent, groupLayer, nEvents, det_layers)
+    if stats is not None and len(hexels) > 0:
+        # the hits, seeds, border and halo hits are counted per layer instead (the neighbour pairs only for the whole batch)
+        for record in batchStats.records.values():
+            record["counts"] = dict((name, value) for name, value in record["counts"].items() if name == "neighbourPairs")
+        stats.merge(batchStats)
+        hexelLayer = groupLayer[hexels.group]
+        for layerIndex in np.unique(groupLayer):
+            inLayer = hexelLayer == layerIndex
+            stats.add("index", layerIndex, None, hits = np.count_nonzero(inLayer))
+            stats.add("assignment", layerIndex, None, seeds = np.count_nonzero(batch.clusterLayer == layerIndex),
+                      borderHits = np.count_nonzero(hexels.isBorder & inLayer), haloHits = np.count_nonzero(hexels.isHalo & inLayer))
+    return batch
+
+# value of a parameter for each hexel of a batch, from its value per layer (kept as a single number if it is the same for all layers)
+def getHexelValues(values, groupLayer, hexels):
+    return values if np.ndim(values) == 0 else np.asarray(values, dtype=np.float64)[groupLayer][hexels.group]
+
+# compact clustered output of one event (float32 positions and energies, uint32 detids, int32 cluster indices), in buffers
+# allocated once and reused by each fill: the memory is that of the largest event so far (at least the initial capacity)
+# the clustered hits are sorted by 2D cluster: the hits of cluster c are hitOffsets[c]:hitOffsets[c+1] of the hit columns,
+# the clusters are sorted by layer (as in getClusters), with their energy, position and size
+class CompactClusters:
+    hitColumns = (("x", np.float32), ("y", np.float32), ("z", np.float32), ("eta", np.float32), ("phi", np.float32), ("weight", np.float32),
+                  ("rho", np.float32), ("detid", np.uint32), ("clusterIndex", np.int32), ("layer", np.uint8), ("isBorder", bool), ("isHalo", bool))
+    clusterColumns = (("energy", np.float32), ("x", np.float32), ("y", np.float32), ("z", np.float32), ("eta", np.float32), ("phi", np.float32),
+                      ("size", np.uint32), ("layer", np.uint8))
+    def __init__(self, maxHits = compactMaxHits, maxClusters = compactMaxClusters):
+        self.nHits = 0
+        self.nClusters = 0
+        self.reallocations = 0
+        self.hitBuffers = dict((name, np.zeros(maxHits, dtype=dtype)) for name, dtype in self.hitColumns)
+        self.clusterBuffers = dict((name, np.zeros(maxClusters, dtype=dtype)) for name, dtype in self.clusterColumns)
+        self.hitOffsetBuffer = np.zeros(maxClusters + 1, dtype=np.uint32)
+    # make room for the given numbers of hits and clusters (the buffers are only replaced by twice larger ones if too small)
+    def reserve(self, nHits, nClusters):
+        for buffers, n in ((self.hitBuffers, nHits), (self.clusterBuffers, nClusters)):
+            capacity = len(buffers.values()[0])
+            if n > capacity:
+                capacity = max(n, 2*capacity)
+                for name in buffers.keys():
+                    buffers[name] = np.zeros(capacity, dtype=buffers[name].dtype)
+                self.reallocations += 1
+        if nClusters + 1 > len(self.hitOffsetBuffer):
+            self.hitOffsetBuffer = np.zeros(len(self.clusterBuffers["energy"]) + 1, dtype=np.uint32)
+        self.nHits = nHits
+        self.nClusters = nClusters
+    # column of the hits or of the clusters of the current event (view of the buffer, overwritten by the next fill)
+    def getHitColumn(self, name):
+        return self.hitBuffers[name][:self.nHits]
+    def getClusterColumn(self, name):
+        return self.clusterBuffers[name][:self.nClusters]
+    def getHitOffsets(self):
+        return self.hitOffsetBuffer[:self.nClusters+1]
+    # bytes held by the buffers
+    def nbytes(self):
+        return sum(buffer.nbytes for buffers in (self.hitBuffers, self.clusterBuffers) for buffer in buffers.values()) + self.hitOffsetBuffer.nbytes
+    # copy the given hits (sorted by cluster) of a hexel store, from position first on, with their cluster index (counted from clusterFirst)
+    def setHits(self, first, hexels, hits, clusterIndex, layer):
+        last = first + len(hits)
+        for name in ("x", "y", "z", "eta", "phi", "weight", "rho", "detid", "isBorder", "isHalo"):
+            self.hitBuffers[name][first:last] = getattr(hexels, name)[hits]
+        self.hitBuffers["clusterIndex"][first:last] = clusterIndex
+        self.hitBuffers["layer"][first:last] = layer
+    # copy the selected clusters of a ClusterPositions from position first on
+    def setClusters(self, first, positions, layer, select = slice(None)):
+        for name in ("energy", "x", "y", "z", "eta", "phi", "size"):
+            values = getattr(positions, name)[select]
+            last = first + len(values)
+            self.clusterBuffers[name][first:last] = values
+        self.clusterBuffers["layer"][first:last] = layer
+    # fill with the per-layer clustered hexels of one event (as returned by makeClusters)
+    def fill(self, clusters):
+        clusterHits = [hexels.getClusterHits() for hexels in clusters]
+        self.reserve(sum(len(hits) for hits, offsets in clusterHits), sum(hexels.nClusters for hexels in clusters))
+        hitFirst = 0
+        clusterFirst = 0
+        for layer, hexels in enumerate(clusters):
+            hits, offsets = clusterHits[layer]
+            if hexels.nClusters == 0: continue
+            self.setHits(hitFirst, hexels, hits, hexels.clusterIndex[hits] + clusterFirst, layer)
+            self.setClusters(clusterFirst, calculateClusterPositions(hexels), layer)
+            self.hitOffsetBuffer[clusterFirst:clusterFirst+hexels.nClusters+1] = offsets + hitFirst
+            hitFirst += len(hits)
+            clusterFirst += hexels.nClusters
+        self.hitOffsetBuffer[clusterFirst] = hitFirst
+        return self
+    # fill with one event of a ClusterBatch (see makeClustersBatch)
+    def fillBatch(self, batch, event):
+        clusterFirst, clusterLast = batch.eventClusterOffsets[event], batch.eventClusterOffsets[event+1]
+        hitFirst, hitLast = batch.clusterOffsets[clusterFirst], batch.clusterOffsets[clusterLast]
+        hits = batch.clusterHits[hitFirst:hitLast]
+        self.reserve(len(hits), clusterLast - clusterFirst)
+        self.setHits(0, batch.hexels, hits, batch.hexels.clusterIndex[hits] - clusterFirst, batch.groupLayer[batch.hexels.group[hits]])
+        self.setClusters(0, batch.clusters, batch.clusterLayer[clusterFirst:clusterLast], slice(clusterFirst, clusterLast))
+        self.hitOffsetBuffer[:clusterLast-clusterFirst+1] = batch.clusterOffsets[clusterFirst:clusterLast+1] - hitFirst
+        return self
+
+# get basic clusters from the list of per-layer clustered hexels
+def getClusters(clusters, verbosityLevel = verbosityLevel):
     # init the lists
     thisCluster = []
     clusters_v = []
-    # loop over all layers and all clusters in each layer
+    # loop over all layers and all clusters in each layer (Hexel views are created only here)
     layer = 0
-    for clist_per_layer in clusters:
+    for hexels in clusters:
+        positions = calculateClusterPositions(hexels)
         index = 0
-        for cluster in clist_per_layer:
-            energy = 0
-            position = calculatePosition(cluster)
-            for iNode in cluster:
-                if (not iNode.isHalo):
-                    energy += iNode.weight
+        for cluster in hexels.getClusters():
             if (verbosityLevel>=1):
-                print "Layer: ", layer, "| 2D-cluster index: ", index, ", No. of cells = ", len(cluster), ", Energy  = ", energy, ", Phi = ", position.phi(), ", Eta = ", position.eta(), ", z = ", position.z()
+                print "Layer: ", layer, "| 2D-cluster index: ", index, ", No. of cells = ", len(cluster), ", Energy  = ", float(positions.energy[index]), ", Phi = ", float(positions.phi[index]), ", Eta = ", float(positions.eta[index]), ", z = ", float(positions.z[index])
                 for iNode in cluster:
                     if (not iNode.isHalo):
                         print "Layer: ", layer, "|                    ",       "  detid = ", iNode.detid, ", weight  = ", iNode.weight, ", phi = ", iNode.phi, ", eta = ", iNode.eta
 
-            clusters_v.append(BasicCluster(energy = energy, position = position, thisCluster = cluster))
+            clusters_v.append(positions.getBasicCluster(index, thisCluster = cluster))
             index += 1
         layer += 1
     return clusters_v
 
+# energy, position and size of the 2D clusters of all layers, in the order of getClusters
+def getClusterPositions(clusters):
+    positions = [calculateClusterPositions(hexels) for hexels in clusters]
+    positions.append(ClusterPositions(np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64)))
+    return ClusterPositions(*[np.concatenate([getattr(position, name) for position in positions]) for name in ("energy", "x", "y", "z", "size")])
+
+# energy and position of the multi-clusters, from the energy, position and size of their 2D clusters
+# members: indices of the 2D clusters of each multi-cluster; the position is based on the positions of the 2D clusters
+# weighted by the energy (times size), summed in the order of the members as the loop over the 2D clusters did
+def calculateMultiClusterPositions(clusterPositions, members, vz = 0.):
+    sizes = np.array([len(clusterIndices) for clusterIndices in members], dtype=np.int64)
+    owner = np.repeat(np.arange(len(members)), sizes)
+    clusterIndices = np.concatenate([np.asarray(clusterIndices, dtype=np.int64) for clusterIndices in members] + [np.zeros(0, dtype=np.int64)])
+    x = clusterPositions.x[clusterIndices]
+    y = clusterPositions.y[clusterIndices]
+    point_r2 = (x*x + y*y)
+    point_z = clusterPositions.z[clusterIndices] - vz
+    point_h = np.power(point_r2 + point_z*point_z,0.5)
+    weight = clusterPositions.energy[clusterIndices] * clusterPositions.size[clusterIndices] # need to check this (is it weight = energy * size ?)
+    for i in range(np.count_nonzero(~((y != 0.) | (x != 0.)))): print "Cluster position somehow in beampipe."
+    for i in range(np.count_nonzero(~(point_z != 0.))): print "Layer-cluster position given as reference point."
+    point_r = np.power(point_r2,0.5)
+    nMulti = len(members)
+    acc_rho = np.bincount(owner, weights=point_r * weight, minlength=nMulti)
+    acc_phi = np.bincount(owner, weights=np.arctan2(y,x) * weight, minlength=nMulti)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acc_eta = np.bincount(owner, weights=-1. * np.log(point_r/(point_z + point_h)) * weight, minlength=nMulti)
+        invweight = 1.0/np.bincount(owner, weights=weight, minlength=nMulti)
+    rho = acc_rho*invweight
+    eta = acc_eta*invweight
+    phi = acc_phi*invweight
+    # from (rho, eta, phi) to (x, y, z), with the conventions of ROOT.Math.RhoEtaPhiPoint
+    z = np.where(rho > 0, rho*np.sinh(eta), np.where(eta == 0, 0., np.where(eta > 0, eta - etaMax, eta + etaMax)))
+    energy = np.bincount(owner, weights=clusterPositions.energy[clusterIndices], minlength=nMulti)
+    return ClusterPositions(energy, rho*np.cos(phi), rho*np.sin(phi), z, sizes)
+
 # get position of the multi-cluster, based on the positions of its 2D clusters weighted by the energy
 def getMultiClusterPosition(multi_clu, vz):
-    if(len(multi_clu) == 0): return ROOT.Math.XYZPoint()
-    acc_rho = 0.0
-    acc_eta = 0.0
-    acc_phi = 0.0
-    totweight = 0.
-    for layer_clu in multi_clu:
-        x = layer_clu.x
-        y = layer_clu.y
-        point_r2 = (x*x + y*y)
-        point_z = layer_clu.z-vz
-        point_h = pow(point_r2 + point_z*point_z,0.5)
-        weight = layer_clu.energy * len(layer_clu.thisCluster) # need to check this (is it weight = energy * size ?)
-        if not (y != 0. or x != 0.): print "Cluster position somehow in beampipe."
-        if not (point_z != 0.): print "Layer-cluster position given as reference point."
-        point_r = pow(point_r2,0.5)
-        acc_rho += point_r * weight
-        acc_phi += math.atan2(y,x) * weight
-        acc_eta += -1. * math.log(point_r/(point_z + point_h)) * weight
-        totweight += weight
-    invweight = 1.0/totweight
-    temp = ROOT.Math.RhoEtaPhiPoint(acc_rho*invweight,acc_eta*invweight,acc_phi*invweight)
-    return ROOT.Math.XYZPoint(temp.x(),temp.y(),temp.z())
+    if(len(multi_clu) == 0): return ClusterPoint(0., 0., 0., 0., 0.)
+    clusterPositions = ClusterPositions(np.array([layer_clu.energy for layer_clu in multi_clu]), np.array([layer_clu.x for layer_clu in multi_clu]),
+                                        np.array([layer_clu.y for layer_clu in multi_clu]), np.array([layer_clu.z for layer_clu in multi_clu]),
+                                        np.array([len(layer_clu.thisCluster) for layer_clu in multi_clu]))
+    return calculateMultiClusterPositions(clusterPositions, [np.arange(len(multi_clu))], vz).getPoint(0)
 
 # get energy of the multi-cluster, based on its 2D clusters
 def getMultiClusterEnergy(multi_clu):
@@ -316,41 +1029,168 @@ def getMultiClusterEnergy(multi_clu):
         acc += layer_clu.energy
     return acc
 
-# make multi-clusters stasrting from the 2D clusters
-def makePreClusters(clusters, multiclusterRadius = multiclusterRadius, minClusters = minClusters):
-    # get clusters in one list (just following original approach)
-    thecls = getClusters(clusters)
+# group the 2D clusters into multi-clusters: in decreasing energy, each cluster not used yet takes all unused clusters within radius
+# u, v: eta and phi (or x and y) of the clusters, the cone is searched in a KDTree of all clusters built once
+# returns the indices of the clusters of each multi-cluster (in decreasing energy)
+def findMultiClusters(u, v, z, energy, radius, phiWrap = False, backend = kernelBackend):
+    u = np.asarray(u, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    # positions sorted by decreasing energy
+    es = sortedDecreasing(np.asarray(energy, dtype=np.float64))
+    u, v, z = u[es], v[es], z[es]
+    nClusters = len(es)
+    if nClusters == 0:
+        return []
+    # with the phi wrap, copies of the clusters close to phi = +-pi are added on the other side
+    owner = np.arange(nClusters)
+    points = np.column_stack((u, v))
+    if phiWrap:
+        low = np.flatnonzero(v < -math.pi + radius)
+        high = np.flatnonzero(v > math.pi - radius)
+        owner = np.concatenate((owner, low, high))
+        points = np.vstack((points, np.column_stack((u[low], v[low] + 2*math.pi)), np.column_stack((u[high], v[high] - 2*math.pi))))
+    # clusters in the cone of each cluster, from a slightly larger radius and then the exact (strict) cut, as in distanceDR2/distanceReal2
+    inCone = spatial.cKDTree(points).query_ball_point(points[:nClusters], radius*(1. + 1e-9))
+    offsets = np.r_[0, np.cumsum([len(found) for found in inCone])].astype(np.int64)
+    candidates = owner[np.concatenate([np.asarray(found, dtype=np.int64) for found in inCone])]
+
+    # same greedy assignment as the loop over all pairs, then the clusters of each multi-cluster in decreasing energy (the leading one first)
+    leader = HGCalKernels.getKernels(backend).assignMultiClusters(u, v, z, offsets, candidates, radius, phiWrap)
+    members = np.argsort(leader, kind='mergesort')
+    return [es[found] for found in np.split(members, findRunStarts(leader[members])[1:])]
 
-    # init lists and vars
+# make multi-clusters stasrting from the 2D clusters (timed and counted in stats if given)
+def makePreClusters(clusters, multiclusterRadius = multiclusterRadius, minClusters = minClusters, realSpaceCone = realSpaceCone,
+                    multiclusterPhiWrap = multiclusterPhiWrap, verbosityLevel = verbosityLevel, backend = kernelBackend, stats = None):
+    if stats is not None: start = time.time()
+    if (verbosityLevel>=1): getClusters(clusters, verbosityLevel) # only to print the 2D clusters
+
+    # init lists and vars (the 2D clusters as arrays, in the order of getClusters)
     thePreClusters = []
-    vused = [0.]*len(thecls)
-    used = 0
-    # indices sorted by decreasing energy
-    es = sorted(range(len(thecls)), key=lambda k: thecls[k].energy, reverse=True)
-    # loop over all clusters
-    index = 0
-    for i in range(0,len(thecls)):
-        if(vused[i]==0):
-            temp = [thecls[es[i]]]
-            if (thecls[es[i]].z>0): vused[i] = 1
-            else: vused[i] = -1
-            used += 1
-            for j in range(i+1,len(thecls)):
-                if(vused[j]==0):
-                    distanceCheck = 9999.
-                    if(realSpaceCone):
-                        distanceCheck = distanceReal2(thecls[es[i]],thecls[es[j]])
-                    else:
-                        distanceCheck = distanceDR2(thecls[es[i]],thecls[es[j]])
-                    if( distanceCheck < multiclusterRadius*multiclusterRadius and int(thecls[es[i]].z*vused[i])>0 ):
-                        temp.append(thecls[es[j]])
-                        vused[j] = vused[i]
-                        used += 1
-            if(len(temp) > minClusters):
-                position = getMultiClusterPosition(temp, 0)
-                energy = getMultiClusterEnergy(temp)
-                thePreClusters.append(BasicCluster(energy = energy, position = position, thisCluster = temp))
-                print "Multi-cluster index: ", index, ", No. of 2D-clusters = ", len(temp), ", Energy  = ", energy, ", Phi = ", position.phi(), ", Eta = ", position.eta(), ", z = ", position.z()
-                index += 1
+    positions = getClusterPositions(clusters)
+    # group the clusters, in a cone in eta/phi (or x/y) around the most energetic ones
+    if(realSpaceCone):
+        u, v = positions.x, positions.y
+    else:
+        u, v = positions.eta, positions.phi
+    multiClusters = findMultiClusters(u, v, positions.z, positions.energy, multiclusterRadius, phiWrap = multiclusterPhiWrap and not realSpaceCone,
+                                      backend = backend)
+    multiClusters = [members for members in multiClusters if len(members) > minClusters]
+    multiPositions = calculateMultiClusterPositions(positions, multiClusters, 0)
+    # layer and index in the layer of each 2D cluster, and the hexels of the clusters of each layer (Hexel views only made on access)
+    layerFirst = np.r_[0, np.cumsum([hexels.nClusters for hexels in clusters])].astype(np.int64)
+    clusterLayer = np.repeat(np.arange(len(clusters)), np.diff(layerFirst))
+    clusterHits = [hexels.getClusterHits() if hexels.nClusters > 0 else None for hexels in clusters]
+    def getCluster(k):
+        layer = clusterLayer[k]
+        hits, offsets = clusterHits[layer]
+        index = k - layerFirst[layer]
+        return positions.getBasicCluster(k, thisCluster = ClusterHexels(clusters[layer], hits[offsets[index]:offsets[index+1]]))
+    # loop over all multi-clusters
+    for index in range(0, len(multiClusters)):
+        temp = [getCluster(k) for k in multiClusters[index]]
+        thePreClusters.append(multiPositions.getBasicCluster(index, thisCluster = temp))
+        if (verbosityLevel>=1):
+            print "Multi-cluster index: ", index, ", No. of 2D-clusters = ", len(temp), ", Energy  = ", float(multiPositions.energy[index]), ", Phi = ", float(multiPositions.phi[index]), ", Eta = ", float(multiPositions.eta[index]), ", z = ", float(multiPositions.z[index])
+    if stats is not None: stats.add("multiClusters", None, start, clusters = len(positions), multiClusters = len(thePreClusters))
     return thePreClusters
 
+# scan of the clustering parameters on the same events (flat arrays of rechits, see makeHexelBatch)
+# the expensive steps are done once per parameter they depend on: the hexels once per ecut, the local density and nearest
+# higher hits once per delta_c, the cluster centers and assignment for each kappa, and the multi-clustering once per radius
+# (the minClusters values only select among its multi-clusters)
+# returns one row per parameter point, with the mean number and energy of the 2D and multi-clusters per event
+def scanParameters(eventOffsets, layer, x, y, energy, z = None, eta = None, phi = None, detid = None, ecuts = [ecut], deltaCs = [delta_c],
+                   kappas = [kappa], multiclusterRadii = [multiclusterRadius], minClustersValues = [minClusters], spatialIndex = spatialIndex,
+                   haloExclusion = haloExclusion, realSpaceCone = realSpaceCone, multiclusterPhiWrap = multiclusterPhiWrap, det_layers = det_layers,
+                   backend = kernelBackend):
+    rows = []
+    for ecutValue in ecuts:
+        hexels, groupEvent, groupLayer, nEvents = makeHexelBatch(eventOffsets, layer, x, y, energy, z, eta, phi, detid, ecutValue, det_layers)
+        for deltaC in deltaCs:
+            if (len(hexels) > 0):
+                hexelDeltaC = getHexelValues(deltaC, groupLayer, hexels)
+                hit_index = makeSpatialIndex(hexels, spatialIndex, hexelDeltaC, backend)
+                maxdensity = calculateLocalDensity(hexels, hit_index, hexelDeltaC)
+                calculateDistanceToHigher(hexels, hit_index)
+            for kappaValue in kappas:
+                if (len(hexels) > 0): findAndAssignClusters(hexels, hit_index, maxdensity, hexelDeltaC, kappaValue, haloExclusion, 0)
+                batch = ClusterBatch(hexels, groupEvent, groupLayer, nEvents, det_layers)
+                clusters = batch.clusters
+                u, v = (clusters.x, clusters.y) if realSpaceCone else (clusters.eta, clusters.phi)
+                for radius in multiclusterRadii:
+                    # multi-clusters of each event, as indices of the 2D clusters of the batch
+                    multiClusters = []
+                    for event in range(0, nEvents):
+                        first, last = batch.eventClusterOffsets[event], batch.eventClusterOffsets[event+1]
+                        multiClusters.append([first + members for members in findMultiClusters(u[first:last], v[first:last], clusters.z[first:last],
+                                              clusters.energy[first:last], radius, phiWrap = multiclusterPhiWrap and not realSpaceCone, backend = backend)])
+                    for minClustersValue in minClustersValues:
+                        selected = [members for eventMultiClusters in multiClusters for members in eventMultiClusters if len(members) > minClustersValue]
+                        multiEnergy = [clusters.energy[members].sum() for members in selected]
+                        rows.append({"ecut": ecutValue, "delta_c": deltaC, "kappa": kappaValue, "multiclusterRadius": radius, "minClusters": minClustersValue,
+                                     "events": nEvents, "hits": len(hexels)/float(max(nEvents, 1)),
+                                     "clusters": len(clusters)/float(max(nEvents, 1)), "clusterEnergy": clusters.energy.sum()/max(nEvents, 1),
+                                     "multiClusters": len(selected)/float(max(nEvents, 1)), "multiClusterEnergy": np.sum(multiEnergy)/max(nEvents, 1)})
+    return rows
+
+# print the rows of a parameter scan as a table
+def printScanTable(rows):
+    print "%8s %8s %8s %8s %6s %10s %10s %12s %10s %12s" % ("ecut", "delta_c", "kappa", "radius", "minCl", "hits/ev", "2D/ev", "E(2D)/ev", "multi/ev", "E(multi)/ev")
+    for row in rows:
+        print "%8.3f %8s %8.2f %8.4f %6d %10.1f %10.2f %12.3f %10.2f %12.3f" % (row["ecut"], "%.2f" % row["delta_c"] if np.ndim(row["delta_c"]) == 0 else "layers", row["kappa"], row["multiclusterRadius"], row["minClusters"],
+                                                                                row["hits"], row["clusters"], row["clusterEnergy"], row["multiClusters"], row["multiClusterEnergy"])
+
+# delta_c of each layer, from its value in the EE, FH and BH
+def deltaCPerSubdetector(deltaEE, deltaFH, deltaBH, det_layers = det_layers):
+    layers = np.arange(det_layers)
+    return np.where(layers < firstFHLayer, deltaEE, np.where(layers < firstBHLayer, deltaFH, deltaBH)).astype(np.float64)
+
+# imaging algo with its parameters fixed at creation (instead of the module parameters): several configurations can be used
+# in one process, and one configuration can be shared by threads and pool workers, as nothing is changed by the calls
+# delta_c: one value, or one per layer (e.g. from deltaCPerSubdetector)
+class ImagingAlgo(object):
+    parameters = ("delta_c", "kappa", "ecut", "multiclusterRadius", "realSpaceCone", "multiclusterPhiWrap", "minClusters", "haloExclusion",
+                  "det_layers", "spatialIndex", "backend", "verbosityLevel")
+    def __init__(self, delta_c = delta_c, kappa = kappa, ecut = ecut, multiclusterRadius = multiclusterRadius, realSpaceCone = realSpaceCone,
+                 multiclusterPhiWrap = multiclusterPhiWrap, minClusters = minClusters, haloExclusion = haloExclusion, det_layers = det_layers,
+                 spatialIndex = spatialIndex, backend = kernelBackend, verbosityLevel = verbosityLevel):
+        if (np.ndim(delta_c) > 0):
+            delta_c = np.array(delta_c, dtype=np.float64)
+            if (delta_c.shape != (det_layers,)):
+                raise ValueError("delta_c has %d values, expected one per layer (%d)" % (delta_c.size, det_layers))
+            delta_c.flags.writeable = False
+        if (spatialIndex not in spatialIndexTypes):
+            raise ValueError("unknown spatial index '%s', expected one of %s" % (spatialIndex, sorted(spatialIndexTypes.keys())))
+        HGCalKernels.checkBackend(backend) # the kernels are only loaded when used
+        values = locals()
+        for name in self.parameters:
+            object.__setattr__(self, name, values[name])
+    def __setattr__(self, name, value):
+        raise AttributeError("the parameters of an ImagingAlgo are fixed, use replace() to get one with other parameters")
+    def __repr__(self):
+        return "ImagingAlgo(%s)" % ", ".join("%s = %r" % (name, getattr(self, name)) for name in self.parameters)
+    # copy of the algo, with some parameters changed
+    def replace(self, **changes):
+        values = dict((name, getattr(self, name)) for name in self.parameters)
+        values.update(changes)
+        return ImagingAlgo(**values)
+    # persistent pool of workers to cluster the layers with this configuration (see makeLayerPool)
+    def makeLayerPool(self, nWorkers = layerWorkers, poolType = layerPoolType):
+        return makeLayerPool(nWorkers, poolType, self.spatialIndex, self.backend)
+    # per-layer hexel stores with the 2D clusters of one event (see makeClusters)
+    def makeClusters(self, rHitsCollection, pool = None, stats = None):
+        return makeClusters(rHitsCollection, self.ecut, self.spatialIndex, pool, self.delta_c, self.kappa, self.haloExclusion,
+                            self.det_layers, self.verbosityLevel, self.backend, stats)
+    # 2D clusters of many events at once, from flat arrays of rechits (see makeClustersBatch)
+    def makeClustersBatch(self, eventOffsets, layer, x, y, energy, z = None, eta = None, phi = None, detid = None, stats = None):
+        return makeClustersBatch(eventOffsets, layer, x, y, energy, z, eta, phi, detid, self.ecut, self.spatialIndex, self.delta_c, self.kappa,
+                                 self.haloExclusion, self.det_layers, self.verbosityLevel, self.backend, stats)
+    # basic clusters from the per-layer clustered hexels (see getClusters)
+    def getClusters(self, clusters):
+        return getClusters(clusters, self.verbosityLevel)
+    # multi-clusters from the per-layer clustered hexels (see makePreClusters)
+    def makePreClusters(self, clusters, stats = None):
+        return makePreClusters(clusters, self.multiclusterRadius, self.minClusters, self.realSpaceCone, self.multiclusterPhiWrap, self.verbosityLevel,
+                               self.backend, stats)
@@ -0,0 +1,153 @@
+##############################################################################
+# Compute kernels of the stand-alone HGCalImagingAlgo (sequential steps)
+# each backend implements the same kernels with the same results:
+# "numpy" always, and "numba" (compiled loops) if numba is installed
+# (numba is only imported, and the loops compiled, on first use of its kernels)
+##############################################################################
+import math
+import pkgutil
+import numpy as np
+
+## kernels with NumPy
+
+# nearest higher density hit of each query hit, among its candidates candidates[offsets[i]:offsets[i+1]] (each query has at least one)
+# rank: position of each hit in the order of decreasing density, only candidates of lower rank count as higher
+# among equally distant higher hits the one with the highest rank (lowest density) is taken, as the "<=" in the sequential search did
+# returns the squared distance (inf if no candidate is higher) and the rank (-1 if none) of the nearest higher hit of each query
+def selectNearestHigherNumpy(x, y, rank, query, offsets, candidates):
+    if (len(query) == 0):
+        return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int64)
+    position = np.repeat(np.arange(len(query)), np.diff(offsets))
+    hits = query[position]
+    tmp = np.where(rank[candidates] < rank[hits], pow(x[candidates] - x[hits],2) + pow(y[candidates] - y[hits],2), np.inf)
+    best = np.minimum.reduceat(tmp, offsets[:-1])
+    bestRank = np.maximum.reduceat(np.where(tmp == best[position], rank[candidates], -1), offsets[:-1])
+    return best, np.where(np.isfinite(best), bestRank, -1)
+
+# cluster index of each hit from the first cluster center up its chain of nearestHigher hits (-1 if the chain ends at a top
+# density hit that is not a center), the same as copying it from the nearestHigher hit in order of decreasing density
+# the chains are followed by pointer jumping (each hit jumps to the parent of its parent), in log2 of their length steps
+def propagateClusterIndexNumpy(clusterIndex, nearestHigher):
+    parent = np.where((clusterIndex == -1) & (nearestHigher != -1), nearestHigher, np.arange(len(clusterIndex)))
+    active = np.flatnonzero(parent[parent] != parent) # hits whose parent is not the end of their chain yet
+    while(len(active) > 0):
+        parent[active] = parent[parent[active]]
+        active = active[parent[parent[active]] != parent[active]]
+    return clusterIndex[parent]
+
+# greedy multi-clustering of clusters sorted by decreasing energy: each cluster not used yet takes all unused clusters
+# (after it) of its cone candidates candidates[offsets[i]:offsets[i+1]] closer than radius in (u, v) - unless |z| < 1
+# returns the first (leading) cluster of the multi-cluster of each cluster
+def assignMultiClustersNumpy(u, v, z, offsets, candidates, radius, phiWrap):
+    leader = np.full(len(u), -1, dtype=np.int64)
+    for i in range(0, len(u)):
+        if(leader[i]==-1):
+            leader[i] = i
+            side = 1 if z[i]>0 else -1
+            if(int(z[i]*side)>0):
+                found = candidates[offsets[i]:offsets[i+1]]
+                found = found[(found > i) & (leader[found]==-1)]
+                dv = v[found] - v[i]
+                if phiWrap:
+                    dv = np.where(dv > math.pi, dv - 2*math.pi, np.where(dv < -math.pi, dv + 2*math.pi, dv))
+                leader[found[pow(u[found] - u[i],2) + pow(dv,2) < radius*radius]] = i
+    return leader
+
+# one set of kernels, as used by the clustering
+class Kernels:
+    def __init__(self, name, selectNearestHigher, propagateClusterIndex, assignMultiClusters):
+        self.name = name
+        self.selectNearestHigher = selectNearestHigher
+        self.propagateClusterIndex = propagateClusterIndex
+        self.assignMultiClusters = assignMultiClusters
+
+## kernels compiled with numba (plain loops, the GIL is released so that threads can run them in parallel)
+## the compiled kernels are cached on disk (next to this file), so that new processes (e.g. pool workers) do not compile them again
+
+# nearest higher density hit of each query hit (see selectNearestHigherNumpy)
+def selectNearestHigherLoops(x, y, rank, query, offsets, candidates):
+    best = np.full(len(query), np.inf)
+    bestRank = np.full(len(query), -1, dtype=np.int64)
+    for i in range(len(query)):
+        hit = query[i]
+        for c in range(offsets[i], offsets[i+1]):
+            found = candidates[c]
+            if rank[found] < rank[hit]:
+                dx = x[found] - x[hit]
+                dy = y[found] - y[hit]
+                dist2 = dx*dx + dy*dy
+                if dist2 < best[i] or (dist2 == best[i] and rank[found] > bestRank[i]):
+                    best[i] = dist2
+                    bestRank[i] = rank[found]
+    return best, bestRank
+
+# each chain is followed up to the first hit with a known cluster index, which is then set for the whole chain
+def propagateClusterIndexLoops(clusterIndex, nearestHigher):
+    result = clusterIndex.copy()
+    known = (clusterIndex != -1) | (nearestHigher == -1)
+    for i in range(len(clusterIndex)):
+        j = i
+        while not known[j]:
+            j = nearestHigher[j]
+        value = result[j]
+        j = i
+        while not known[j]:
+            result[j] = value
+            known[j] = True
+            j = nearestHigher[j]
+    return result
+
+# greedy multi-clustering of the clusters sorted by decreasing energy (see assignMultiClustersNumpy)
+def assignMultiClustersLoops(u, v, z, offsets, candidates, radius, phiWrap):
+    leader = np.full(len(u), -1, dtype=np.int64)
+    for i in range(len(u)):
+        if leader[i] != -1:
+            continue
+        leader[i] = i
+        side = 1 if z[i]>0 else -1
+        if int(z[i]*side) <= 0:
+            continue
+        for c in range(offsets[i], offsets[i+1]):
+            found = candidates[c]
+            if found <= i or leader[found] != -1:
+                continue
+            du = u[found] - u[i]
+            dv = v[found] - v[i]
+            if phiWrap:
+                if dv > math.pi:
+                    dv -= 2*math.pi
+                elif dv < -math.pi:
+                    dv += 2*math.pi
+            if du*du + dv*dv < radius*radius:
+                leader[found] = i
+    return leader
+
+# the kernels of each backend
+def makeNumpyKernels():
+    return Kernels("numpy", selectNearestHigherNumpy, propagateClusterIndexNumpy, assignMultiClustersNumpy)
+
+def makeNumbaKernels():
+    import numba # only here, as it takes longer to import than the rest of the clustering
+    compiled = [numba.njit(nogil=True, cache=True)(loops) for loops in (selectNearestHigherLoops, propagateClusterIndexLoops, assignMultiClustersLoops)]
+    return Kernels("numba", *compiled)
+
+# available kernel backends (made on first use by getKernels)
+kernelBackends = {"numpy": makeNumpyKernels}
+if pkgutil.find_loader("numba") is not None:
+    kernelBackends["numba"] = makeNumbaKernels
+loadedKernels = {}
+
+# compiled kernels if available
+defaultBackend = "numba" if "numba" in kernelBackends else "numpy"
+
+# raise a ValueError if the backend is not available
+def checkBackend(backend):
+    if (backend not in kernelBackends):
+        raise ValueError("unknown kernel backend '%s', expected one of %s" % (backend, sorted(kernelBackends.keys())))
+
+# kernels of the given backend
+def getKernels(backend = defaultBackend):
+    if (backend not in loadedKernels):
+        checkBackend(backend)
+        loadedKernels[backend] = kernelBackends[backend]()
+    return loadedKernels[backend]
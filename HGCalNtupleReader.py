@@ -0,0 +1,278 @@
+"""Columnar batch reader for HGCal ntuples (ana/hgc tree).
+
+The events are read in batches of flat NumPy arrays with offsets instead of
+one PyROOT proxy access per hit: in a batch, the rechits of event i are
+rechitOffsets[i]:rechitOffsets[i+1] of the rechit columns, its SimClusters
+simClusterOffsets[i]:simClusterOffsets[i+1] of the SimCluster columns, and
+the hits (detids) of SimCluster j are
+simClusterHitOffsets[j]:simClusterHitOffsets[j+1] of simClusterHits.
+Other collections of the ntuple (e.g. the RECO clusters) can be read along,
+with the same layout (collections, collectionOffsets).
+
+The branches are read with uproot 3 if it is installed, otherwise with
+PyROOT (ROOT is then imported on first use): with TTree::Draw, whole branches
+over the entries of a batch, only the hits of the SimClusters are copied per
+SimCluster. Both check first that the file has all branches read
+(ntupleBranches).
+"""
+import collections
+import logging
+import numpy as np
+try:
+    import uproot3 as uproot
+except ImportError:
+    try:
+        import uproot
+    except ImportError:
+        uproot = None
+if uproot is not None and not uproot.__version__.startswith("3."):
+    uproot = None  # the uproot 3 API (numentries, awkward 0 jagged arrays) is used
+
+
+class NullHandler(logging.Handler):
+    """NullHandler for logging module."""
+
+    def emit(self, record):
+        """emit."""
+        pass
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+# columns read for the rechits (rechits_raw) and the SimClusters (simcluster), with their types
+rechitColumns = ["detid", "layer", "energy", "pt", "eta", "phi", "x", "y", "z"]
+simClusterColumns = ["pt", "eta", "phi", "energy"]
+columnTypes = {"detid": np.int64, "layer": np.int64}  # float64 otherwise
+# branches read from the ntuple: the collections (vectors of structs, split in one branch per member) and their members read
+ntupleBranches = [("rechits_raw", rechitColumns), ("simcluster", simClusterColumns + ["hits"])]
+# events per batch
+batchSize = 100
+# "uproot" (default if it can be imported) or "pyroot"
+readerBackends = ["pyroot"] + (["uproot"] if uproot is not None else [])
+defaultBackend = "uproot" if uproot is not None else "pyroot"
+
+RecHitRecord = collections.namedtuple("RecHitRecord", rechitColumns)
+SimClusterRecord = collections.namedtuple("SimClusterRecord", simClusterColumns + ["hits"])
+
+
+def getOffsets(counts):
+    """Offsets (first and last+1 element of each item) from the counts."""
+    return np.r_[0, np.cumsum(counts)].astype(np.int64)
+
+
+def flattenJagged(array):
+    """Counts and flat content of one level of a jagged array (uproot/awkward, or a sequence of sequences)."""
+    if hasattr(array, "counts"):
+        return np.asarray(array.counts, dtype=np.int64), array.flatten()
+    counts = np.array([len(item) for item in array], dtype=np.int64)
+    items = [np.asarray(item) for item in array if len(item) > 0]
+    return counts, np.concatenate(items) if len(items) > 0 else np.zeros(0)
+
+
+def getBranchNames(collections=ntupleBranches):
+    """names of the branches of (collection, members) pairs, e.g. rechits_raw.detid."""
+    return [collection + "." + member for collection, members in collections for member in members]
+
+
+def getMissingBranches(availableBranches, collections=ntupleBranches):
+    """branches of the collections not in availableBranches (names of the branches of a tree)."""
+    availableBranches = set(availableBranches)
+    return [name for name in getBranchNames(collections) if name not in availableBranches]
+
+
+def checkBranches(fileName, treeName, missingBranches):
+    """raise a KeyError if branches are missing in the tree of a file."""
+    if len(missingBranches) > 0:
+        raise KeyError("branches %s missing in tree %s of %s" % (missingBranches, treeName, fileName))
+
+
+def drawColumns(tree, expressions, nEntries, firstEntry):
+    """values of 1-4 expressions (of one collection) over nEntries entries from firstEntry, one per element (TTree::Draw)."""
+    nRows = tree.Draw(":".join(expressions), "", "goff", nEntries, firstEntry)
+    columns = []
+    for getValues in [tree.GetV1, tree.GetV2, tree.GetV3, tree.GetV4][:len(expressions)]:
+        if nRows <= 0:
+            columns.append(np.zeros(0))
+            continue
+        values = getValues()
+        if hasattr(values, "SetSize"):
+            values.SetSize(nRows)  # PyROOT buffer
+        else:
+            values = values.reshape((nRows,))  # cppyy low level view
+        columns.append(np.frombuffer(values, dtype=np.float64, count=nRows).copy())
+    return columns
+
+
+class EventBatch(object):
+    """Batch of consecutive events (from entry firstEntry on) as flat arrays with offsets."""
+
+    def __init__(self, firstEntry, rechitCounts, rechits, simClusterCounts, simClusters, simClusterHitCounts, simClusterHits, collections=None):
+        """set the columns (dicts of arrays by column name) and the offsets from the counts per event (per SimCluster for the hits).
+
+        collections: other collections, dict of (counts per event, columns) by collection name.
+        """
+        self.firstEntry = firstEntry
+        self.nEvents = len(rechitCounts)
+        self.rechitOffsets = getOffsets(rechitCounts)
+        self.rechits = dict((name, np.asarray(rechits[name], dtype=columnTypes.get(name, np.float64))) for name in rechitColumns)
+        self.simClusterOffsets = getOffsets(simClusterCounts)
+        self.simClusters = dict((name, np.asarray(simClusters[name], dtype=columnTypes.get(name, np.float64))) for name in simClusterColumns)
+        self.simClusterHitOffsets = getOffsets(simClusterHitCounts)
+        self.simClusterHits = np.asarray(simClusterHits, dtype=np.int64)
+        collections = {} if collections is None else collections
+        self.collectionOffsets = dict((collection, getOffsets(counts)) for collection, (counts, columns) in collections.items())
+        self.collections = dict((collection, dict((name, np.asarray(values, dtype=columnTypes.get(name, np.float64))) for name, values in columns.items()))
+                                for collection, (counts, columns) in collections.items())
+
+    def getRecHitSlice(self, event):
+        """rechits of an event (index in the batch) as a slice of the rechit columns."""
+        return slice(self.rechitOffsets[event], self.rechitOffsets[event+1])
+
+    def getSimClusterSlice(self, event):
+        """SimClusters of an event (index in the batch) as a slice of the SimCluster columns."""
+        return slice(self.simClusterOffsets[event], self.simClusterOffsets[event+1])
+
+    def getCollectionSlice(self, collection, event):
+        """elements of an event in one of the other collections as a slice of its columns."""
+        return slice(self.collectionOffsets[collection][event], self.collectionOffsets[collection][event+1])
+
+    def getSimClusterHits(self, event):
+        """hits (detids) of the SimClusters of an event as offsets (from 0) and a view of simClusterHits."""
+        offsets = self.simClusterHitOffsets[self.simClusterOffsets[event]:self.simClusterOffsets[event+1]+1]
+        return offsets - offsets[0], self.simClusterHits[offsets[0]:offsets[-1]]
+
+    def getRecHit(self, index):
+        """rechit at the given index of the rechit columns as a record (with the attributes of the ntuple rechits)."""
+        return RecHitRecord(*[self.rechits[name][index].item() for name in rechitColumns])
+
+    def getRecHits(self, event):
+        """rechits of an event as records."""
+        return [self.getRecHit(index) for index in range(self.rechitOffsets[event], self.rechitOffsets[event+1])]
+
+    def getSimClusters(self, event):
+        """SimClusters of an event as records, with the array of their hits (detids)."""
+        return [SimClusterRecord(*([self.simClusters[name][index].item() for name in simClusterColumns] +
+                                   [self.simClusterHits[self.simClusterHitOffsets[index]:self.simClusterHitOffsets[index+1]]]))
+                for index in range(self.simClusterOffsets[event], self.simClusterOffsets[event+1])]
+
+
+class NtupleReader(object):
+    """Reader of the events of a list of files, a Sample or a TChain, in batches of batchSize events."""
+
+    def __init__(self, source, treeName="ana/hgc", batchSize=batchSize, backend=defaultBackend, extraCollections=[]):
+        """source: list of file names, Sample (SampleHelper) or TChain.
+
+        extraCollections: (collection, members) pairs read in addition to the rechits and SimClusters (see EventBatch.collections).
+        """
+        if backend not in readerBackends:
+            raise ValueError("unknown reader backend '%s', expected one of %s" % (backend, readerBackends))
+        self.treeName = treeName
+        self.batchSize = batchSize
+        self.backend = backend
+        self.extraCollections = list(extraCollections)
+        if hasattr(source, "fileList"):
+            self.fileNames = list(source.fileList)
+        elif hasattr(source, "GetListOfFiles"):
+            self.fileNames = [element.GetTitle() for element in source.GetListOfFiles()]
+        else:
+            self.fileNames = list(source)
+
+    def __iter__(self):
+        """iterate over the batches of all events."""
+        return self.iterBatches()
+
+    def iterBatches(self, maxEvents=-1):
+        """yield the batches of the first maxEvents events (all for -1), entries counted over all files."""
+        readFile = self.readFileUproot if self.backend == "uproot" else self.readFilePyROOT
+        firstEntry = 0
+        for fileName in self.fileNames:
+            logging.debug("iterBatches: reading " + fileName)
+            for batch in readFile(fileName, firstEntry, 0, -1 if maxEvents < 0 else maxEvents - firstEntry):
+                yield batch
+                firstEntry += batch.nEvents
+            if maxEvents >= 0 and firstEntry >= maxEvents:
+                break
+
+    def iterFileBatches(self, fileName, entryStart=0, entryStop=-1):
+        """yield the batches of the entries entryStart to entryStop-1 (to the last for -1) of one file, entries counted in the file."""
+        readFile = self.readFileUproot if self.backend == "uproot" else self.readFilePyROOT
+        return readFile(fileName, 0, entryStart, entryStop)
+
+    def findMissingBranches(self, collections=ntupleBranches):
+        """branches of the collections missing in the tree of at least one of the files."""
+        missingBranches = set()
+        for fileName in self.fileNames:
+            if self.backend == "uproot":
+                missingBranches.update(getMissingBranches(self.getBranchesUproot(uproot.open(fileName)[self.treeName]), collections))
+            else:
+                import ROOT
+                inFile = ROOT.TFile.Open(fileName)
+                tree = inFile.Get(self.treeName)
+                missingBranches.update(name for name in getBranchNames(collections) if not tree.GetBranch(name))
+                inFile.Close()
+        return [name for name in getBranchNames(collections) if name in missingBranches]
+
+    def getBranchesUproot(self, tree):
+        """names of all branches of a tree opened with uproot."""
+        return [name.decode("utf-8") if isinstance(name, bytes) else name for name in tree.allkeys()]
+
+    def readFileUproot(self, fileName, firstEntry, entryStart, entryStop):
+        """batches of the entries entryStart:entryStop of one file (numbered from firstEntry on), read with uproot."""
+        tree = uproot.open(fileName)[self.treeName]
+        checkBranches(fileName, self.treeName, getMissingBranches(self.getBranchesUproot(tree), ntupleBranches + self.extraCollections))
+        nEntries = tree.numentries if entryStop < 0 else min(tree.numentries, entryStop)
+        branches = getBranchNames(ntupleBranches + self.extraCollections)
+        for start in range(entryStart, nEntries, self.batchSize):
+            arrays = tree.arrays(branches, entrystart=start, entrystop=min(start + self.batchSize, nEntries), namedecode="utf-8")
+            rechits = {}
+            for name in rechitColumns:
+                rechitCounts, rechits[name] = flattenJagged(arrays["rechits_raw." + name])
+            simClusters = {}
+            for name in simClusterColumns:
+                simClusterCounts, simClusters[name] = flattenJagged(arrays["simcluster." + name])
+            simClusterHitCounts, simClusterHits = flattenJagged(flattenJagged(arrays["simcluster.hits"])[1])
+            collections = {}
+            for collection, members in self.extraCollections:
+                columns = {}
+                for name in members:
+                    counts, columns[name] = flattenJagged(arrays[collection + "." + name])
+                collections[collection] = (counts, columns)
+            yield EventBatch(firstEntry + start, rechitCounts, rechits, simClusterCounts, simClusters, simClusterHitCounts, simClusterHits, collections)
+
+    def readFilePyROOT(self, fileName, firstEntry, entryStart, entryStop):
+        """batches of the entries entryStart:entryStop of one file (numbered from firstEntry on), read with PyROOT.
+
+        Whole branches are read with TTree::Draw, only the SimCluster hits by looping over the events.
+        """
+        import ROOT
+        inFile = ROOT.TFile.Open(fileName)
+        tree = inFile.Get(self.treeName)
+        collections = [("rechits_raw", rechitColumns), ("simcluster", simClusterColumns)] + self.extraCollections
+        checkBranches(fileName, self.treeName, [name for name in getBranchNames(ntupleBranches + self.extraCollections) if not tree.GetBranch(name)])
+        nEntries = tree.GetEntries() if entryStop < 0 else min(tree.GetEntries(), entryStop)
+        for start in range(entryStart, nEntries, self.batchSize):
+            nBatch = min(self.batchSize, nEntries - start)
+            tree.SetEstimate(nBatch + 1)
+            counts = []
+            for first in range(0, len(collections), 4):
+                counts += drawColumns(tree, ["Length$(%s.%s)" % (collection, names[0]) for collection, names in collections[first:first+4]], nBatch, start)
+            # one value per element (rechit, SimCluster, ...) of the batch, at most 4 columns of a collection per TTree::Draw
+            tree.SetEstimate(int(max([collectionCounts.sum() for collectionCounts in counts] + [nBatch])) + 1)
+            columns = [{} for collection in collections]
+            for (collection, names), collectionColumns in zip(collections, columns):
+                for first in range(0, len(names), 4):
+                    collectionColumns.update(zip(names[first:first+4], drawColumns(tree, [collection + "." + name for name in names[first:first+4]], nBatch, start)))
+            # the hits (a vector per SimCluster), copied per SimCluster with only the simcluster branch read
+            simClusterHitCounts, simClusterHits = [], []
+            tree.SetBranchStatus("*", 0)
+            tree.SetBranchStatus("simcluster*", 1)
+            for entry in range(start, start + nBatch):
+                tree.GetEntry(entry)
+                for simClus in tree.simcluster:
+                    simClusterHits.append(np.fromiter(simClus.hits, dtype=np.int64, count=simClus.hits.size()))
+                    simClusterHitCounts.append(simClus.hits.size())
+            tree.SetBranchStatus("*", 1)
+            yield EventBatch(firstEntry + start, counts[0], columns[0], counts[1], columns[1], simClusterHitCounts,
+                             np.concatenate(simClusterHits) if len(simClusterHits) > 0 else np.zeros(0, dtype=np.int64),
+                             dict((collection, (collectionCounts, collectionColumns))
+                                  for (collection, names), collectionCounts, collectionColumns in zip(collections[2:], counts[2:], columns[2:])))
+        inFile.Close()
@@ -0,0 +1,34 @@
+##############################################################################
+# ROOT adapter of the stand-alone HGCalImagingAlgo: the clustering runs
+# without ROOT (plain arrays and ClusterPoint tuples), this converts its
+# output to ROOT types for the code that needs them (e.g. testClustering)
+##############################################################################
+import ROOT
+import math
+import HGCalImagingAlgo
+
+# position (ClusterPoint, or any object with x, y and z attributes) as ROOT.Math.XYZPoint
+def toXYZPoint(point):
+    return ROOT.Math.XYZPoint(point.x, point.y, point.z)
+
+# position (ClusterPoint) as ROOT.Math.RhoEtaPhiPoint
+def toRhoEtaPhiPoint(point):
+    return ROOT.Math.RhoEtaPhiPoint(math.hypot(point.x, point.y), point.eta, point.phi)
+
+# position of the cluster (BasicCluster) as ROOT.Math.XYZPoint
+def getClusterXYZPoint(cluster):
+    return toXYZPoint(cluster.getPosition())
+
+# histograms of the time and counts per event of each stage (HGCalImagingAlgo.PipelineStats) vs the layer, added to histDict
+def fillStatsHistograms(stats, histDict, tag = "stats_", det_layers = HGCalImagingAlgo.det_layers):
+    for stage in stats.stages:
+        layerRecords = [record for (recordStage, layer), record in stats.records.items() if recordStage == stage and layer is not None]
+        if len(layerRecords) == 0: continue # stage of whole events only
+        names = sorted(set(name for record in layerRecords for name in record["counts"]))
+        for name in ["time"] + names:
+            values = stats.getLayerValues(stage, name, det_layers)/max(stats.nEvents, 1)
+            histName = tag + stage + "_" + name
+            histDict[histName] = ROOT.TH1F(histName, histName + ";layer;" + name + " per event", det_layers, -0.5, det_layers - 0.5)
+            for layer in range(0, det_layers):
+                histDict[histName].SetBinContent(layer + 1, values[layer])
+    return histDict
@@ -0,0 +1,175 @@
+##############################################################################
+# Synthetic HGCal events (stand-alone): electromagnetic showers on top of
+# pileup hits, as flat rechit arrays, to test and benchmark the imaging algo
+# offline (z and X0 of the layers from the geometry file, v33-withBH.txt)
+##############################################################################
+import os
+import math
+import numpy as np
+from scipy import special
+import HGCalHelpers
+import HGCalImagingAlgo
+
+## basic setup of the events
+# geometry file (as for test.py)
+geometryFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "v33-withBH.txt")
+# particles (photons) per event, their energy (GeV) and |eta| range, both endcaps
+nParticles = 1
+particleEnergy = 20.
+particleEtaRange = (1.6, 2.8)
+# pileup: hits per cm2 in each layer (in 1.5 < |eta| < 3.0), with exponential energies of the given mean (GeV)
+pileupDensity = 0.
+pileupEnergy = 0.02
+pileupEtaRange = (1.5, 3.0)
+# longitudinal profile (gamma distribution in X0): critical energy (GeV) and slope b
+criticalEnergy = 0.008
+profileSlope = 0.5
+# lateral profile (core and tail, r^2/(r^2+R^2) each): Moliere radius (cm)
+moliereRadius = 2.5
+# the energy in each layer is spread over spots of about this energy (GeV)
+spotEnergy = 0.005
+# cell pitch (cm) of the hexagonal silicon cells and of the scintillator tiles (from firstBHLayer on)
+cellSize = 1.0
+scintillatorCellSize = 4.0
+# others
+randomSeed = 1234
+
+# rechit with the same attributes as in the ntuple (as used by HGCalImagingAlgo.makeClusters)
+class SyntheticRecHit(object):
+    __slots__ = ("layer", "x", "y", "z", "eta", "phi", "energy", "detid")
+    def __init__(self, layer, x, y, z, eta, phi, energy, detid):
+        self.layer = layer
+        self.x = x
+        self.y = y
+        self.z = z
+        self.eta = eta
+        self.phi = phi
+        self.energy = energy
+        self.detid = detid
+
+# generator of synthetic events, layers numbered as in the ntuple (from 1)
+class EventGenerator:
+    def __init__(self, nParticles = nParticles, particleEnergy = particleEnergy, particleEtaRange = particleEtaRange, pileupDensity = pileupDensity,
+                 pileupEnergy = pileupEnergy, geometryFile = geometryFile, seed = randomSeed):
+        self.nParticles = nParticles
+        self.particleEnergy = particleEnergy
+        self.particleEtaRange = particleEtaRange
+        self.pileupDensity = pileupDensity
+        self.pileupEnergy = pileupEnergy
+        self.rng = np.random.RandomState(seed)
+        # z (cm) and depth (X0 at the end of the absorber before the layer) of each layer
+        geometry = HGCalHelpers.parseGeometry(geometryFile)
+        self.layers = np.array(sorted(geometry.z_abs.keys()), dtype=np.int64)
+        self.z = np.array([geometry.z_abs[layer] for layer in self.layers])/10.
+        self.x0 = np.array([geometry.x0_cumulative[layer] for layer in self.layers])
+        self.cellSize = np.where(self.layers < HGCalImagingAlgo.firstBHLayer, cellSize, scintillatorCellSize)
+        # particles of the events generated last: event, energy, eta and phi
+        self.particleEvent = np.zeros(0, dtype=np.int64)
+        self.particleEnergies = np.zeros(0)
+        self.particleEta = np.zeros(0)
+        self.particlePhi = np.zeros(0)
+
+    # fraction of the energy of a shower of the given energy deposited in each layer, from the gamma profile in X0
+    def getLayerFractions(self, energy):
+        tmax = max(math.log(energy/criticalEnergy) + 0.5, 1.) # photons
+        a = profileSlope*tmax + 1.
+        return np.diff(special.gammainc(a, profileSlope*np.r_[0., self.x0])), tmax
+
+    # energy spots of one shower (energy, and eta and phi of its axis) in all layers: layer index, x, y and energy of each spot
+    def makeShower(self, energy, eta, phi):
+        fractions, tmax = self.getLayerFractions(energy)
+        nSpots = np.maximum(1, self.rng.poisson(fractions*energy/spotEnergy))
+        spotLayer = np.repeat(np.arange(len(self.layers)), nSpots)
+        spotEnergies = (fractions*energy/nSpots)[spotLayer]
+        # radius of the core and of the tail grow with the depth, the core holds less energy later in the shower
+        tau = (self.x0/tmax)[spotLayer]
+        core = self.rng.uniform(size=len(spotLayer)) < np.clip(0.85 - 0.2*tau, 0.3, 0.9)
+        radius = np.where(core, 0.1 + 0.1*tau, 0.6 + 0.4*tau)*moliereRadius
+        u = self.rng.uniform(0., 0.999, len(spotLayer)) # no spots beyond about 30 radii
+        r = radius*np.sqrt(u/(1. - u))
+        angle = self.rng.uniform(-math.pi, math.pi, len(spotLayer))
+        # shower axis from the origin
+        axis = np.abs(self.z[spotLayer])/math.sinh(abs(eta))
+        x = axis*math.cos(phi) + r*np.cos(angle)
+        y = axis*math.sin(phi) + r*np.sin(angle)
+        return spotLayer, x, y, spotEnergies
+
+    # pileup hits in all layers of one endcap: layer index, x, y and energy of each hit
+    def makePileup(self):
+        rMin = self.z/math.sinh(pileupEtaRange[1])
+        rMax = self.z/math.sinh(pileupEtaRange[0])
+        nHits = self.rng.poisson(self.pileupDensity*math.pi*(rMax*rMax - rMin*rMin))
+        hitLayer = np.repeat(np.arange(len(self.layers)), nHits)
+        r = np.sqrt(self.rng.uniform(rMin[hitLayer]*rMin[hitLayer], rMax[hitLayer]*rMax[hitLayer]))
+        angle = self.rng.uniform(-math.pi, math.pi, len(hitLayer))
+        return hitLayer, r*np.cos(angle), r*np.sin(angle), self.rng.exponential(self.pileupEnergy, len(hitLayer))
+
+    # rechits of one event (deposits in the same cell summed), with the layer, x, y, energy, z, eta, phi and detid of each rechit
+    # also returns the energy, eta and phi of its particles
+    def generateEvent(self):
+        deposits = []
+        energies = np.full(self.nParticles, float(self.particleEnergy))
+        side = np.where(self.rng.uniform(size=self.nParticles) < 0.5, -1., 1.)
+        eta = side*self.rng.uniform(self.particleEtaRange[0], self.particleEtaRange[1], self.nParticles)
+        phi = self.rng.uniform(-math.pi, math.pi, self.nParticles)
+        for i in range(0, self.nParticles):
+            deposits.append((eta[i] > 0,) + self.makeShower(energies[i], eta[i], phi[i]))
+        if (self.pileupDensity > 0):
+            for positive in (False, True):
+                deposits.append((positive,) + self.makePileup())
+        if (len(deposits) == 0):
+            return [np.zeros(0, dtype=np.int64)] + [np.zeros(0)]*6 + [np.zeros(0, dtype=np.int64)], (energies, eta, phi)
+
+        # hexagonal cells (rows of cells shifted by half a cell), the detid holds the endcap, layer and cell indices
+        positive = np.concatenate([np.full(len(deposit[1]), deposit[0], dtype=bool) for deposit in deposits])
+        layerIndex = np.concatenate([deposit[1] for deposit in deposits])
+        x = np.concatenate([deposit[2] for deposit in deposits])
+        y = np.concatenate([deposit[3] for deposit in deposits])
+        size = self.cellSize[layerIndex]
+        rowSize = size*math.sqrt(3.)/2.
+        iy = np.round(y/rowSize).astype(np.int64)
+        ix = np.round(x/size - 0.5*(iy & 1)).astype(np.int64)
+        maxCells = 1 << 10 # the detid fits in 32 bits (spots of the far tails beyond maxCells cells are dropped)
+        inside = (np.abs(ix) < maxCells) & (np.abs(iy) < maxCells)
+        cell = ((layerIndex*2 + positive)*2*maxCells + ix + maxCells)*2*maxCells + iy + maxCells
+        detid, inverse = np.unique(cell[inside], return_inverse=True)
+        energy = np.bincount(inverse, weights=np.concatenate([deposit[4] for deposit in deposits])[inside], minlength=len(detid))
+
+        # cell centres
+        iy = detid%(2*maxCells) - maxCells
+        ix = (detid//(2*maxCells))%(2*maxCells) - maxCells
+        layerIndex = detid//(4*maxCells*maxCells)//2
+        positive = (detid//(4*maxCells*maxCells))%2 == 1
+        size = self.cellSize[layerIndex]
+        x = (ix + 0.5*(iy & 1))*size
+        y = iy*size*math.sqrt(3.)/2.
+        z = np.where(positive, self.z[layerIndex], -self.z[layerIndex])
+        r = np.hypot(x, y)
+        return [self.layers[layerIndex], x, y, energy, z, np.arcsinh(z/r), np.arctan2(y, x), detid], (energies, eta, phi)
+
+    # rechits of many events, as flat arrays as taken by HGCalImagingAlgo.makeClustersBatch (see HGCalImagingAlgo.getRecHitArrays)
+    # returns the event offsets, and the layer, x, y, energy, z, eta, phi and detid of all rechits
+    def generateEvents(self, nEvents):
+        events = [self.generateEvent() for event in range(0, nEvents)]
+        eventOffsets = np.r_[0, np.cumsum([len(columns[0]) for columns, particles in events])].astype(np.int64)
+        columns = [np.concatenate([event[0][i] for event in events]) for i in range(0, 8)]
+        self.particleEvent = np.repeat(np.arange(nEvents), self.nParticles)
+        self.particleEnergies, self.particleEta, self.particlePhi = [np.concatenate([event[1][i] for event in events]) for i in range(0, 3)]
+        return [eventOffsets] + columns
+
+# rechit objects of one event from the flat arrays (as taken by HGCalImagingAlgo.makeClusters)
+def getRecHits(eventOffsets, layer, x, y, energy, z, eta, phi, detid, event):
+    return [SyntheticRecHit(int(layer[i]), float(x[i]), float(y[i]), float(z[i]), float(eta[i]), float(phi[i]), float(energy[i]), int(detid[i]))
+            for i in range(eventOffsets[event], eventOffsets[event+1])]
+
+def main():
+    for density in (0., 0.01, 0.05):
+        generator = EventGenerator(pileupDensity = density)
+        recHits = generator.generateEvents(10)
+        eventOffsets, energy = recHits[0], recHits[4]
+        nHits = np.diff(eventOffsets)
+        print "pileup density %.3f/cm2: rechits per event %.0f, above ecut %.0f, energy per event %.2f GeV" % (
+            density, nHits.mean(), np.count_nonzero(energy >= HGCalImagingAlgo.ecut)/10., energy.sum()/10.)
+
+if __name__ == '__main__':
+    main()
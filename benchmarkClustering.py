@@ -0,0 +1,490 @@
+# benchmark the stand-alone imaging algo (HGCalImagingAlgo) on synthetic layers of hexels
+import time
+import os
+import sys
+import json
+import numpy as np
+from scipy import spatial
+import HGCalImagingAlgo
+import HGCalKernels
+import HGCalSynthetic
+from HGCalImagingAlgo import HexelLayer, KDTreeIndex
+
+## basic setup for benchmarking
+# hits per layer to scan
+layerSizes = [1000, 3000, 10000, 30000, 100000]
+# largest layer for which the quadratic reference search is still run
+maxBruteForceSize = 10000
+# layers of a synthetic event with pileup (hits per cm2, random seed) on which the nearest-higher search and the clusters are also checked
+pileupCheckLayers = [17, 24, 29, 33]
+pileupCheckDensity = 0.02
+pileupCheckSeed = 7
+# synthetic layer: fraction of hits in showers (rest is uniform noise), showers per 1k hits, cell size (cm)
+showerFraction = 0.8
+showersPerKHits = 2
+cellSize = 1.0
+# leaf sizes of the per-layer KDTree to compare
+leafSizes = [4, 8, 16, 32, 64, 128, 1000]
+# 2D clusters per event to scan for the multi-clustering
+clusterCounts = [100, 300, 1000, 3000]
+# synthetic events for the stage benchmark: pileup hits per cm2 in each layer (occupancy levels), particles and events per level
+pileupDensities = [0., 0.002, 0.01, 0.05]
+stageParticles = 10
+stageEvents = 5
+# machine-readable results of the stage benchmark, and the earlier results to compare to (if the file exists)
+resultsFileName = "benchmarkClustering.json"
+referenceFileName = "benchmarkClustering_reference.json"
+# workers and types of the persistent layer pools compared to the serial clustering of the layers (makeClusters)
+layerPoolWorkers = 4
+layerPoolTypes = ["threads", "processes"]
+# relative slow-down of a stage that counts as a regression
+timeTolerance = 0.2
+# others
+randomSeed = 1234
+repetitions = 3 # best of
+
+# synthetic layer of hexels: showers with a gaussian lateral profile on top of uniform noise, positions on a grid of cells
+def makeLayer(nHits, seed = randomSeed):
+    rng = np.random.RandomState(seed)
+    nShowerHits = int(nHits*showerFraction)
+    nShowers = max(1, nHits*showersPerKHits//1000)
+    centers = rng.uniform(-120., 120., (nShowers, 2))
+    owner = rng.randint(0, nShowers, nShowerHits)
+    x = np.concatenate((rng.normal(centers[owner,0], 3.), rng.uniform(-150., 150., nHits-nShowerHits)))
+    y = np.concatenate((rng.normal(centers[owner,1], 3.), rng.uniform(-150., 150., nHits-nShowerHits)))
+    x = np.round(x/cellSize)*cellSize
+    y = np.round(y/cellSize)*cellSize
+    weight = np.concatenate((rng.exponential(0.3, nShowerHits), rng.exponential(0.05, nHits-nShowerHits))) + HGCalImagingAlgo.ecut
+    return x, y, weight
+
+# synthetic layer as columnar hexel store, with the local density calculated
+def makeHexelLayer(nHits, seed = randomSeed):
+    x, y, weight = makeLayer(nHits, seed)
+    hexels = HexelLayer()
+    hexels.setColumns(x, y, weight)
+    HGCalImagingAlgo.calculateLocalDensity(hexels, KDTreeIndex(x, y))
+    return hexels
+
+# local density with one query per hit on the pure-python KDTree, as done before the pair query (reference for the comparison)
+def localDensityPerHit(x, y, weight):
+    lp = spatial.KDTree(zip(x, y), leafsize=1000)
+    rho = np.zeros(len(x))
+    for i in range(0, len(x)):
+        found = np.array(lp.query_ball_point([x[i], y[i]], HGCalImagingAlgo.delta_c), dtype=np.int64)
+        dist2 = pow(x[found] - x[i],2) + pow(y[found] - y[i],2)
+        rho[i] = weight[found[dist2 < HGCalImagingAlgo.delta_c*HGCalImagingAlgo.delta_c]].sum()
+    return rho
+
+# quadratic search for the nearest higher hit, as done before the KDTree search (reference for the comparison)
+def nearestHigherBruteForce(x, y, order):
+    nearestHigher = np.full(len(order), -1, dtype=np.int64)
+    dist2 = np.zeros(len(order), dtype=np.float64)
+    xs = x[order]
+    ys = y[order]
+    for oi in range(1, len(order)):
+        tmp = pow(xs[:oi] - xs[oi],2) + pow(ys[:oi] - ys[oi],2)
+        oj = oi - 1 - np.argmin(tmp[::-1]) # last of the equally distant hits
+        nearestHigher[order[oi]] = order[oj]
+        dist2[order[oi]] = tmp[oj]
+    return nearestHigher, dist2
+
+# delta as before the KDTree search: pow(dist2,0.5) per hit, the highest density hit at the largest distance (at least 50) (reference for the comparison)
+def deltaBruteForce(x, y, order, dist2):
+    dist2 = dist2.copy()
+    dist2[order[0]] = max(2500.0, (pow(x - x[order[0]],2) + pow(y - y[order[0]],2)).max())
+    return np.array([pow(d2,0.5) for d2 in dist2])
+
+# synthetic layer of an event with pileup (HGCalSynthetic, both endcaps, above ecut) as columnar hexel store, with the local density calculated
+def makePileupHexelLayer(layer, density = pileupCheckDensity, seed = pileupCheckSeed):
+    generator = HGCalSynthetic.EventGenerator(pileupDensity = density, seed = seed)
+    eventOffsets, layers, x, y, energy = generator.generateEvents(1)[:5]
+    keep = (layers == layer) & (energy >= HGCalImagingAlgo.ecut)
+    hexels = HexelLayer()
+    hexels.setColumns(x[keep], y[keep], energy[keep])
+    HGCalImagingAlgo.calculateLocalDensity(hexels, KDTreeIndex(hexels.x, hexels.y))
+    return hexels
+
+# nearest-higher search of a layer (with the local density) against the quadratic reference, and the clusters found from both
+# returns the time of the tree, of the search and of the reference, and whether nearestHigher, dist2, delta and the cluster index of all hits agree
+def compareNearestHigher(hexels):
+    x, y = hexels.x, hexels.y
+    order = HGCalImagingAlgo.sortedDecreasing(hexels.rho)
+    start = time.time()
+    lp = KDTreeIndex(x, y)
+    tTree = time.time() - start
+    start = time.time()
+    nearestHigher, dist2 = lp.searchNearestHigher(order)
+    tSearch = time.time() - start
+    start = time.time()
+    nearestHigherRef, dist2Ref = nearestHigherBruteForce(x, y, order)
+    tBrute = time.time() - start
+    # the seeds are ordered by decreasing delta, so a delta off by one ulp can already change the cluster numbering
+    maxdensity = HGCalImagingAlgo.calculateDistanceToHigher(hexels, lp)
+    HGCalImagingAlgo.findAndAssignClusters(hexels, lp, maxdensity)
+    delta, clusterIndex = hexels.delta, hexels.clusterIndex
+    hexels.nearestHigher, hexels.delta = nearestHigherRef, deltaBruteForce(x, y, order, dist2Ref)
+    HGCalImagingAlgo.findAndAssignClusters(hexels, lp, maxdensity)
+    same = (np.array_equal(nearestHigher, nearestHigherRef) and np.array_equal(dist2, dist2Ref) and np.array_equal(delta, hexels.delta)
+            and np.array_equal(clusterIndex, hexels.clusterIndex))
+    return tTree, tSearch, tBrute, same
+
+# scaling of the nearest-higher search with the number of hits per layer, then the same check on layers of an event with pileup
+def benchmarkNearestHigher(sizes = layerSizes, pileupLayers = pileupCheckLayers):
+    print "%8s %12s %12s %12s %8s" % ("hits", "tree [s]", "search [s]", "quadr. [s]", "same")
+    for nHits in sizes:
+        hexels = makeHexelLayer(nHits)
+        if (nHits <= maxBruteForceSize):
+            tTree, tSearch, tBrute, same = compareNearestHigher(hexels)
+            print "%8d %12.4f %12.4f %12.4f %8s" % (nHits, tTree, tSearch, tBrute, same)
+            continue
+        order = HGCalImagingAlgo.sortedDecreasing(hexels.rho)
+        start = time.time()
+        lp = KDTreeIndex(hexels.x, hexels.y)
+        tTree = time.time() - start
+        start = time.time()
+        lp.searchNearestHigher(order)
+        tSearch = time.time() - start
+        print "%8d %12.4f %12.4f %12.4f %8s" % (nHits, tTree, tSearch, float('nan'), "-")
+    print "%8s %8s %12s %12s %12s %8s" % ("layer", "hits", "tree [s]", "search [s]", "quadr. [s]", "same")
+    for layer in pileupLayers:
+        hexels = makePileupHexelLayer(layer)
+        tTree, tSearch, tBrute, same = compareNearestHigher(hexels)
+        print "%8d %8d %12.4f %12.4f %12.4f %8s" % (layer, len(hexels), tTree, tSearch, tBrute, same)
+
+# scaling of the local density calculation with the number of hits per layer
+def benchmarkLocalDensity(sizes = layerSizes):
+    print "%8s %12s %12s %12s %8s" % ("hits", "tree [s]", "pairs [s]", "per hit [s]", "same")
+    for nHits in sizes:
+        x, y, weight = makeLayer(nHits)
+        hexels = HexelLayer()
+        hexels.setColumns(x, y, weight)
+        start = time.time()
+        lp = KDTreeIndex(x, y)
+        tTree = time.time() - start
+        start = time.time()
+        HGCalImagingAlgo.calculateLocalDensity(hexels, lp)
+        tPairs = time.time() - start
+        tPerHit = float('nan')
+        same = "-"
+        if (nHits <= maxBruteForceSize):
+            start = time.time()
+            rhoRef = localDensityPerHit(x, y, weight)
+            tPerHit = time.time() - start
+            same = str(np.allclose(hexels.rho, rhoRef, rtol=1e-12, atol=0.))
+        print "%8d %12.4f %12.4f %12.4f %8s" % (nHits, tTree, tPairs, tPerHit, same)
+
+# time of the shared per-layer index (build, neighbour pairs and nearest-higher search) versus the KDTree leaf size
+def benchmarkLeafSize(sizes = layerSizes, leafSizes = leafSizes):
+    print "%8s %8s %12s %12s %12s %12s" % ("hits", "leafsize", "tree [s]", "pairs [s]", "search [s]", "total [s]")
+    for nHits in sizes:
+        hexels = makeHexelLayer(nHits)
+        order = HGCalImagingAlgo.sortedDecreasing(hexels.rho)
+        for leafsize in leafSizes:
+            best = None
+            for repetition in range(0, repetitions):
+                start = time.time()
+                lp = KDTreeIndex(hexels.x, hexels.y, leafsize = leafsize)
+                tTree = time.time() - start
+                start = time.time()
+                lp.getNeighbourPairs(HGCalImagingAlgo.delta_c)
+                tPairs = time.time() - start
+                start = time.time()
+                lp.searchNearestHigher(order)
+                tSearch = time.time() - start
+                if (best is None or tTree + tPairs + tSearch < sum(best)):
+                    best = (tTree, tPairs, tSearch)
+            print "%8d %8d %12.4f %12.4f %12.4f %12.4f" % (nHits, leafsize, best[0], best[1], best[2], sum(best))
+
+# spatial index backends (KDTree and tiles) versus the occupancy (hits in the same area of the layer)
+def benchmarkSpatialIndex(sizes = layerSizes, backends = sorted(HGCalImagingAlgo.spatialIndexTypes.keys())):
+    print "%8s %12s %10s %12s %12s %12s %12s %8s" % ("hits", "hits/cm2", "index", "build [s]", "pairs [s]", "search [s]", "total [s]", "same")
+    for nHits in sizes:
+        hexels = makeHexelLayer(nHits)
+        order = HGCalImagingAlgo.sortedDecreasing(hexels.rho)
+        results = []
+        for backend in backends:
+            best = None
+            for repetition in range(0, repetitions):
+                start = time.time()
+                lp = HGCalImagingAlgo.spatialIndexTypes[backend](hexels.x, hexels.y)
+                tBuild = time.time() - start
+                start = time.time()
+                pairs = lp.getNeighbourPairs(HGCalImagingAlgo.delta_c)
+                tPairs = time.time() - start
+                start = time.time()
+                nearestHigher = lp.searchNearestHigher(order)
+                tSearch = time.time() - start
+                if (best is None or tBuild + tPairs + tSearch < sum(best)):
+                    best = (tBuild, tPairs, tSearch)
+            # same pairs (in any order) and same nearest higher hits as the first backend
+            pairs = np.sort(pairs[0]*nHits + pairs[1])
+            results.append((pairs, nearestHigher))
+            same = np.array_equal(results[0][0], pairs) and np.array_equal(results[0][1][0], nearestHigher[0]) and np.array_equal(results[0][1][1], nearestHigher[1])
+            print "%8d %12.3f %10s %12.4f %12.4f %12.4f %12.4f %8s" % (nHits, nHits/(300.*300.), backend, best[0], best[1], best[2], sum(best), same)
+
+# cluster assignment by copying the cluster index from the nearest higher hit in order of decreasing density (reference for the comparison)
+def assignSequential(clusterIndex, nearestHigher, order):
+    clusterIndex = clusterIndex.copy()
+    for i in order:
+        if(clusterIndex[i] == -1 and nearestHigher[i] != -1):
+            clusterIndex[i] = clusterIndex[nearestHigher[i]]
+    return clusterIndex
+
+# time of the cluster assignment by pointer jumping versus the sequential loop over the hits
+def benchmarkAssignment(sizes = layerSizes):
+    print "%8s %10s %12s %12s %8s" % ("hits", "clusters", "jumping [s]", "loop [s]", "same")
+    for nHits in sizes:
+        x, y, weight = makeLayer(nHits)
+        hexels = HexelLayer()
+        hexels.setColumns(x, y, weight)
+        HGCalImagingAlgo.clusterLayer(hexels)
+        # cluster index of the cluster centers only (as before the assignment)
+        isCenter = (hexels.delta >= HGCalImagingAlgo.delta_c) & ~(hexels.rho < hexels.rho.max()/HGCalImagingAlgo.kappa)
+        centers = np.where(isCenter, hexels.clusterIndex, -1)
+        start = time.time()
+        clusterIndex = HGCalImagingAlgo.propagateClusterIndex(centers, hexels.nearestHigher)
+        tJumping = time.time() - start
+        start = time.time()
+        clusterIndexRef = assignSequential(centers, hexels.nearestHigher, HGCalImagingAlgo.sortedDecreasing(hexels.rho))
+        tLoop = time.time() - start
+        print "%8d %10d %12.4f %12.4f %8s" % (nHits, hexels.nClusters, tJumping, tLoop, np.array_equal(clusterIndex, clusterIndexRef))
+
+# border hits and border density with one neighbour query per hit, as done before the pair list (reference for the comparison)
+def borderPerHit(hexels, lp):
+    rho_b = np.zeros(hexels.nClusters)
+    isBorder = np.zeros(len(hexels), dtype=bool)
+    for i in range(0, len(hexels)):
+        ci = hexels.clusterIndex[i]
+        if(ci != -1):
+            found = lp.queryHit(i, HGCalImagingAlgo.delta_c)
+            found = found[hexels.clusterIndex[found] != -1]
+            dist2 = pow(hexels.x[found] - hexels.x[i],2) + pow(hexels.y[found] - hexels.y[i],2)
+            close = dist2 < HGCalImagingAlgo.delta_c*HGCalImagingAlgo.delta_c
+            if(np.any(close & (hexels.clusterIndex[found] != ci)) or not np.any(close & (dist2 != 0.))):
+                isBorder[i] = True
+                rho_b[ci] = max(rho_b[ci], hexels.rho[i])
+    return isBorder, rho_b
+
+# time of the border/halo stage (pair list, with and without halo exclusion) versus one query per hit
+def benchmarkBorder(sizes = layerSizes):
+    print "%8s %10s %12s %12s %12s %8s %8s" % ("hits", "clusters", "pairs [s]", "+halo [s]", "per hit [s]", "halo", "same")
+    for nHits in sizes:
+        x, y, weight = makeLayer(nHits)
+        hexels = HexelLayer()
+        hexels.setColumns(x, y, weight)
+        HGCalImagingAlgo.clusterLayer(hexels)
+        lp = KDTreeIndex(x, y)
+        lp.getNeighbourPairs(HGCalImagingAlgo.delta_c) # shared with the local density, not counted here
+        times = []
+        for halo in (False, True):
+            hexels.isBorder[:] = False
+            start = time.time()
+            rho_b = HGCalImagingAlgo.findBorderAndHalo(hexels, lp, haloExclusion = halo)
+            times.append(time.time() - start)
+        tPerHit = float('nan')
+        same = "-"
+        if (nHits <= maxBruteForceSize):
+            start = time.time()
+            isBorderRef, rho_bRef = borderPerHit(hexels, lp)
+            tPerHit = time.time() - start
+            same = str(np.array_equal(hexels.isBorder, isBorderRef) and np.array_equal(rho_b, rho_bRef))
+        print "%8d %10d %12.4f %12.4f %12.4f %8d %8s" % (nHits, hexels.nClusters, times[0], times[1], tPerHit, hexels.isHalo.sum(), same)
+
+# greedy multi-clustering as the loop over all pairs of 2D clusters, before the cone search (reference for the comparison)
+def multiClustersPairLoop(eta, phi, z, energy, radius):
+    es = HGCalImagingAlgo.sortedDecreasing(energy)
+    vused = [0.]*len(es)
+    multiClusters = []
+    for i in range(0, len(es)):
+        if(vused[i]==0):
+            temp = [es[i]]
+            vused[i] = 1 if z[es[i]] > 0 else -1
+            for j in range(i+1, len(es)):
+                if(vused[j]==0 and pow(eta[es[j]] - eta[es[i]],2) + pow(phi[es[j]] - phi[es[i]],2) < radius*radius and int(z[es[i]]*vused[i])>0):
+                    temp.append(es[j])
+                    vused[j] = vused[i]
+            multiClusters.append(temp)
+    return multiClusters
+
+# synthetic 2D clusters of one event: clusters of the showers spread over the layers, returns their eta, phi, z and energy
+def makeClusterPositions(nClusters, rng):
+    nShowers = max(1, nClusters//20)
+    owner = rng.randint(0, nShowers, nClusters)
+    side = np.where(rng.uniform(size=nShowers) < 0.5, -1., 1.)[owner]
+    eta = side*rng.uniform(1.6, 2.8, nShowers)[owner] + rng.normal(0., 0.01, nClusters)
+    phi = rng.uniform(-np.pi, np.pi, nShowers)[owner] + rng.normal(0., 0.01, nClusters)
+    z = side*rng.uniform(320., 400., nClusters)
+    energy = rng.exponential(1., nClusters)
+    return eta, phi, z, energy
+
+# scaling of the multi-clustering with the number of 2D clusters per event
+def benchmarkMultiClusters(counts = clusterCounts):
+    print "%8s %12s %12s %8s" % ("clusters", "cone [s]", "pairs [s]", "same")
+    rng = np.random.RandomState(randomSeed)
+    for nClusters in counts:
+        eta, phi, z, energy = makeClusterPositions(nClusters, rng)
+        start = time.time()
+        multiClusters = HGCalImagingAlgo.findMultiClusters(eta, phi, z, energy, HGCalImagingAlgo.multiclusterRadius)
+        tCone = time.time() - start
+        start = time.time()
+        multiClustersRef = multiClustersPairLoop(eta, phi, z, energy, HGCalImagingAlgo.multiclusterRadius)
+        tPairs = time.time() - start
+        same = [list(members) for members in multiClusters] == multiClustersRef
+        print "%8d %12.4f %12.4f %8s" % (nClusters, tCone, tPairs, same)
+
+# time of the steps with a kernel of HGCalKernels (nearest higher, assignment, multi-clustering) for each kernel backend
+# the multi-clustering is timed for one 2D cluster per ten hits, the first call of each backend is not timed (compilation of the numba kernels)
+def benchmarkKernelBackends(sizes = layerSizes, backends = sorted(HGCalKernels.kernelBackends.keys())):
+    print "%8s %10s %10s %12s %12s %12s %8s" % ("hits", "clusters", "backend", "nearest [s]", "assign [s]", "multi [s]", "same")
+    rng = np.random.RandomState(randomSeed)
+    for nHits in sizes:
+        nClusters = nHits//10
+        hexels = makeHexelLayer(nHits)
+        order = HGCalImagingAlgo.sortedDecreasing(hexels.rho)
+        HGCalImagingAlgo.clusterLayer(hexels)
+        centers = np.where((hexels.delta >= HGCalImagingAlgo.delta_c) & ~(hexels.rho < hexels.rho.max()/HGCalImagingAlgo.kappa), hexels.clusterIndex, -1)
+        eta, phi, z, energy = makeClusterPositions(nClusters, rng)
+        results = []
+        for backend in backends:
+            lp = KDTreeIndex(hexels.x, hexels.y, backend = backend)
+            steps = [lambda: lp.searchNearestHigher(order),
+                     lambda: HGCalImagingAlgo.propagateClusterIndex(centers, hexels.nearestHigher, backend),
+                     lambda: HGCalImagingAlgo.findMultiClusters(eta, phi, z, energy, HGCalImagingAlgo.multiclusterRadius, backend = backend)]
+            best = []
+            result = [step() for step in steps]
+            for step in steps:
+                times = []
+                for i in range(repetitions):
+                    start = time.time()
+                    step()
+                    times.append(time.time() - start)
+                best.append(min(times))
+            results.append(result)
+            same = (np.array_equal(result[0][0], results[0][0][0]) and np.array_equal(result[0][1], results[0][0][1]) and
+                    np.array_equal(result[1], results[0][1]) and [list(m) for m in result[2]] == [list(m) for m in results[0][2]])
+            print "%8d %10d %10s %12.4f %12.4f %12.4f %8s" % (nHits, nClusters, backend, best[0], best[1], best[2], same)
+
+# time of each clustering stage and of the multi-clustering on synthetic events (HGCalSynthetic) at several occupancy levels
+# all events of a level are clustered as one batch (makeClustersBatch), best of repetitions for each stage
+# returns one row per level with the times and the numbers of hits, clusters and multi-clusters per event
+def benchmarkStages(densities = pileupDensities, nParticles = stageParticles, nEvents = stageEvents, spatialIndex = HGCalImagingAlgo.spatialIndex,
+                    backend = HGCalImagingAlgo.kernelBackend):
+    stages = ["hexels", "index", "density", "nearestHigher", "assignment", "positions", "multiClusters"]
+    print "%8s %10s %10s %8s" % ("pileup", "hits/ev", "2D/ev", "multi/ev") + "".join(" %13s" % (stage + " [s]") for stage in stages)
+    rows = []
+    for density in densities:
+        generator = HGCalSynthetic.EventGenerator(nParticles = nParticles, pileupDensity = density, seed = randomSeed)
+        recHits = generator.generateEvents(nEvents)
+        times = dict((stage, []) for stage in stages)
+        for i in range(repetitions):
+            start = time.time()
+            hexels, groupEvent, groupLayer, nEvents = HGCalImagingAlgo.makeHexelBatch(*recHits)
+            times["hexels"].append(time.time() - start)
+            start = time.time()
+            lp = HGCalImagingAlgo.makeSpatialIndex(hexels, spatialIndex, backend = backend)
+            times["index"].append(time.time() - start)
+            start = time.time()
+            maxdensity = HGCalImagingAlgo.calculateLocalDensity(hexels, lp)
+            times["density"].append(time.time() - start)
+            start = time.time()
+            HGCalImagingAlgo.calculateDistanceToHigher(hexels, lp)
+            times["nearestHigher"].append(time.time() - start)
+            start = time.time()
+            HGCalImagingAlgo.findAndAssignClusters(hexels, lp, maxdensity)
+            times["assignment"].append(time.time() - start)
+            start = time.time()
+            batch = HGCalImagingAlgo.ClusterBatch(hexels, groupEvent, groupLayer, nEvents)
+            times["positions"].append(time.time() - start)
+            start = time.time()
+            clusters = batch.clusters
+            nMultiClusters = 0
+            for event in range(0, nEvents):
+                first, last = batch.eventClusterOffsets[event], batch.eventClusterOffsets[event+1]
+                multiClusters = HGCalImagingAlgo.findMultiClusters(clusters.eta[first:last], clusters.phi[first:last], clusters.z[first:last],
+                                                                   clusters.energy[first:last], HGCalImagingAlgo.multiclusterRadius, backend = backend)
+                nMultiClusters += len([members for members in multiClusters if len(members) > HGCalImagingAlgo.minClusters])
+            times["multiClusters"].append(time.time() - start)
+        row = {"pileupDensity": density, "particles": nParticles, "events": nEvents, "hits": len(hexels)/float(nEvents),
+               "clusters": len(clusters)/float(nEvents), "multiClusters": nMultiClusters/float(nEvents),
+               "times": dict((stage, min(times[stage])) for stage in stages)}
+        rows.append(row)
+        print "%8.3f %10.1f %10.1f %8.1f" % (density, row["hits"], row["clusters"], row["multiClusters"]) + "".join(" %13.4f" % row["times"][stage] for stage in stages)
+    return rows
+
+# time per event of makeClusters with the layers clustered serially and in persistent, warmed-up pools (made once by makeLayerPool)
+# on synthetic events at several occupancy levels: the speed-up of a pool type is its time relative to the serial clustering,
+# the pileup density at which it is above 1 is the occupancy from which the parallel clustering pays off on this machine
+def benchmarkLayerPool(densities = pileupDensities, nParticles = stageParticles, nEvents = stageEvents, nWorkers = layerPoolWorkers,
+                       poolTypes = layerPoolTypes):
+    print "%8s %10s %10s %12s" % ("pileup", "hits/ev", "workers", "serial [s]") + "".join(" %13s %8s %8s" % (poolType + " [s]", "speed-up", "same") for poolType in poolTypes)
+    pools = dict((poolType, HGCalImagingAlgo.makeLayerPool(nWorkers, poolType)) for poolType in poolTypes)
+    HGCalImagingAlgo.warmLayerWorker()
+    for density in densities:
+        generator = HGCalSynthetic.EventGenerator(nParticles = nParticles, pileupDensity = density, seed = randomSeed)
+        recHits = generator.generateEvents(nEvents)
+        events = [HGCalSynthetic.getRecHits(*(recHits + [event])) for event in range(0, nEvents)]
+        results = {}
+        times = {}
+        for poolType in [None] + poolTypes:
+            best = None
+            for repetition in range(0, repetitions):
+                start = time.time()
+                clusters = [HGCalImagingAlgo.makeClusters(rHits, pool = None if poolType is None else pools[poolType]) for rHits in events]
+                elapsed = (time.time() - start)/nEvents
+                best = elapsed if best is None else min(best, elapsed)
+            times[poolType] = best
+            results[poolType] = [[hexels.clusterIndex for hexels in layers] for layers in clusters]
+        line = "%8.3f %10.1f %10d %12.4f" % (density, len(recHits[1])/float(nEvents), nWorkers, times[None])
+        for poolType in poolTypes:
+            same = all(np.array_equal(a, b) for eventA, eventB in zip(results[None], results[poolType]) for a, b in zip(eventA, eventB))
+            line += " %13.4f %8.2f %8s" % (times[poolType], times[None]/times[poolType], same)
+        print line
+    for pool in pools.values():
+        pool.close()
+        pool.join()
+
+# write the rows of the stage benchmark to a JSON file, with the setup they were made with
+def saveStageResults(rows, fileName = resultsFileName, spatialIndex = HGCalImagingAlgo.spatialIndex, backend = HGCalImagingAlgo.kernelBackend):
+    setup = {"spatialIndex": spatialIndex, "backend": backend, "repetitions": repetitions, "randomSeed": randomSeed,
+             "python": sys.version.split()[0], "numpy": np.__version__, "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open(fileName, "w") as f:
+        json.dump({"setup": setup, "results": rows}, f, indent = 1, sort_keys = True)
+    print "results written to ", fileName
+
+# compare the rows of the stage benchmark to earlier ones (e.g. read from a results file): stages slower by more than
+# the tolerance, and changed numbers of hits, clusters or multi-clusters (the events are the same for the same seed)
+# returns the list of regressions found
+def compareStageResults(rows, referenceRows, tolerance = timeTolerance):
+    regressions = []
+    reference = dict((row["pileupDensity"], row) for row in referenceRows)
+    for row in rows:
+        if row["pileupDensity"] not in reference: continue
+        ref = reference[row["pileupDensity"]]
+        for name in ("hits", "clusters", "multiClusters"):
+            if (row[name] != ref[name]):
+                regressions.append("pileup %.3f: %s per event %.1f, was %.1f" % (row["pileupDensity"], name, row[name], ref[name]))
+        for stage in sorted(row["times"].keys()):
+            if (stage in ref["times"] and row["times"][stage] > ref["times"][stage]*(1. + tolerance)):
+                regressions.append("pileup %.3f: %s %.4f s, was %.4f s" % (row["pileupDensity"], stage, row["times"][stage], ref["times"][stage]))
+    for regression in regressions:
+        print "REGRESSION ", regression
+    return regressions
+
+def main():
+    benchmarkSpatialIndex()
+    benchmarkLeafSize()
+    benchmarkLocalDensity()
+    benchmarkNearestHigher()
+    benchmarkAssignment()
+    benchmarkBorder()
+    benchmarkMultiClusters()
+    benchmarkKernelBackends()
+    benchmarkLayerPool()
+    rows = benchmarkStages()
+    saveStageResults(rows)
+    if (os.path.exists(referenceFileName)):
+        with open(referenceFileName) as f:
+            compareStageResults(rows, json.load(f)["results"])
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,25 @@ import ROOT
 import logging
 import numpy as np
 import HGCalHelpers
+import HGCalNtupleReader
 from multiprocessing import Process
 import copy
 import optparse
 import math
 import os
 
+# radii (mm) of the radial energy profiles around the reference points
+radialProfileRadii = np.arange(1., 501., 5.)
+# energy fractions of the containment radii (radius_events_eFrac histograms)
+containmentFractions = np.arange(0.5, 1.01, 0.05)
+# reference points of the radial profiles, and detectors
+lateralReferences = ["RecHitsClusMaxLayer", "RecHitsClusFirstLayer", "SimCluster"]
+detectors = ["EE", "FH", "BH", "FH+BH", "all"]
+# per selected SimCluster: event, index and energy of the SimCluster, RecHit cluster energy per detector, radial profiles
+# and containment radii per reference point and detector (see saveRadialProfiles)
+radialProfileKeys = ["event", "simCluster", "simClusterEnergy", "recHitsClusEnergy", "energyRadius", "SimVsRecHits_containment",
+                     "RecHitsClusVsRecHits_containment"]
+
 
 class RecHit(object):
     """RecHit class for easier RecHit handling."""
@@ -37,33 +50,6 @@ class RecHitCollection(object):
         self.rechits.append(rechit)
 
 
-def getRecHitDetIds(rechits):
-    """Get a numpy array of RecHits."""
-    recHitsList = []
-    for rHit in rechits:
-        recHitsList.append(rHit.detid)
-    # print "RecHits -"*10
-    # print recHitsList
-    recHits = np.array(recHitsList)
-    return recHits
-
-
-def getHitList(simClus, recHitDetIds):
-    """Get list indices from recHitDetIds."""
-    sClusHitsList = []
-    for DetId in simClus.hits:
-        sClusHitsList.append(DetId)
-    # print sClusHitsList
-    sClusHits = np.array(sClusHitsList)
-    # thanks to http://stackoverflow.com/questions/11483863/python-intersection-indices-numpy-array
-    recHitIndices = np.nonzero(np.in1d(recHitDetIds, sClusHits))
-    # print "indices - "*10
-    # print recHitIndices
-    # if (len(recHitIndices[0]) != len(sClusHitsList)):
-    #     print "Mismatch:", len(recHitIndices[0]), len(sClusHits)
-    return recHitIndices
-
-
 def getXYWeighted(rechits, layer):
     """return energy-weighted x-y position."""
     sumE = 0
@@ -89,7 +75,6 @@ def getHists():
     histDict = {}
     histDict["selectedEvents"] = ROOT.TH1F("selectedEvents", "selectedEvents", 1, 0.5, 1.5)
     clusters = ["SimClus", "PFClus", "GenPart", "RecHits", "RecHitsClus"]
-    detectors = ["EE", "FH", "BH", "FH+BH", "all"]
     for clus in clusters:
 
         histDict["%s_energy" % clus] = ROOT.TH1F("%s_energy" % clus, "%s_energy;E [GeV]" % clus, 200, 0, 100)
@@ -202,7 +187,6 @@ def getHists():
                     histDict["%s_frac_energy_%s_%s_fracEvents_1D" % (comp, detect, etaR)] = ROOT.TH1F("%s_frac_energy_%s_%s_fracEvents_1D" % (comp, detect, etaR), "%s_frac_energy_%s_%s_fracEvents_1D;E fraction %s;fraction of events" % (comp, detect, etaR, detect), 100, 0, 0.5)
                     histDict["%s_frac_energy_%s_%s_fracEvents_1D_cumulative" % (comp, detect, etaR)] = ROOT.TH1F("%s_frac_energy_%s_%s_fracEvents_1D_cumulative" % (comp, detect, etaR), "%s_frac_energy_%s_%s_fracEvents_1D_cumulative;E fraction %s;cumulative fraction of events" % (comp, detect, etaR, detect), 100, 0, 0.5)
 
-    lateralReferences = ["RecHitsClusMaxLayer", "RecHitsClusFirstLayer", "SimCluster"]
     for refKey in lateralReferences:
         for detect in detectors:
             histDict["SimVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect)] = ROOT.TH1F("SimVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect), "SimVsRecHits_radius_frac_energy_%s_%s;radius [mm];E fraction (%s)" % (refKey, detect, detect), 100, -2.5, 497.5)
@@ -210,15 +194,16 @@ def getHists():
             histDict["RecHitsClusVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect)] = ROOT.TH1F("RecHitsClusVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect), "RecHitsClusVsRecHits_radius_frac_energy_%s_%s;radius [mm];E fraction rel. to %s (%s)" % (refKey, detect, refKey, detect), 100, -2.5, 497.5)
             histDict["RecHitsClusVsRecHits_radius_energy_%s_%s" % (refKey, detect)] = ROOT.TH1F("RecHitsClusVsRecHits_radius_energy_%s_%s" % (refKey, detect), "RecHitsClusVsRecHits_radius_energy_%s_%s;radius [mm];E not rel. to %s (%s)" % (refKey, detect, refKey, detect), 100, -2.5, 497.5)
             histDict["RecHitsClusVsRecHits_total_energy_%s_%s" % (refKey, detect)] = ROOT.TH1F("RecHitsClusVsRecHits_total_energy_%s_%s" % (refKey, detect), "RecHitsClusVsRecHits_total_energy_%s_%s;radius [mm];E total %s (%s)" % (refKey, detect, refKey, detect), 100, -2.5, 497.5)
-            for eFrac in np.arange(0.5, 1.01, 0.05):
+            for eFrac in containmentFractions:
                 histDict["SimVsRecHits_radius_events_eFrac%d_%s_%s" % (eFrac*100, refKey, detect)] = ROOT.TH1F("SimVsRecHits_radius_events_eFrac%d_%s_%s" % (eFrac*100, refKey, detect), "SimVsRecHits_radius_events_eFrac%d_%s_%s;radius [mm];events (%s)" % (eFrac*100, refKey, detect, detect), 100, -2.5, 497.5)
                 histDict["RecHitsClusVsRecHits_radius_events_eFrac%d_%s_%s" % (eFrac*100, refKey, detect)] = ROOT.TH1F("RecHitsClusVsRecHits_radius_events_eFrac%d_%s_%s" % (eFrac*100, refKey, detect), "RecHitsClusVsRecHits_radius_events_eFrac%d_%s_%s;radius [mm];events (%s)" % (eFrac*100, refKey, detect, detect), 100, -2.5, 497.5)
 
     return histDict
 
 
-def processSample(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClusECut, imgType, logger, geometry, rootOnly=False):
-    """process a single sample."""
+def processSample(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClusECut, imgType, logger, geometry, rootOnly=False,
+                  batchSize=HGCalNtupleReader.batchSize):
+    """process a single sample, reading the events of the chain in batches of flat arrays."""
     HGCalHelpers.createOutputDir(outDir)
     histDict = getHists()
     canvas = None
@@ -228,83 +213,88 @@ def processSample(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClu
     sampleEvents = chain.GetEntries()
     logger.info("Events: %d" % sampleEvents)
 
-    # start event loop
+    # start event loop (events 0 to nEvents, all for nEvents <= 0)
     selectedEvents = 0
-    for currentEvent, event in enumerate(chain):
-        if (currentEvent % 100 == 0):
-            logger.info("Event {} of {}".format(currentEvent, sampleEvents))
-
-        # associate RecHits to SimClusters
-        simClusHitAssoc = []
-        recHitDetIds = getRecHitDetIds(event.rechits_raw)
-        for simClusIndex, simClus in enumerate(event.simcluster):
-            # print ("SimClus %d - "%simClusIndex)*10
-            simClusHitAssoc.append(getHitList(simClus, recHitDetIds))
-
-        # get generator particles applying conversion cut
-        # vGenParticleTLV = HGCalHelpers.getGenParticles(event, histDict, dvzCut)
-
-        # keep track of SimClusters that are in the same hemisphere as the selected GenParticles
-        # matchesGen = [False]*len(event.simcluster)
-
-        # simClusIndex = 0
-        # for simCl, pfCl in zip(event.simcluster, event.pfcluster):
-        #     # logging.info("{} {}".format(simCl.pt, pfCl.pt))
-        #     for genPartIndex, genPart in enumerate(vGenParticleTLV):
-        #         # if deltaR2(genPart, simCl) < loose_dRCut:
-        #         if genPart.Eta()*simCl.eta > 0:
-        #             matchesGen[simClusIndex] = True
-        #             histDict["SimVsPF_delta_energy"].Fill(simCl.energy-pfCl.energy)
-        #             histDict["SimVsPF_delta_pt"].Fill(simCl.pt-pfCl.pt)
-        #             histDict["SimVsPF_deltaover_energy"].Fill((simCl.energy-pfCl.energy)/simCl.energy)
-        #             histDict["SimVsPF_deltaover_pt"].Fill((simCl.pt-pfCl.pt)/simCl.pt)
-        #             histDict["SimVsPF_delta_eta"].Fill(simCl.eta-pfCl.eta)
-        #             histDict["SimVsPF_delta_phi"].Fill(simCl.phi-pfCl.phi)
-        #             histDict["SimVsPF_delta_R"].Fill(HGCalHelpers.deltaR(simCl, pfCl))
-        #             break
-        #     simClusIndex += 1
-
-        # use the SimClusters that "match" the GenParticles and study associated RecHits
-        detectors = ["EE", "FH", "BH", "FH+BH", "all"]
-        for simClusIndex, simCl in enumerate(event.simcluster):
-            simClTLV = ROOT.TLorentzVector()
-            simClTLV.SetPtEtaPhiE(simCl.pt, simCl.eta, simCl.phi, simCl.energy)
-            histDict["SimClus_energy"].Fill(simCl.energy)
-            histDict["SimClus_pt"].Fill(simCl.pt)
-            histDict["SimClus_eta"].Fill(simCl.eta)
-            histDict["SimClus_phi"].Fill(simCl.phi)
-            # if (matchesGen[simClusIndex]):
-            if (simCl.energy >= simClusECut) and not ((abs(simCl.eta) < 1.7) or (abs(simCl.eta) > 2.7)):
-                histDict["SimClus_energy_pass"].Fill(simCl.energy)
-                histDict["SimClus_pt_pass"].Fill(simCl.pt)
-                histDict["SimClus_eta_pass"].Fill(simCl.eta)
-                histDict["SimClus_phi_pass"].Fill(simCl.phi)
-                recHitVectors = {}
-                recHitVectorsLayer = {}
-                recHitEsum_plain = {}
-                for detect in detectors:
-                    recHitVectors[detect] = ROOT.TLorentzVector()
-                    recHitEsum_plain[detect] = 0
-                for layer in range(1, maxLayer):
-                    recHitVectorsLayer[layer] = ROOT.TLorentzVector()
-                    recHitEsum_plain[layer] = 0
-                    # recHitEsumLayerCumulative[layer] = 0
-                allRecHits = []
-                # print "loop hits"
-                for hitIndexArray in simClusHitAssoc[simClusIndex]:
-                    for hitIndex in hitIndexArray:
-                        thisHit = event.rechits_raw[hitIndex]
-                        allRecHits.append(event.rechits_raw[hitIndex])
+    radialProfileStore = dict((key, []) for key in radialProfileKeys)
+    reader = HGCalNtupleReader.NtupleReader(chain, batchSize=batchSize)
+    for batch in reader.iterBatches(nEvents + 1 if nEvents > 0 else -1):
+        for batchEvent in range(batch.nEvents):
+            currentEvent = batch.firstEntry + batchEvent
+            if (currentEvent % 100 == 0):
+                logger.info("Event {} of {}".format(currentEvent, sampleEvents))
+            recHitSlice = batch.getRecHitSlice(batchEvent)
+            simClusters = batch.getSimClusters(batchEvent)
+
+            # associate RecHits to SimClusters (the RecHits of SimCluster i are assocRecHits[assocOffsets[i]:assocOffsets[i+1]] of the event)
+            assocOffsets, assocRecHits = HGCalHelpers.associateRecHits(batch.rechits["detid"][recHitSlice], *batch.getSimClusterHits(batchEvent))
+
+            # get generator particles applying conversion cut
+            # vGenParticleTLV = HGCalHelpers.getGenParticles(event, histDict, dvzCut)
+
+            # keep track of SimClusters that are in the same hemisphere as the selected GenParticles
+            # matchesGen = [False]*len(event.simcluster)
+
+            # simClusIndex = 0
+            # for simCl, pfCl in zip(event.simcluster, event.pfcluster):
+            #     # logging.info("{} {}".format(simCl.pt, pfCl.pt))
+            #     for genPartIndex, genPart in enumerate(vGenParticleTLV):
+            #         # if deltaR2(genPart, simCl) < loose_dRCut:
+            #         if genPart.Eta()*simCl.eta > 0:
+            #             matchesGen[simClusIndex] = True
+            #             histDict["SimVsPF_delta_energy"].Fill(simCl.energy-pfCl.energy)
+            #             histDict["SimVsPF_delta_pt"].Fill(simCl.pt-pfCl.pt)
+            #             histDict["SimVsPF_deltaover_energy"].Fill((simCl.energy-pfCl.energy)/simCl.energy)
+            #             histDict["SimVsPF_deltaover_pt"].Fill((simCl.pt-pfCl.pt)/simCl.pt)
+            #             histDict["SimVsPF_delta_eta"].Fill(simCl.eta-pfCl.eta)
+            #             histDict["SimVsPF_delta_phi"].Fill(simCl.phi-pfCl.phi)
+            #             histDict["SimVsPF_delta_R"].Fill(HGCalHelpers.deltaR(simCl, pfCl))
+            #             break
+            #     simClusIndex += 1
+
+            # use the SimClusters that "match" the GenParticles and study associated RecHits
+            for simClusIndex, simCl in enumerate(simClusters):
+                simClTLV = ROOT.TLorentzVector()
+                simClTLV.SetPtEtaPhiE(simCl.pt, simCl.eta, simCl.phi, simCl.energy)
+                histDict["SimClus_energy"].Fill(simCl.energy)
+                histDict["SimClus_pt"].Fill(simCl.pt)
+                histDict["SimClus_eta"].Fill(simCl.eta)
+                histDict["SimClus_phi"].Fill(simCl.phi)
+                # if (matchesGen[simClusIndex]):
+                if (simCl.energy >= simClusECut) and not ((abs(simCl.eta) < 1.7) or (abs(simCl.eta) > 2.7)):
+                    histDict["SimClus_energy_pass"].Fill(simCl.energy)
+                    histDict["SimClus_pt_pass"].Fill(simCl.pt)
+                    histDict["SimClus_eta_pass"].Fill(simCl.eta)
+                    histDict["SimClus_phi_pass"].Fill(simCl.phi)
+                    recHitVectors = {}
+                    recHitVectorsLayer = {}
+                    recHitEsum_plain = {}
+                    for detect in detectors:
+                        recHitVectors[detect] = ROOT.TLorentzVector()
+                        recHitEsum_plain[detect] = 0
+                    for layer in range(1, maxLayer):
+                        recHitVectorsLayer[layer] = ROOT.TLorentzVector()
+                        recHitEsum_plain[layer] = 0
+                        # recHitEsumLayerCumulative[layer] = 0
+                    allRecHits = []
+                    # x-y coordinates (at the layer of each hit) of the hits and of the SimCluster, projected for all hits at once
+                    simClusRecHits = recHitSlice.start + assocRecHits[assocOffsets[simClusIndex]:assocOffsets[simClusIndex+1]]
+                    simClusHitLayers = batch.rechits["layer"][simClusRecHits]
+                    simClusHitsX, simClusHitsY = geometry.layerEtaPhiToXY(simClusHitLayers, simCl.eta, simCl.phi)
+                    recHitsX, recHitsY = geometry.layerEtaPhiToXY(simClusHitLayers, batch.rechits["eta"][simClusRecHits], batch.rechits["phi"][simClusRecHits])
+                    # print "loop hits"
+                    for hitNumber, recHitIndex in enumerate(simClusRecHits):
+                        thisHit = batch.getRecHit(recHitIndex)
+                        allRecHits.append(thisHit)
                         # print thisHit.energy
                         histDict["RecHits_layers_energy"].Fill(thisHit.layer, thisHit.energy)
                         histDict["RecHits_layers_energy_1D"].Fill(thisHit.layer, thisHit.energy)
                         histDict["RecHits_layers_nHits"].Fill(thisHit.layer)
                         histDict["RecHits_layers_pt"].Fill(thisHit.layer, thisHit.pt)
                         histDict["RecHits_layers_N"].Fill(thisHit.layer)
-                        simClx = geometry.layerEtaPhiToX(thisHit.layer, simCl.eta, simCl.phi)
-                        simCly = geometry.layerEtaPhiToY(thisHit.layer, simCl.eta, simCl.phi)
-                        hitx = geometry.layerEtaPhiToX(thisHit.layer, thisHit.eta, thisHit.phi)
-                        hity = geometry.layerEtaPhiToY(thisHit.layer, thisHit.eta, thisHit.phi)
+                        simClx = simClusHitsX[hitNumber]
+                        simCly = simClusHitsY[hitNumber]
+                        hitx = recHitsX[hitNumber]
+                        hity = recHitsY[hitNumber]
                         # print "x:", thisHit.x, geometry.layerEtaPhiToX(thisHit.layer, thisHit.eta, thisHit.phi), "y:", thisHit.y, geometry.layerEtaPhiToY(thisHit.layer, thisHit.eta, thisHit.phi), "layer:", thisHit.layer, "eta, phi:", thisHit.eta, thisHit.phi
                         # print simClx, hitx, simCly, hity, simCl.eta, thisHit.eta, simCl.phi, thisHit.phi
                         recHitTLV = ROOT.TLorentzVector()
@@ -326,152 +316,153 @@ def processSample(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClu
                             recHitVectors["FH+BH"] += recHitTLV
                             recHitEsum_plain["BH"] += thisHit.energy
                             recHitEsum_plain["FH+BH"] += thisHit.energy
-                logger.debug("SimCluster pt, E: {}, {} - RecHitVector pt, E: {}, {}".format(simCl.pt, simCl.energy, recHitVectors["all"].Pt(), recHitVectors["all"].E()))
-                (xPosWeighted, yPosWeighted) = getXYWeighted(allRecHits, 30)
-                # relative pT cut to clean up misreconstructed particles
-                if applyRecHitsRelPtCut:
-                    if (recHitVectors["all"].Pt() < 0.8*simCl.pt):
-                        continue
-                selectedEvents += 1
-                histDict["RecHits_energy"].Fill(recHitVectors["all"].E())
-                histDict["RecHits_eta"].Fill(recHitVectors["all"].Eta())
-                histDict["RecHits_phi"].Fill(recHitVectors["all"].Phi())
-                histDict["RecHits_pt"].Fill(recHitVectors["all"].Pt())
-                histDict["SimVsRecHits_delta_eta"].Fill(simCl.eta-recHitVectors["all"].Eta())
-                histDict["SimVsRecHits_delta_phi"].Fill(simCl.phi-recHitVectors["all"].Phi())
-                recHitClusTot_energy = 0
-                recHitLayer_energy_plain_cumulative = 0
-                recHitClusTot_pt = 0
-                for layer in range(1, maxLayer):
-                    recHitLayer_energy_plain_cumulative += recHitEsum_plain[layer]
-                    if (recHitVectorsLayer[layer].E() > 0):
-                        recHitClusTot_energy += recHitVectorsLayer[layer].E()
-                        recHitClusTot_pt += recHitVectorsLayer[layer].Pt()
-                        histDict["RecHitsClus_layers_energy"].Fill(layer, recHitVectorsLayer[layer].E())
-                        histDict["RecHitsClus_layers_energy_1D"].Fill(layer, recHitVectorsLayer[layer].E())
-                        histDict["RecHitsClus_layers_pt"].Fill(layer, recHitVectorsLayer[layer].Pt())
-                        histDict["RecHitsClus_layers_delta_eta"].Fill(layer, recHitVectorsLayer[layer].Eta() - simCl.eta)
-                        histDict["RecHitsClus_layers_delta_phi"].Fill(layer, recHitVectorsLayer[layer].Phi() - simCl.phi)
-                        histDict["RecHitsClus_layers_delta_R"].Fill(layer, HGCalHelpers.deltaR2(recHitVectorsLayer[layer], simCl))
-                        # lateral shower comparison to SimCluster
-
-                    histDict["RecHitsClus_layers_energy_relative"].Fill(layer, recHitVectorsLayer[layer].E()/recHitVectors["all"].E())
-                    histDict["RecHitsClus_layers_pt_relative"].Fill(layer, recHitVectorsLayer[layer].Pt()/recHitVectors["all"].Pt())
-                    histDict["RecHitsClus_layers_energy_cumulative"].Fill(layer, recHitClusTot_energy/simCl.energy)
-                    histDict["RecHitsClus_layers_energy_1D_cumulative"].Fill(layer, recHitClusTot_energy/simCl.energy)
-                    histDict["RecHitsClus_layers_energy_1D_relative"].Fill(layer, recHitVectorsLayer[layer].E()/simCl.energy)
-                    histDict["RecHitsClus_layers_energy_plain_1D_cumulative"].Fill(layer, recHitLayer_energy_plain_cumulative/simCl.energy)
-                    histDict["RecHitsClus_layers_energy_plain_1D_relative"].Fill(layer, recHitEsum_plain[layer]/simCl.energy)
-                    histDict["RecHitsClus_layers_pt_cumulative"].Fill(layer, recHitClusTot_pt/simCl.pt)
-                    # histDict["RecHitsClus_layers_eta_cumulative"].Fill(layer, recHitClusTot_eta/simCl.eta)
-                # histDict["SimVsRecHits_delta_R"].Fill(HGCalHelpers.deltaR(simCl, recHitVector))
-                # print "XY fun:", xPosWeighted, yPosWeighted, recHitVectorsLayer[30].X(), recHitVectorsLayer[30].Y(), recHitVectorsLayer[30].E()
-                for detect in detectors:
-                    etaR = "fullEta"
-                    histDict["SimVsRecHits_delta_energy_%s_%s" % (detect, etaR)].Fill(simCl.energy-recHitVectors[detect].E())
-                    histDict["SimVsRecHits_delta_pt_%s_%s" % (detect, etaR)].Fill(simCl.pt-recHitVectors[detect].Pt())
-                    histDict["SimVsRecHits_deltaover_energy_%s_%s" % (detect, etaR)].Fill((simCl.energy-recHitVectors[detect].E())/simCl.energy)
-                    histDict["SimVsRecHits_deltaover_pt_%s_%s" % (detect, etaR)].Fill((simCl.pt-recHitVectors[detect].Pt())/simCl.pt)
-                    histDict["SimVsRecHits_frac_energy_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy)
-                    histDict["SimVsRecHits_frac_pt_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt)
-                    histDict["SimVsRecHits_frac_energy_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].E()/simCl.energy, recHitVectors[detect].E()/simCl.energy)
-                    histDict["SimVsRecHits_frac_pt_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].Pt()/simCl.pt, recHitVectors[detect].Pt()/simCl.pt)
-                    histDict["SimVsRecHits_frac_energy_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy, recHitVectors[detect].Eta())
-                    histDict["SimVsRecHits_frac_pt_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt, recHitVectors[detect].Eta())
-                    # recHitLayer_energy_plain_cumulative is now the total energy
-                    histDict["SimVsRecHits_frac_energy_delta_energy_%s_%s" % (detect, etaR)].Fill(recHitEsum_plain[detect]/simCl.energy, (recHitLayer_energy_plain_cumulative - simCl.energy)/simCl.energy)
-                    histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D" % (detect, etaR)].Fill(recHitEsum_plain[detect]/simCl.energy)
-                    for binIndex in range(1, histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D_cumulative" % (detect, etaR)].GetNbinsX()+1):
-                        binLowEdge = histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D_cumulative" % (detect, etaR)].GetXaxis().GetBinLowEdge(binIndex)
-                        if (recHitEsum_plain[detect]/simCl.energy > binLowEdge):
-                            histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D_cumulative" % (detect, etaR)].Fill(binLowEdge+0.00001)
-                    if (abs(simCl.eta) <= 1.95):
-                        etaR = "1p70_1p95"
-                    elif (abs(simCl.eta) <= 2.2):
-                        etaR = "1p95_2p20"
-                    elif (abs(simCl.eta) <= 2.45):
-                        etaR = "2p20_2p45"
-                    else:
-                        etaR = "2p45_2p70"
-                    histDict["SimVsRecHits_delta_energy_%s_%s" % (detect, etaR)].Fill(simCl.energy-recHitVectors[detect].E())
-                    histDict["SimVsRecHits_delta_pt_%s_%s" % (detect, etaR)].Fill(simCl.pt-recHitVectors[detect].Pt())
-                    histDict["SimVsRecHits_deltaover_energy_%s_%s" % (detect, etaR)].Fill((simCl.energy-recHitVectors[detect].E())/simCl.energy)
-                    histDict["SimVsRecHits_deltaover_pt_%s_%s" % (detect, etaR)].Fill((simCl.pt-recHitVectors[detect].Pt())/simCl.pt)
-                    histDict["SimVsRecHits_frac_energy_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy)
-                    histDict["SimVsRecHits_frac_pt_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt)
-                    histDict["SimVsRecHits_frac_energy_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].E()/simCl.energy, recHitVectors[detect].E()/simCl.energy)
-                    histDict["SimVsRecHits_frac_pt_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].Pt()/simCl.pt, recHitVectors[detect].Pt()/simCl.pt)
-                    histDict["SimVsRecHits_frac_energy_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy, recHitVectors[detect].Eta())
-                    histDict["SimVsRecHits_frac_pt_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt, recHitVectors[detect].Eta())
-
-                # now loop over individual RecHits again to compare against energy-weighted RecHitCluster
-                # first try to determine the layer where the maximum energy has been deposited
-                layerEmax = 0
-                Emax = 0
-                for layer, tlv in recHitVectorsLayer.iteritems():
-                    if tlv.E() > Emax:
-                        Emax = tlv.E()
-                        layerEmax = layer
-                # now get x-y coordinates of that cluster
-                maxRecHitsClus_x = geometry.layerEtaPhiToX(layerEmax, recHitVectorsLayer[layerEmax].Eta(), recHitVectorsLayer[layerEmax].Phi())
-                maxRecHitsClus_y = geometry.layerEtaPhiToY(layerEmax, recHitVectorsLayer[layerEmax].Eta(), recHitVectorsLayer[layerEmax].Phi())
-                # try also to use energy-weighted coordinates of first layer and SimCluster coordinates
-                firstLayerRecHitsClus_x = geometry.layerEtaPhiToX(1, recHitVectorsLayer[1].Eta(), recHitVectorsLayer[1].Phi())
-                firstLayerRecHitsClus_y = geometry.layerEtaPhiToY(1, recHitVectorsLayer[1].Eta(), recHitVectorsLayer[1].Phi())
-                simClus_x = geometry.layerEtaPhiToX(1, simCl.eta, simCl.phi)
-                simClus_y = geometry.layerEtaPhiToY(1, simCl.eta, simCl.phi)
-
-                radiusReferenceObject = {}
-                radiusReferenceObject["RecHitsClusMaxLayer"] = (maxRecHitsClus_x, maxRecHitsClus_y)
-                radiusReferenceObject["RecHitsClusFirstLayer"] = (firstLayerRecHitsClus_x, firstLayerRecHitsClus_y)
-                radiusReferenceObject["SimCluster"] = (simClus_x, simClus_y)
-
-                maxRadius = 501
-                for refKey, refObject in radiusReferenceObject.iteritems():
-                    # loop over the RecHits and add them if they are within a certain radius (up to maxRadius mm)
-                    recHitVectorsRadius = {}
+                    logger.debug("SimCluster pt, E: {}, {} - RecHitVector pt, E: {}, {}".format(simCl.pt, simCl.energy, recHitVectors["all"].Pt(), recHitVectors["all"].E()))
+                    (xPosWeighted, yPosWeighted) = getXYWeighted(allRecHits, 30)
+                    # relative pT cut to clean up misreconstructed particles
+                    if applyRecHitsRelPtCut:
+                        if (recHitVectors["all"].Pt() < 0.8*simCl.pt):
+                            continue
+                    selectedEvents += 1
+                    histDict["RecHits_energy"].Fill(recHitVectors["all"].E())
+                    histDict["RecHits_eta"].Fill(recHitVectors["all"].Eta())
+                    histDict["RecHits_phi"].Fill(recHitVectors["all"].Phi())
+                    histDict["RecHits_pt"].Fill(recHitVectors["all"].Pt())
+                    histDict["SimVsRecHits_delta_eta"].Fill(simCl.eta-recHitVectors["all"].Eta())
+                    histDict["SimVsRecHits_delta_phi"].Fill(simCl.phi-recHitVectors["all"].Phi())
+                    recHitClusTot_energy = 0
+                    recHitLayer_energy_plain_cumulative = 0
+                    recHitClusTot_pt = 0
+                    for layer in range(1, maxLayer):
+                        recHitLayer_energy_plain_cumulative += recHitEsum_plain[layer]
+                        if (recHitVectorsLayer[layer].E() > 0):
+                            recHitClusTot_energy += recHitVectorsLayer[layer].E()
+                            recHitClusTot_pt += recHitVectorsLayer[layer].Pt()
+                            histDict["RecHitsClus_layers_energy"].Fill(layer, recHitVectorsLayer[layer].E())
+                            histDict["RecHitsClus_layers_energy_1D"].Fill(layer, recHitVectorsLayer[layer].E())
+                            histDict["RecHitsClus_layers_pt"].Fill(layer, recHitVectorsLayer[layer].Pt())
+                            histDict["RecHitsClus_layers_delta_eta"].Fill(layer, recHitVectorsLayer[layer].Eta() - simCl.eta)
+                            histDict["RecHitsClus_layers_delta_phi"].Fill(layer, recHitVectorsLayer[layer].Phi() - simCl.phi)
+                            histDict["RecHitsClus_layers_delta_R"].Fill(layer, HGCalHelpers.deltaR2(recHitVectorsLayer[layer], simCl))
+                            # lateral shower comparison to SimCluster
+
+                        histDict["RecHitsClus_layers_energy_relative"].Fill(layer, recHitVectorsLayer[layer].E()/recHitVectors["all"].E())
+                        histDict["RecHitsClus_layers_pt_relative"].Fill(layer, recHitVectorsLayer[layer].Pt()/recHitVectors["all"].Pt())
+                        histDict["RecHitsClus_layers_energy_cumulative"].Fill(layer, recHitClusTot_energy/simCl.energy)
+                        histDict["RecHitsClus_layers_energy_1D_cumulative"].Fill(layer, recHitClusTot_energy/simCl.energy)
+                        histDict["RecHitsClus_layers_energy_1D_relative"].Fill(layer, recHitVectorsLayer[layer].E()/simCl.energy)
+                        histDict["RecHitsClus_layers_energy_plain_1D_cumulative"].Fill(layer, recHitLayer_energy_plain_cumulative/simCl.energy)
+                        histDict["RecHitsClus_layers_energy_plain_1D_relative"].Fill(layer, recHitEsum_plain[layer]/simCl.energy)
+                        histDict["RecHitsClus_layers_pt_cumulative"].Fill(layer, recHitClusTot_pt/simCl.pt)
+                        # histDict["RecHitsClus_layers_eta_cumulative"].Fill(layer, recHitClusTot_eta/simCl.eta)
+                    # histDict["SimVsRecHits_delta_R"].Fill(HGCalHelpers.deltaR(simCl, recHitVector))
+                    # print "XY fun:", xPosWeighted, yPosWeighted, recHitVectorsLayer[30].X(), recHitVectorsLayer[30].Y(), recHitVectorsLayer[30].E()
                     for detect in detectors:
-                        recHitVectorsRadius[detect] = {}
-                        for radius in range(1, maxRadius, 5):
-                            recHitVectorsRadius[detect][radius] = ROOT.TLorentzVector()
-                    for thisHit in allRecHits:
-                        thisHit_x = geometry.layerEtaPhiToX(thisHit.layer, thisHit.eta, thisHit.phi)
-                        thisHit_y = geometry.layerEtaPhiToY(thisHit.layer, thisHit.eta, thisHit.phi)
-                        distanceSquared = (thisHit_x-refObject[0])**2 + (thisHit_y-refObject[1])**2
-                        histDict["RecHits_layers_delta_x_%s" % refKey].Fill(thisHit.layer, refObject[0] - hitx)
-                        histDict["RecHits_layers_delta_y_%s" % refKey].Fill(thisHit.layer, refObject[1] - hity)
-                        histDict["RecHits_layers_delta_d_%s" % refKey].Fill(thisHit.layer, math.sqrt(distanceSquared))
-                        histDict["RecHits_layers_delta_d2_%s" % refKey].Fill(thisHit.layer, distanceSquared)
-                        histDict["RecHits_layers_delta_x_eWeight_%s" % refKey].Fill(thisHit.layer, refObject[0] - thisHit_x, thisHit.energy)
-                        histDict["RecHits_layers_delta_y_eWeight_%s" % refKey].Fill(thisHit.layer, refObject[1] - thisHit_y, thisHit.energy)
-                        histDict["RecHits_layers_delta_d_eWeight_%s" % refKey].Fill(thisHit.layer, math.sqrt(distanceSquared), thisHit.energy)
-                        histDict["RecHits_layers_delta_d2_eWeight_%s" % refKey].Fill(thisHit.layer, distanceSquared, thisHit.energy)
-                        for radius in range(1, maxRadius, 5):
-                            if (distanceSquared < radius**2):
-                                tmpTLV = ROOT.TLorentzVector()
-                                tmpTLV.SetPtEtaPhiE(thisHit.pt, thisHit.eta, thisHit.phi, thisHit.energy)
-                                recHitVectorsRadius = addIfDetectorLayer(recHitVectorsRadius, tmpTLV, thisHit.layer, radius)
-                    for detect in detectors:
-                        for radius in range(1, maxRadius, 5):
-                            histDict["SimVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect)].Fill(radius, recHitVectorsRadius[detect][radius].E()/simCl.energy)
+                        etaR = "fullEta"
+                        histDict["SimVsRecHits_delta_energy_%s_%s" % (detect, etaR)].Fill(simCl.energy-recHitVectors[detect].E())
+                        histDict["SimVsRecHits_delta_pt_%s_%s" % (detect, etaR)].Fill(simCl.pt-recHitVectors[detect].Pt())
+                        histDict["SimVsRecHits_deltaover_energy_%s_%s" % (detect, etaR)].Fill((simCl.energy-recHitVectors[detect].E())/simCl.energy)
+                        histDict["SimVsRecHits_deltaover_pt_%s_%s" % (detect, etaR)].Fill((simCl.pt-recHitVectors[detect].Pt())/simCl.pt)
+                        histDict["SimVsRecHits_frac_energy_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy)
+                        histDict["SimVsRecHits_frac_pt_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt)
+                        histDict["SimVsRecHits_frac_energy_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].E()/simCl.energy, recHitVectors[detect].E()/simCl.energy)
+                        histDict["SimVsRecHits_frac_pt_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].Pt()/simCl.pt, recHitVectors[detect].Pt()/simCl.pt)
+                        histDict["SimVsRecHits_frac_energy_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy, recHitVectors[detect].Eta())
+                        histDict["SimVsRecHits_frac_pt_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt, recHitVectors[detect].Eta())
+                        # recHitLayer_energy_plain_cumulative is now the total energy
+                        histDict["SimVsRecHits_frac_energy_delta_energy_%s_%s" % (detect, etaR)].Fill(recHitEsum_plain[detect]/simCl.energy, (recHitLayer_energy_plain_cumulative - simCl.energy)/simCl.energy)
+                        histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D" % (detect, etaR)].Fill(recHitEsum_plain[detect]/simCl.energy)
+                        for binIndex in range(1, histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D_cumulative" % (detect, etaR)].GetNbinsX()+1):
+                            binLowEdge = histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D_cumulative" % (detect, etaR)].GetXaxis().GetBinLowEdge(binIndex)
+                            if (recHitEsum_plain[detect]/simCl.energy > binLowEdge):
+                                histDict["SimVsRecHits_frac_energy_%s_%s_fracEvents_1D_cumulative" % (detect, etaR)].Fill(binLowEdge+0.00001)
+                        if (abs(simCl.eta) <= 1.95):
+                            etaR = "1p70_1p95"
+                        elif (abs(simCl.eta) <= 2.2):
+                            etaR = "1p95_2p20"
+                        elif (abs(simCl.eta) <= 2.45):
+                            etaR = "2p20_2p45"
+                        else:
+                            etaR = "2p45_2p70"
+                        histDict["SimVsRecHits_delta_energy_%s_%s" % (detect, etaR)].Fill(simCl.energy-recHitVectors[detect].E())
+                        histDict["SimVsRecHits_delta_pt_%s_%s" % (detect, etaR)].Fill(simCl.pt-recHitVectors[detect].Pt())
+                        histDict["SimVsRecHits_deltaover_energy_%s_%s" % (detect, etaR)].Fill((simCl.energy-recHitVectors[detect].E())/simCl.energy)
+                        histDict["SimVsRecHits_deltaover_pt_%s_%s" % (detect, etaR)].Fill((simCl.pt-recHitVectors[detect].Pt())/simCl.pt)
+                        histDict["SimVsRecHits_frac_energy_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy)
+                        histDict["SimVsRecHits_frac_pt_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt)
+                        histDict["SimVsRecHits_frac_energy_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].E()/simCl.energy, recHitVectors[detect].E()/simCl.energy)
+                        histDict["SimVsRecHits_frac_pt_EE_%s_%s" % (detect, etaR)].Fill(recHitVectors["EE"].Pt()/simCl.pt, recHitVectors[detect].Pt()/simCl.pt)
+                        histDict["SimVsRecHits_frac_energy_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].E()/simCl.energy, recHitVectors[detect].Eta())
+                        histDict["SimVsRecHits_frac_pt_eta_%s_%s" % (detect, etaR)].Fill(recHitVectors[detect].Pt()/simCl.pt, recHitVectors[detect].Eta())
+
+                    # now loop over individual RecHits again to compare against energy-weighted RecHitCluster
+                    # first try to determine the layer where the maximum energy has been deposited
+                    layerEmax = 0
+                    Emax = 0
+                    for layer, tlv in recHitVectorsLayer.iteritems():
+                        if tlv.E() > Emax:
+                            Emax = tlv.E()
+                            layerEmax = layer
+                    # now get x-y coordinates of that cluster
+                    maxRecHitsClus_x = geometry.layerEtaPhiToX(layerEmax, recHitVectorsLayer[layerEmax].Eta(), recHitVectorsLayer[layerEmax].Phi())
+                    maxRecHitsClus_y = geometry.layerEtaPhiToY(layerEmax, recHitVectorsLayer[layerEmax].Eta(), recHitVectorsLayer[layerEmax].Phi())
+                    # try also to use energy-weighted coordinates of first layer and SimCluster coordinates
+                    firstLayerRecHitsClus_x = geometry.layerEtaPhiToX(1, recHitVectorsLayer[1].Eta(), recHitVectorsLayer[1].Phi())
+                    firstLayerRecHitsClus_y = geometry.layerEtaPhiToY(1, recHitVectorsLayer[1].Eta(), recHitVectorsLayer[1].Phi())
+                    simClus_x = geometry.layerEtaPhiToX(1, simCl.eta, simCl.phi)
+                    simClus_y = geometry.layerEtaPhiToY(1, simCl.eta, simCl.phi)
+
+                    radiusReferenceObject = {}
+                    radiusReferenceObject["RecHitsClusMaxLayer"] = (maxRecHitsClus_x, maxRecHitsClus_y)
+                    radiusReferenceObject["RecHitsClusFirstLayer"] = (firstLayerRecHitsClus_x, firstLayerRecHitsClus_y)
+                    radiusReferenceObject["SimCluster"] = (simClus_x, simClus_y)
+
+                    # radial profiles and containment radii (for containmentFractions) per reference point and detector
+                    energyRadius = np.zeros((len(lateralReferences), len(detectors), len(radialProfileRadii)))
+                    simContainment = np.full((len(lateralReferences), len(detectors), len(containmentFractions)), np.nan)
+                    recHitsClusContainment = np.full((len(lateralReferences), len(detectors), len(containmentFractions)), np.nan)
+                    for refKey, refObject in radiusReferenceObject.iteritems():
+                        refIndex = lateralReferences.index(refKey)
+                        # energy of the RecHits within each radius (radialProfileRadii) per detector
+                        recHitsDistanceSquared = (recHitsX-refObject[0])**2 + (recHitsY-refObject[1])**2
+                        recHitEnergyRadius = getRadialProfiles(simClusHitLayers, batch.rechits["energy"][simClusRecHits], recHitsDistanceSquared)
+                        for thisHit, thisHit_x, thisHit_y, distanceSquared in zip(allRecHits, recHitsX, recHitsY, recHitsDistanceSquared):
+                            histDict["RecHits_layers_delta_x_%s" % refKey].Fill(thisHit.layer, refObject[0] - hitx)
+                            histDict["RecHits_layers_delta_y_%s" % refKey].Fill(thisHit.layer, refObject[1] - hity)
+                            histDict["RecHits_layers_delta_d_%s" % refKey].Fill(thisHit.layer, math.sqrt(distanceSquared))
+                            histDict["RecHits_layers_delta_d2_%s" % refKey].Fill(thisHit.layer, distanceSquared)
+                            histDict["RecHits_layers_delta_x_eWeight_%s" % refKey].Fill(thisHit.layer, refObject[0] - thisHit_x, thisHit.energy)
+                            histDict["RecHits_layers_delta_y_eWeight_%s" % refKey].Fill(thisHit.layer, refObject[1] - thisHit_y, thisHit.energy)
+                            histDict["RecHits_layers_delta_d_eWeight_%s" % refKey].Fill(thisHit.layer, math.sqrt(distanceSquared), thisHit.energy)
+                            histDict["RecHits_layers_delta_d2_eWeight_%s" % refKey].Fill(thisHit.layer, distanceSquared, thisHit.energy)
+                        nRadii = len(radialProfileRadii)
+                        for detect in detectors:
+                            histDict["SimVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect)].FillN(nRadii, radialProfileRadii, recHitEnergyRadius[detect]/simCl.energy)
                             # also make plots relative to RecHitCluster sum in a subdetector
                             if (recHitVectors[detect].E() != 0):
-                                histDict["RecHitsClusVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect)].Fill(radius, recHitVectorsRadius[detect][radius].E()/recHitVectors[detect].E())
-                                histDict["RecHitsClusVsRecHits_radius_energy_%s_%s" % (refKey, detect)].Fill(radius, recHitVectorsRadius[detect][radius].E())
-                                histDict["RecHitsClusVsRecHits_total_energy_%s_%s" % (refKey, detect)].Fill(radius, recHitVectors[detect].E())
-                        for eFrac in np.arange(0.5, 1.01, 0.05):
-                            for radius in range(1, maxRadius, 5):
-                                if (recHitVectorsRadius[detect][radius].E()/simCl.energy > eFrac):
-                                    histDict["SimVsRecHits_radius_events_eFrac%d_%s_%s" % (eFrac*100, refKey, detect)].Fill(radius)
-                                    break
-                            for radius in range(1, maxRadius, 5):
-                                if (recHitVectors[detect].E() != 0):
-                                    if (recHitVectorsRadius[detect][radius].E()/recHitVectors[detect].E() > eFrac):
-                                        histDict["RecHitsClusVsRecHits_radius_events_eFrac%d_%s_%s" % (eFrac*100, refKey, detect)].Fill(radius)
-                                        break
-
-        if (nEvents > 0 and currentEvent >= nEvents):
-            break
+                                histDict["RecHitsClusVsRecHits_radius_frac_energy_%s_%s" % (refKey, detect)].FillN(nRadii, radialProfileRadii, recHitEnergyRadius[detect]/recHitVectors[detect].E())
+                                histDict["RecHitsClusVsRecHits_radius_energy_%s_%s" % (refKey, detect)].FillN(nRadii, radialProfileRadii, recHitEnergyRadius[detect])
+                                histDict["RecHitsClusVsRecHits_total_energy_%s_%s" % (refKey, detect)].FillN(nRadii, radialProfileRadii, np.full(nRadii, recHitVectors[detect].E()))
+                            detIndex = detectors.index(detect)
+                            energyRadius[refIndex, detIndex] = recHitEnergyRadius[detect]
+                            simContainment[refIndex, detIndex] = getContainmentRadii(recHitEnergyRadius[detect], simCl.energy)
+                            recHitsClusContainment[refIndex, detIndex] = getContainmentRadii(recHitEnergyRadius[detect], recHitVectors[detect].E())
+                    radialProfileStore["event"].append(currentEvent)
+                    radialProfileStore["simCluster"].append(simClusIndex)
+                    radialProfileStore["simClusterEnergy"].append(simCl.energy)
+                    radialProfileStore["recHitsClusEnergy"].append([recHitVectors[detect].E() for detect in detectors])
+                    radialProfileStore["energyRadius"].append(energyRadius)
+                    radialProfileStore["SimVsRecHits_containment"].append(simContainment)
+                    radialProfileStore["RecHitsClusVsRecHits_containment"].append(recHitsClusContainment)
+    # containment radii of all selected SimClusters at once, also stored per event (with the profiles to change the fractions later)
+    radialProfileStore = saveRadialProfiles(os.path.join(outDir, "radialProfiles.npz"), radialProfileStore)
+    for comp in ["SimVsRecHits", "RecHitsClusVsRecHits"]:
+        for refIndex, refKey in enumerate(lateralReferences):
+            for detIndex, detect in enumerate(detectors):
+                for fracIndex, eFrac in enumerate(containmentFractions):
+                    radii = radialProfileStore[comp + "_containment"][:, refIndex, detIndex, fracIndex]
+                    radii = radii[~np.isnan(radii)]
+                    if len(radii) > 0:
+                        histDict["%s_radius_events_eFrac%d_%s_%s" % (comp, eFrac*100, refKey, detect)].FillN(len(radii), radii, np.ones(len(radii)))
     histDict["SimClus_eta_eff"] = ROOT.TGraphAsymmErrors(histDict["SimClus_eta_pass"].Clone("SimClus_eta_eff"))
     histDict["SimClus_eta_eff"].Divide(histDict["SimClus_eta_pass"], histDict["SimClus_eta"], "cl=0.683 b(1,1) mode")
     histDict["SimClus_eta_eff"].GetYaxis().SetTitle("eff.")
@@ -489,32 +480,57 @@ def processSample(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClu
     HGCalHelpers.saveHistograms(histDict, canvas, outDir, imgType, logScale=False, rootOnly=rootOnly)
 
 
-def addIfDetectorLayer(myDict, itemToAdd, layer, secondIndex=None):
-    """This makes use of: detectors = ["EE", "FH", "BH", "FH+BH", "all"]"""
-    if secondIndex:
-        myDict["all"][secondIndex] += itemToAdd
-    else:
-        myDict["all"] += itemToAdd
-    if (layer < 29):
-        if secondIndex:
-            myDict["EE"][secondIndex] += itemToAdd
-        else:
-            myDict["EE"] += itemToAdd
-    elif (layer < 41):
-        if secondIndex:
-            myDict["FH"][secondIndex] += itemToAdd
-            myDict["FH+BH"][secondIndex] += itemToAdd
-        else:
-            myDict["FH"] += itemToAdd
-            myDict["FH+BH"] += itemToAdd
-    else:
-        if secondIndex:
-            myDict["BH"][secondIndex] += itemToAdd
-            myDict["FH+BH"][secondIndex] += itemToAdd
-        else:
-            myDict["BH"] += itemToAdd
-            myDict["FH+BH"] += itemToAdd
-    return myDict
+def getRadialProfiles(layers, energies, distanceSquared, radii=None):
+    """energy of the RecHits within each radius (distance < radius) per detector: ["EE", "FH", "BH", "FH+BH", "all"].
+
+    each hit is binned once at the first radius containing it, the binned sums per detector are then summed cumulatively.
+    returns a dict of the contained energy at each radius (array) per detector.
+    """
+    if radii is None:
+        radii = radialProfileRadii
+    nRadii = len(radii)
+    radiusBin = np.searchsorted(np.asarray(radii, dtype=np.float64)**2, distanceSquared, side='right')  # nRadii if outside all radii
+    detector = np.where(np.asarray(layers) < 29, 0, np.where(np.asarray(layers) < 41, 1, 2))  # EE, FH, BH
+    binnedEnergy = np.bincount(detector*(nRadii+1) + radiusBin, weights=energies, minlength=3*(nRadii+1)).reshape(3, nRadii+1)
+    energyRadius = np.cumsum(binnedEnergy[:, :nRadii], axis=1)
+    return {"EE": energyRadius[0], "FH": energyRadius[1], "BH": energyRadius[2], "FH+BH": energyRadius[1] + energyRadius[2], "all": energyRadius.sum(axis=0)}
+
+
+def getContainmentRadii(energyRadius, totalEnergy, fractions=None, radii=None):
+    """first radius at which the contained energy (energyRadius, at each radius) exceeds each fraction of totalEnergy.
+
+    the fractions are looked up at once in the running maximum of the contained fraction, which gives the same radius as
+    scanning the radii for each fraction. returns an array of the radius per fraction, NaN where it is never exceeded.
+    """
+    if fractions is None:
+        fractions = containmentFractions
+    if radii is None:
+        radii = radialProfileRadii
+    containment = np.full(len(fractions), np.nan)
+    if totalEnergy == 0:
+        return containment
+    containedFraction = np.maximum.accumulate(np.asarray(energyRadius)/totalEnergy)
+    radiusIndex = np.searchsorted(containedFraction, fractions, side='right')
+    contained = radiusIndex < len(radii)
+    containment[contained] = np.asarray(radii, dtype=np.float64)[radiusIndex[contained]]
+    return containment
+
+
+def saveRadialProfiles(fileName, radialProfileStore):
+    """save the radial profiles of the selected SimClusters (lists per SimCluster, radialProfileKeys) as arrays to fileName (npz).
+
+    also stores the radii, fractions, reference points and detectors the arrays are indexed with; the containment radii for other
+    fractions follow from getContainmentRadii(energyRadius[i, ref, det], simClusterEnergy[i] or recHitsClusEnergy[i, det], fractions).
+    returns the dict of the arrays.
+    """
+    shapes = {"recHitsClusEnergy": (len(detectors),),
+              "energyRadius": (len(lateralReferences), len(detectors), len(radialProfileRadii)),
+              "SimVsRecHits_containment": (len(lateralReferences), len(detectors), len(containmentFractions)),
+              "RecHitsClusVsRecHits_containment": (len(lateralReferences), len(detectors), len(containmentFractions))}
+    arrays = dict((key, np.array(radialProfileStore[key], dtype=np.int64 if key in ["event", "simCluster"] else np.float64).reshape((-1,) + shapes.get(key, ())))
+                  for key in radialProfileKeys)
+    np.savez_compressed(fileName, radii=radialProfileRadii, fractions=containmentFractions, references=lateralReferences, detectors=detectors, **arrays)
+    return arrays
 
 
 def main():
@@ -530,6 +546,7 @@ def main():
     parser.add_option('', '--sampleName', dest='sampleName', type='string',  default='', help='sample name')
     parser.add_option('', '--files', dest='fileString', type='string',  default='', help='comma-separated file list')
     parser.add_option('', '--eCut', dest='eCut', type=float,  default=0., help='SimCluster energy threshold')
+    parser.add_option('', '--batchSize', dest='batchSize', type=int,  default=HGCalNtupleReader.batchSize, help='events read at once')
 
     # store options and arguments as global variables
     global opt, args
@@ -600,7 +617,8 @@ def main():
             sample = sampleManager.getSample(sampleName)
             chain = sample.getChain()
             logger.info("Submitting %s" % sampleName)
-            process = Process(target=processSample, args=(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClusECut, imgType, logger, geometry))
+            process = Process(target=processSample, args=(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClusECut, imgType, logger, geometry),
+                              kwargs={"batchSize": opt.batchSize})
             jobs.append(process)
 
         for j in jobs:
@@ -616,7 +634,8 @@ def main():
         sample = Sample(opt.sampleName, "", fileList=fileList)
         chain = sample.getChain()
         logger.info("Running %s" % opt.sampleName)
-        processSample(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClusECut, imgType, logger, geometry, rootOnly=True)
+        processSample(chain, nEvents, outDir, maxLayer, applyRecHitsRelPtCut, simClusECut, imgType, logger, geometry, rootOnly=True,
+                      batchSize=opt.batchSize)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,12 @@
 # investigate shower development based on RecHits and SimClusters
 import ROOT
+import time
+import multiprocessing
 import numpy as np
 import HGCalHelpers
 import HGCalImagingAlgo
+import HGCalROOT
+import HGCalNtupleReader
 
 ## basic setup for testing
 # 2D clustering
@@ -13,6 +17,15 @@ minClusters = 3
 # allowed events/layers for testing/histograming
 allowedRangeLayers = [] # layer considered for histograming e.g. [10, 15], empty for none
 allowedRangeEvents = list(range(5,8)) # event numbers considered for histograming, e.g. [5,6,7], empty for none
+# validation of the stand-alone clustering vs RECO on whole files (instead of the detailed look at a few events above)
+validationMode = False
+validationFiles = ["partGun_PDGid22_x96_E20.0To20.0_NTUP_1.root"]
+validationWorkers = 4 # processes, each clustering chunks of validationChunkEvents events
+validationChunkEvents = 50
+validationMaxEvents = -1 # per file, -1 for all
+# RECO collections compared to: the clustered rechits (with the index of their 2D cluster, -1 if not clustered), 2D clusters and multi-clusters
+# (without the rechits, e.g. not in all ntuples, only the numbers and energies of the clusters are compared)
+recoCollections = [("rechits", ["detid", "cluster2d"]), ("cluster2d", ["energy"]), ("multicluster", ["energy"])]
 # other
 verbosityLevel = 1 # 0 - only basic info (default); 1 - additional info; 2 - detailed info printed
 
@@ -25,29 +38,14 @@ def getRecHitDetIds(rechits):
     recHits = np.array(recHitsList)
     return recHits
 
-def getHitList(simClus, recHitDetIds):
-    sClusHitsList = []
-    for DetId in simClus.hits:
-        sClusHitsList.append(DetId)
-    # print sClusHitsList
-    sClusHits = np.array(sClusHitsList)
-    # thanks to http://stackoverflow.com/questions/11483863/python-intersection-indices-numpy-array
-    recHitIndices = np.nonzero(np.in1d(recHitDetIds, sClusHits))
-    # print "indices - "*10
-    # print recHitIndices
-    # if (len(recHitIndices[0]) != len(sClusHitsList)):
-    #     print "Mismatch:", len(recHitIndices[0]), len(sClusHits)
-    return recHitIndices
-
 # get list of rechist associated to sim-cluster hits
 def getRecHitsSimAssoc(rechits_raw, simcluster):
-    # get sim-cluster associations
-    nSimClus = 0
-    simClusHitAssoc = []
+    # get sim-cluster associations (the rechits of sim-cluster i are assocRecHits[assocOffsets[i]:assocOffsets[i+1]])
     recHitDetIds = getRecHitDetIds(rechits_raw)
-    for simClusIndex, simClus in enumerate(simcluster):
-        simClusHitAssoc.append(getHitList(simClus, recHitDetIds))
-        nSimClus += 1
+    simClusHits = [np.fromiter(simClus.hits, dtype=np.int64) for simClus in simcluster]
+    nSimClus = len(simClusHits)
+    assocOffsets, assocRecHits = HGCalHelpers.associateRecHits(recHitDetIds, np.r_[0, np.cumsum([len(hits) for hits in simClusHits])],
+                                                               np.concatenate(simClusHits + [np.zeros(0, dtype=np.int64)]))
 
     # get list of rechist associated to simhits
     rHitsSimAssoc = [[] for k in range(0,nSimClus)]
@@ -56,40 +54,95 @@ def getRecHitsSimAssoc(rechits_raw, simcluster):
 
         # loop over sim clusters and then rechits
         rHitsSimAssocTemp = []
-        for hitIndexArray in simClusHitAssoc[simClusIndex]:
-            for hitIndex in hitIndexArray:
-                thisHit = rechits_raw[hitIndex]
-                if(thisHit.energy < ecut): continue
-                # independent of sim cluster, after cleaning
-                rHitsSimAssocTemp.append(thisHit)
+        for hitIndex in assocRecHits[assocOffsets[simClusIndex]:assocOffsets[simClusIndex+1]]:
+            thisHit = rechits_raw[hitIndex]
+            if(thisHit.energy < ecut): continue
+            # independent of sim cluster, after cleaning
+            rHitsSimAssocTemp.append(thisHit)
         rHitsSimAssoc[simClusIndex]= rHitsSimAssocTemp
 
     return rHitsSimAssoc
 
-# histograming of rechist associated to sim-cluster hits
-def histRecHitsSimAssoc(rHitsSimAssoc, currentEvent, histDict, tag = "rHitsAssoc_", zoomed = False):
+# sparse store of event displays: only the filled points (z, phi, eta, weight) of each display are kept, with its binning, written
+# one display after the other to a single file (as numpy arrays), and rendered as TH3F on demand (see renderEventDisplays)
+class EventDisplayStore:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.outFile = open(fileName, "wb")
+        self.nDisplays = 0
+        self.nPoints = 0
+    # add a display: binning (nBins, low, high of z, phi and eta, as for TH3F) and the coordinates of its points (weight 1 if not given)
+    def add(self, name, title, binning, z, phi, eta, weight = None):
+        points = np.empty((len(z), 4), dtype=np.float32)
+        points[:, 0] = z
+        points[:, 1] = phi
+        points[:, 2] = eta
+        points[:, 3] = 1. if weight is None else weight
+        np.save(self.outFile, np.array([name, title]))
+        np.save(self.outFile, np.asarray(binning, dtype=np.float64))
+        np.save(self.outFile, points)
+        self.nDisplays += 1
+        self.nPoints += len(points)
+    def close(self):
+        self.outFile.close()
+
+# read the displays of an EventDisplayStore file one at a time (optionally only the given names): name, title, binning and points of each
+def readEventDisplays(fileName, names = None):
+    with open(fileName, "rb") as inFile:
+        while True:
+            position = inFile.tell()
+            if not inFile.read(1): break # end of file
+            inFile.seek(position)
+            name, title = np.load(inFile)
+            binning = np.load(inFile)
+            points = np.load(inFile)
+            if names is None or name in names:
+                yield name, title, binning, points
+
+# TH3F of one display
+def makeDisplayHistogram(name, title, binning, points):
+    hist = ROOT.TH3F(name, title, int(binning[0]), binning[1], binning[2], int(binning[3]), binning[4], binning[5], int(binning[6]), binning[7], binning[8])
+    for z, phi, eta, weight in points.astype(np.float64):
+        hist.Fill(z, phi, eta, weight)
+    return hist
+
+# render the displays of an EventDisplayStore file (optionally only the given names) one at a time, saved as images in outDir
+def renderEventDisplays(fileName, outDir, names = None, imgType = "pdf"):
+    canvas = ROOT.TCanvas(outDir + "_displays", outDir + "_displays", 500, 500)
+    ROOT.gStyle.SetPalette(ROOT.kBird);
+    for name, title, binning, points in readEventDisplays(fileName, names):
+        if len(points) == 0: continue # do not save empty displays
+        hist = makeDisplayHistogram(name, title, binning, points)
+        hist.Draw("box")
+        canvas.SaveAs("{}/{}.{}".format(outDir, name, imgType))
+        hist.Delete()
+    return
+
+# display of rechist associated to sim-cluster hits
+def histRecHitsSimAssoc(rHitsSimAssoc, currentEvent, displayStore, tag = "rHitsAssoc_", zoomed = False):
     # sanity check
-    if (histDict == None): return
+    if (displayStore == None): return
 
-    # define event-level hists
+    # event-level display
     if (zoomed): # zoomed for testing/convenience around the eta/phi of most energetic hit
         rs = sorted(range(len(rHitsSimAssoc[0])), key=lambda k: rHitsSimAssoc[0][k].energy, reverse=True) # indices sorted by decreasing rho
         c_phi = rHitsSimAssoc[0][rs[0]].phi
         c_eta = rHitsSimAssoc[0][rs[0]].eta
-        histDict[tag+"map_lay_phi_eta_evt{}".format(currentEvent)]  = ROOT.TH3F(tag+"map_lay_phi_eta_evt{}".format(currentEvent), tag+"map_lay_phi_eta_evt{};z(cm);#phi;#eta".format(currentEvent), 160, 320, 400, 50, c_phi-0.5, c_phi+0.5, 50, c_eta-0.5, c_eta+0.5) # 3D rechists associated to sim-cluster (with ecut cleaning)
+        binning = (160, 320, 400, 50, c_phi-0.5, c_phi+0.5, 50, c_eta-0.5, c_eta+0.5)
     else:
-        histDict[tag+"map_lay_phi_eta_evt{}".format(currentEvent)]  = ROOT.TH3F(tag+"map_lay_phi_eta_evt{}".format(currentEvent), tag+"map_lay_phi_eta_evt{};z(cm);#phi;#eta".format(currentEvent), 160, 320, 400, 314, -3.14, +3.14, 320, -3.2, 3.2) # 3D rechists associated to sim-cluster (with ecut cleaning)
+        binning = (160, 320, 400, 314, -3.14, +3.14, 320, -3.2, 3.2)
+    allHits = [thisHit for simClusHits in rHitsSimAssoc for thisHit in simClusHits]
+    displayStore.add(tag+"map_lay_phi_eta_evt{}".format(currentEvent), tag+"map_lay_phi_eta_evt{};z(cm);#phi;#eta".format(currentEvent), binning,
+                     [abs(thisHit.z) for thisHit in allHits], [thisHit.phi for thisHit in allHits], [thisHit.eta for thisHit in allHits]) # all sim-associated hits
 
+    # sim-cluster-level displays
     for simClusIndex in range(0,len(rHitsSimAssoc)):
-        # define sim-cluster-level hists
-        histDict[tag+"map_lay_phi_eta_evt{}_sim{}".format(currentEvent, simClusIndex)]  = ROOT.TH3F(tag+"map_lay_phi_eta_evt{}_sim{}".format(currentEvent, simClusIndex), tag+"map_lay_phi_eta_evt{}_sim{};z(cm);#phi;#eta".format(currentEvent, simClusIndex), 160, 320, 400, 314, -3.14, +3.14, 320, -3.2, 3.2)
-        # loop over assoc. rec hits
-        for thisHit in rHitsSimAssoc[simClusIndex]:
-            histDict[tag+"map_lay_phi_eta_evt{}".format(currentEvent)].Fill(abs(thisHit.z), thisHit.phi, thisHit.eta) # for each sim cluster, after cleaning
-            if(thisHit.energy < ecut): continue
-            histDict[tag+"map_lay_phi_eta_evt{}_sim{}".format(currentEvent, simClusIndex)].Fill(abs(thisHit.z), thisHit.phi, thisHit.eta) # independent of sim cluster, before cleaning
+        simClusHits = [thisHit for thisHit in rHitsSimAssoc[simClusIndex] if not thisHit.energy < ecut]
+        displayStore.add(tag+"map_lay_phi_eta_evt{}_sim{}".format(currentEvent, simClusIndex), tag+"map_lay_phi_eta_evt{}_sim{};z(cm);#phi;#eta".format(currentEvent, simClusIndex),
+                         (160, 320, 400, 314, -3.14, +3.14, 320, -3.2, 3.2),
+                         [abs(thisHit.z) for thisHit in simClusHits], [thisHit.phi for thisHit in simClusHits], [thisHit.eta for thisHit in simClusHits]) # hits of the sim cluster (with ecut cleaning)
 
-    return histDict
+    return displayStore
 
 # histograming of rechists
 def histRecHits(rHits, currentEvent, histDict, tag = "rHits_", zoomed = False):
@@ -115,25 +168,26 @@ def histRecHits(rHits, currentEvent, histDict, tag = "rHits_", zoomed = False):
 
     return histDict
 
-# histograming of clustered rechist with algo
-def histHexelsClustered(hexelsClustered, currentEvent, histDict, tag = "clustHex_", zoomed = False):
+# display of clustered rechist with algo
+def histHexelsClustered(hexelsClustered, currentEvent, displayStore, tag = "clustHex_", zoomed = False):
     # sanity check
-    if (histDict == None): return
+    if (displayStore == None): return
 
-    # define event-level hists
+    # event-level display
     if (zoomed): # zoomed for testing/convenience around the eta/phi of most energetic hit
         rs = sorted(range(len(hexelsClustered)), key=lambda k: hexelsClustered[k].weight, reverse=True) # indices sorted by decreasing rho
         c_phi = hexelsClustered[rs[0]].phi
         c_eta = hexelsClustered[rs[0]].eta
-        histDict[tag+"eng_phi_eta_evt{}".format(currentEvent)]  = ROOT.TH3F(tag+"eng_phi_eta_evt{}".format(currentEvent), tag+"eng_phi_eta_evt{};z(cm);#phi;#eta".format(currentEvent), 160, 320, 400, 80, c_phi-0.8, c_phi-0.8, 80, c_eta-0.8, c_eta-0.8) # 3D rechists clustered with algo (with ecut cleaning)
+        binning = (160, 320, 400, 80, c_phi-0.8, c_phi-0.8, 80, c_eta-0.8, c_eta-0.8)
     else:
-        histDict[tag+"eng_phi_eta_evt{}".format(currentEvent)]  = ROOT.TH3F(tag+"eng_phi_eta_evt{}".format(currentEvent), tag+"eng_phi_eta_evt{};z(cm);#phi;#eta".format(currentEvent), 160, 320, 400, 314, -3.14, +3.14, 320, -3.2, 3.2) # 3D rechists clustered with algo (with ecut cleaning)
+        binning = (160, 320, 400, 314, -3.14, +3.14, 320, -3.2, 3.2)
 
-    # loop over all clustered rechist
-    for iNode in hexelsClustered:
-        histDict[tag+"eng_phi_eta_evt{}".format(currentEvent)].Fill(abs(iNode.z), iNode.phi, iNode.eta, iNode.weight)
+    # all clustered rechist
+    displayStore.add(tag+"eng_phi_eta_evt{}".format(currentEvent), tag+"eng_phi_eta_evt{};z(cm);#phi;#eta".format(currentEvent), binning,
+                     [abs(iNode.z) for iNode in hexelsClustered], [iNode.phi for iNode in hexelsClustered], [iNode.eta for iNode in hexelsClustered],
+                     [iNode.weight for iNode in hexelsClustered])
 
-    return histDict
+    return displayStore
 
 # histograming of multi-cluster energy
 def histMultiClusters(multiClusters, histDict, tag = "multiClustEng_"):
@@ -187,11 +241,185 @@ def histPrintSaveAll(histDict, outDir):
             continue
     return
 
+# match the hits of two clusterings by detid (with sorted-array searches instead of python sets)
+# detidA/clusterA: detid and cluster index of the hits of the first clustering (detids unique), detidB/clusterB: same for the second
+# returns the number of hits in both, and for each cluster of the first the cluster of the second holding most of its hits
+# (-1 if none) with the fraction of its hits held by it
+# hits with a cluster index outside 0..nClustersA-1 of the first, or below 0 of the second, are left out
+def matchClusterHits(detidA, clusterA, nClustersA, detidB, clusterB):
+    validA = (clusterA >= 0) & (clusterA < nClustersA)
+    detidA, clusterA = detidA[validA], clusterA[validA]
+    validB = clusterB >= 0
+    detidB, clusterB = detidB[validB], clusterB[validB]
+    order = np.argsort(detidB, kind='mergesort')
+    sortedB = detidB[order]
+    position = np.minimum(np.searchsorted(sortedB, detidA), max(len(sortedB) - 1, 0))
+    found = sortedB[position] == detidA if len(sortedB) > 0 else np.zeros(len(detidA), dtype=bool)
+    # hits in common per (cluster of A, cluster of B) pair, the pair with most hits taken for each cluster of A (lowest index of B if tied)
+    nClustersB = int(clusterB.max()) + 1 if len(clusterB) > 0 else 1
+    pairs, counts = np.unique(clusterA[found].astype(np.int64)*nClustersB + clusterB[order][position[found]], return_counts=True)
+    pairsA = pairs//nClustersB
+    best = np.lexsort((-counts, pairsA))
+    best = best[np.r_[True, pairsA[best][1:] != pairsA[best][:-1]]] if len(best) > 0 else best
+    bestCluster = np.full(nClustersA, -1, dtype=np.int64)
+    bestCluster[pairsA[best]] = pairs[best]%nClustersB
+    bestFraction = np.zeros(nClustersA)
+    bestFraction[pairsA[best]] = counts[best]
+    bestFraction /= np.maximum(np.bincount(clusterA, minlength=nClustersA), 1)
+    return np.count_nonzero(found), bestCluster, bestFraction
+
+# agreement metrics of the RECO (CMSSW) and stand-alone clustering of one event of a batch (HGCalNtupleReader), added to the lists in metrics
+# (per event or per RECO 2D cluster), the stand-alone 2D clusters of the batch are given (HGCalImagingAlgo.makeClustersBatch)
+# the hits of the RECO 2D clusters are taken from the clustered rechits of the ntuple, which hold the index of their 2D cluster (if read)
+def validateEvent(batch, event, clusterBatch, metrics, compact, stats = None):
+    # RECO 2D clusters and multi-clusters
+    recoEnergy = batch.collections["cluster2d"]["energy"][batch.getCollectionSlice("cluster2d", event)]
+    recoMultiEnergy = batch.collections["multicluster"]["energy"][batch.getCollectionSlice("multicluster", event)]
+    # stand-alone 2D clusters (halo hits not counted, as in the cluster energy) and multi-clusters
+    clusters2D_rerun = clusterBatch.getLayers(event)
+    multiClusters_rerun = HGCalImagingAlgo.makePreClusters(clusters2D_rerun, multiclusterRadius = multiclusterRadius, minClusters = minClusters,
+                                                           verbosityLevel = 0, stats = stats)
+    compact.fillBatch(clusterBatch, event)
+    counted = ~compact.getHitColumn("isHalo")
+    rerunDetIds = compact.getHitColumn("detid")[counted].astype(np.int64)
+    rerunClusterIndex = compact.getHitColumn("clusterIndex")[counted].astype(np.int64)
+    rerunEnergy = compact.getClusterColumn("energy").astype(np.float64)
+    rerunMultiEnergy = np.array([multiCluster.energy for multiCluster in multiClusters_rerun])
+
+    for name, value in (("nClusters2DReco", len(recoEnergy)), ("nClusters2DRerun", len(rerunEnergy)),
+                        ("nMultiClustersReco", len(recoMultiEnergy)), ("nMultiClustersRerun", len(rerunMultiEnergy)),
+                        ("energy2DReco", recoEnergy.sum()), ("energy2DRerun", rerunEnergy.sum()),
+                        ("multiCluster0EnergyReco", recoMultiEnergy.max() if len(recoMultiEnergy) > 0 else 0.),
+                        ("multiCluster0EnergyRerun", rerunMultiEnergy.max() if len(rerunMultiEnergy) > 0 else 0.),
+                        ("nHitsRerun", len(rerunDetIds)), ("nRecHits", batch.rechitOffsets[event+1] - batch.rechitOffsets[event])):
+        metrics.setdefault(name, []).append(value)
+    if "rechits" not in batch.collections: return metrics
+
+    # RECO clustered rechits matched to the stand-alone 2D clusters
+    recoHits = batch.getCollectionSlice("rechits", event)
+    recoClusterIndex = batch.collections["rechits"]["cluster2d"][recoHits].astype(np.int64)
+    clustered = recoClusterIndex >= 0
+    recoDetIds = batch.collections["rechits"]["detid"][recoHits][clustered]
+    nCommon, bestCluster, bestFraction = matchClusterHits(recoDetIds, recoClusterIndex[clustered], len(recoEnergy), rerunDetIds, rerunClusterIndex)
+    matched = bestCluster >= 0
+    for name, value in (("nHitsReco", len(recoDetIds)), ("nHitsCommon", nCommon)):
+        metrics.setdefault(name, []).append(value)
+    metrics.setdefault("clusterHitFraction", []).append(bestFraction)
+    metrics.setdefault("clusterEnergyRelDiff", []).append((rerunEnergy[bestCluster[matched]] - recoEnergy[matched])/recoEnergy[matched])
+    return metrics
+
+# validation of the events first:last of one file (run by the worker processes), reading the given RECO collections along
+# returns the metrics as arrays, the time and counts of the clustering stages and the time spent
+def validateEventsArgs(args):
+    fileName, first, last, collections = args
+    start = time.time()
+    reader = HGCalNtupleReader.NtupleReader([fileName], extraCollections = collections)
+    metrics = {}
+    compact = HGCalImagingAlgo.CompactClusters()
+    stats = HGCalImagingAlgo.PipelineStats()
+    for batch in reader.iterFileBatches(fileName, first, last):
+        clusterBatch = HGCalImagingAlgo.makeClustersBatch(batch.rechitOffsets, *[batch.rechits[name] for name in ("layer", "x", "y", "energy", "z", "eta", "phi", "detid")],
+                                                          ecut = ecut, stats = stats)
+        for event in range(0, batch.nEvents):
+            validateEvent(batch, event, clusterBatch, metrics, compact, stats)
+    metrics = dict((name, np.concatenate(values) if name.startswith("cluster") else np.array(values)) for name, values in metrics.items())
+    return metrics, stats, time.time() - start
+
+# histograms of the agreement metrics of all events (per event, or per RECO 2D cluster), added to histDict
+# (those of the hits only if the RECO clustered rechits were read)
+def histValidation(metrics, histDict, tag = "validation_"):
+    histograms = [
+        ("nClusters2D_diff", "N(2D clusters) re-run - reco", 81, -40.5, 40.5, metrics["nClusters2DRerun"] - metrics["nClusters2DReco"]),
+        ("nMultiClusters_diff", "N(multi-clusters) re-run - reco", 21, -10.5, 10.5, metrics["nMultiClustersRerun"] - metrics["nMultiClustersReco"]),
+        ("energy2D_relDiff", "(E_{re-run} - E_{reco})/E_{reco} of all 2D clusters", 100, -0.5, 0.5,
+         (metrics["energy2DRerun"] - metrics["energy2DReco"])/np.maximum(metrics["energy2DReco"], 1e-9)),
+        ("multiCluster0_engDiff", "E_{re-run} - E_{reco} of the leading multi-cluster (GeV)", 100, -20, 20,
+         metrics["multiCluster0EnergyRerun"] - metrics["multiCluster0EnergyReco"])]
+    if "nHitsReco" in metrics:
+        nHitsReco = np.maximum(metrics["nHitsReco"], 1)
+        nHitsRerun = np.maximum(metrics["nHitsRerun"], 1)
+        histograms += [
+            ("hitOverlap_reco", "fraction of the reco clustered hits also clustered in the re-run", 101, 0, 1.01, metrics["nHitsCommon"]/nHitsReco.astype(float)),
+            ("hitOverlap_rerun", "fraction of the re-run clustered hits also clustered in reco", 101, 0, 1.01, metrics["nHitsCommon"]/nHitsRerun.astype(float)),
+            ("clusterHitFraction", "fraction of the hits of a reco 2D cluster in its best re-run 2D cluster", 101, 0, 1.01, metrics["clusterHitFraction"]),
+            ("clusterEnergy_relDiff", "(E_{re-run} - E_{reco})/E_{reco} of matched 2D clusters", 100, -1, 1, metrics["clusterEnergyRelDiff"])]
+    for name, title, nBins, low, high, values in histograms:
+        histDict[tag+name] = ROOT.TH1F(tag+name, tag+name+";"+title, nBins, low, high)
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) > 0:
+            histDict[tag+name].FillN(len(values), values, np.ones(len(values)))
+    return histDict
+
+# validation on all events of the given files, in chunks of events clustered by parallel worker processes
+def validateSample(fileNames = validationFiles, outDir = "validation", nWorkers = validationWorkers, chunkEvents = validationChunkEvents,
+                   maxEvents = validationMaxEvents):
+    HGCalHelpers.createOutputDir(outDir)
+    # RECO collections of the files (the 2D and multi-clusters are needed, the clustered rechits are compared only if in all files)
+    missingBranches = HGCalNtupleReader.NtupleReader(fileNames).findMissingBranches(recoCollections)
+    if any(not name.startswith("rechits.") for name in missingBranches):
+        print "No RECO clusters to validate against, missing branches: ", missingBranches
+        return
+    collections = recoCollections
+    if len(missingBranches) > 0:
+        print "Missing branches ", missingBranches, ", only the numbers and energies of the RECO clusters are compared"
+        collections = [(collection, members) for collection, members in recoCollections if collection != "rechits"]
+    chunks = []
+    for fileName in fileNames:
+        inFile = ROOT.TFile.Open(fileName)
+        nEvents = inFile.Get("ana/hgc").GetEntries()
+        inFile.Close()
+        if maxEvents >= 0: nEvents = min(nEvents, maxEvents)
+        chunks += [(fileName, first, min(first + chunkEvents, nEvents), collections) for first in range(0, nEvents, chunkEvents)]
+    print "Validating ", len(fileNames), " file(s) in ", len(chunks), " chunks of up to ", chunkEvents, " events, with ", nWorkers, " workers"
+
+    start = time.time()
+    if nWorkers > 1:
+        pool = multiprocessing.Pool(nWorkers)
+        results = pool.map(validateEventsArgs, chunks, chunksize = 1)
+        pool.close()
+        pool.join()
+    else:
+        results = [validateEventsArgs(chunk) for chunk in chunks]
+    wallTime = time.time() - start
+
+    # merge the chunks
+    stats = HGCalImagingAlgo.PipelineStats()
+    for chunkMetrics, chunkStats, chunkTime in results:
+        stats.merge(chunkStats)
+    metrics = dict((name, np.concatenate([chunkMetrics[name] for chunkMetrics, chunkStats, chunkTime in results if name in chunkMetrics]))
+                   for name in set(name for chunkMetrics, chunkStats, chunkTime in results for name in chunkMetrics))
+    nEvents = len(metrics.get("nRecHits", []))
+    if nEvents == 0:
+        print "No events to validate"
+        return
+    cpuTime = sum(chunkTime for chunkMetrics, chunkStats, chunkTime in results)
+
+    # summary, throughput and histograms
+    print "events: ", nEvents, ", wall time: %.1f s, %.1f events/s, %.0f rechits/s (%.3f s/event per worker)" % (
+        wallTime, nEvents/wallTime, metrics["nRecHits"].sum()/wallTime, cpuTime/nEvents)
+    print "events with same number of 2D clusters: %.3f, of multi-clusters: %.3f" % (
+        np.mean(metrics["nClusters2DRerun"] == metrics["nClusters2DReco"]), np.mean(metrics["nMultiClustersRerun"] == metrics["nMultiClustersReco"]))
+    if "nHitsReco" in metrics:
+        print "clustered hits in both: %.4f of reco, %.4f of re-run" % (
+            metrics["nHitsCommon"].sum()/float(max(metrics["nHitsReco"].sum(), 1)), metrics["nHitsCommon"].sum()/float(max(metrics["nHitsRerun"].sum(), 1)))
+        print "reco 2D clusters fully contained in one re-run 2D cluster: %.4f" % (np.mean(metrics["clusterHitFraction"] == 1.) if len(metrics["clusterHitFraction"]) > 0 else 0.)
+    stats.printSummary()
+    stats.saveJSON(outDir + "/clusteringStats.json")
+    histDict = histValidation(metrics, {}, tag = "validation_")
+    histDict = HGCalROOT.fillStatsHistograms(stats, histDict, tag = "clusteringStats_")
+    histPrintSaveAll(histDict, outDir)
+    return metrics
+
 def main():
+    if validationMode:
+        validateSample()
+        return
+
     # init output stuff
     outDir = "testR"
     HGCalHelpers.createOutputDir(outDir)
     histDict = {}
+    displayStore = EventDisplayStore(outDir + "/eventDisplays.npy") # event displays (sparse, rendered at the end)
 
     # get sample/tree
     inFile = ROOT.TFile.Open("partGun_PDGid22_x96_E20.0To20.0_NTUP_1.root")
@@ -202,6 +430,7 @@ def main():
 
     # start event loop
     multiCluster0_engDiff = [] # for comparions
+    stats = HGCalImagingAlgo.PipelineStats() # time and counts of the clustering stages, over all events
     for currentEvent, event in enumerate(chain):
         if (not currentEvent in allowedRangeEvents): continue # testing limitation
         print "\ncurrentEvent: ", currentEvent
@@ -209,7 +438,7 @@ def main():
         # get list of rechist associated to sim-cluster hits
         rHitsSimAssoc = getRecHitsSimAssoc(event.rechits_raw, event.simcluster)
         # histograming of rechist associated to sim-cluster hits
-        histDict = histRecHitsSimAssoc(rHitsSimAssoc, currentEvent, histDict, tag = "rHitsSimAssoc_", zoomed = False)
+        displayStore = histRecHitsSimAssoc(rHitsSimAssoc, currentEvent, displayStore, tag = "rHitsSimAssoc_", zoomed = False)
 
         # get list of raw rechits with ecut cleaning
         rHitsCleaned = [rechit for rechit in event.rechits_raw if not rechit.energy < ecut]
@@ -224,15 +453,15 @@ def main():
 
         ### Imaging algo run as stand-alone (python)
         # produce 2D clusters with stand-alone algo, out of all raw rechits
-        clusters2D_rerun = HGCalImagingAlgo.makeClusters(event.rechits_raw, ecut = ecut) # hexels per-layer, per 2D cluster
+        clusters2D_rerun = HGCalImagingAlgo.makeClusters(event.rechits_raw, ecut = ecut, stats = stats) # per-layer hexels (columnar), with 2D cluster index
         # produce multi-clusters with stand-alone algo, out of all 2D clusters
-        multiClustersList_rerun = HGCalImagingAlgo.makePreClusters(clusters2D_rerun, multiclusterRadius = multiclusterRadius, minClusters = minClusters) # flat list of multi-clusters (as basic clusters)
+        multiClustersList_rerun = HGCalImagingAlgo.makePreClusters(clusters2D_rerun, multiclusterRadius = multiclusterRadius, minClusters = minClusters, stats = stats) # flat list of multi-clusters (as basic clusters)
 
         # get list of hexeles from 2D clusters produced with stand-alone algo
         clusters2DList_rerun = HGCalImagingAlgo.getClusters(clusters2D_rerun, verbosityLevel = 0) # flat list of 2D clusters (as basic clusters)
         hexelsClustered_rerun = [iNode for bClust in clusters2DList_rerun for iNode in bClust.thisCluster if not iNode.isHalo]
         # histograming of clustered hexels
-        histDict = histHexelsClustered(hexelsClustered_rerun, currentEvent, histDict, tag = "clustHex_", zoomed = True)
+        displayStore = histHexelsClustered(hexelsClustered_rerun, currentEvent, displayStore, tag = "clustHex_", zoomed = True)
 
         ### Compare stand-alone clustering and sim-clusters
         rHitsSimAssocDID = [rechit.detid for simClus in rHitsSimAssoc for rechit in simClus] # list of detids for sim-associated rehits (with ecut cleaning)
@@ -246,6 +475,7 @@ def main():
         ### Compare stand-alone and reco-level clustering
         ls = sorted(range(len(clusters2DList_reco)), key=lambda k: clusters2DList_reco[k].layer, reverse=False) # indices sorted by increasing layer number
         for index in range(len(clusters2DList_reco)): print "Layer: ", clusters2DList_reco[ls[index]].layer, "| 2D-cluster index: ", ls[index], ", No. of cells = ", clusters2DList_reco[ls[index]].nhitAll, ", Energy  = ", clusters2DList_reco[ls[index]].energy, ", Phi = ", clusters2DList_reco[ls[index]].phi, ", Eta = ", clusters2DList_reco[ls[index]].eta, ", z = ", clusters2DList_reco[ls[index]].z
+        for index in range(len(multiClustersList_rerun)): print "Multi-cluster index: ", index, ", No. of 2D-clusters = ", len(multiClustersList_rerun[index].thisCluster), ", Energy  = ", multiClustersList_rerun[index].energy, ", Phi = ", multiClustersList_rerun[index].phi, ", Eta = ", multiClustersList_rerun[index].eta, ", z = ", multiClustersList_rerun[index].z
         for index in range(len(multiClustersList_reco)): print "Multi-cluster (RECO) index: ", index, ", No. of 2D-clusters = ", multiClustersList_reco[index].nclus, ", Energy  = ", multiClustersList_reco[index].energy, ", Phi = ", multiClustersList_reco[index].phi, ", Eta = ", multiClustersList_reco[index].eta, ", z = ", multiClustersList_reco[index].z
         print "num of clusters2D @reco : ", len(clusters2DList_reco)
         print "num of clusters2D re-run: ", len(clusters2DList_rerun)
@@ -256,8 +486,17 @@ def main():
 
     histDict = histValues1D(multiCluster0_engDiff, histDict, tag = "MultClustt0_DiffRerunReco_")
 
+    # time and counts of the clustering stages (per event, per layer in the histograms)
+    stats.printSummary()
+    stats.saveJSON(outDir + "/clusteringStats.json")
+    histDict = HGCalROOT.fillStatsHistograms(stats, histDict, tag = "clusteringStats_")
+
     # print/save histograms
     histPrintSaveAll(histDict, outDir)
+    # render the event displays
+    displayStore.close()
+    print "event displays: ", displayStore.nDisplays, ", points: ", displayStore.nPoints
+    renderEventDisplays(displayStore.fileName, outDir)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,104 @@
+##############################################################################
+# Conformance test of the kernel backends of HGCalKernels: every backend
+# gives the same results as the NumPy kernels on the same inputs, kernel by
+# kernel and for the whole 2D and multi-clustering (HGCalImagingAlgo)
+# run with: python -m unittest test_HGCalKernels (or pytest)
+##############################################################################
+import math
+import unittest
+import numpy as np
+import HGCalKernels
+import HGCalImagingAlgo
+import HGCalSynthetic
+
+## basic setup of the test inputs
+nHits = 2000
+seeds = range(5)
+multiclusterRadii = (0.05, 0.5, 4.)
+
+# random kernel inputs with many ties (positions on a coarse grid), chains of nearestHigher and clusters close to phi = +-pi and z = 0
+def makeKernelInputs(nHits, seed):
+    rng = np.random.RandomState(seed)
+    x = 0.5*rng.randint(-10, 11, nHits)
+    y = 0.5*rng.randint(-10, 11, nHits)
+    rank = rng.permutation(nHits)
+    query = rng.permutation(nHits)[:nHits//2]
+    counts = rng.randint(1, 12, len(query))
+    offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+    candidates = rng.randint(0, nHits, offsets[-1]).astype(np.int64)
+    candidates[offsets[:-1]] = query # each query is its own candidate
+    # nearestHigher of a hit is a hit of lower rank
+    order = np.argsort(rank)
+    nearestHigher = np.full(nHits, -1, dtype=np.int64)
+    nearestHigher[order[1:]] = order[(rng.uniform(size=nHits-1)*np.arange(1, nHits)).astype(np.int64)]
+    nearestHigher[order[rng.randint(0, nHits, nHits//50)]] = -1
+    clusterIndex = np.full(nHits, -1, dtype=np.int64)
+    clusterIndex[order[rng.randint(0, nHits, nHits//20)]] = np.arange(nHits//20)
+    u = rng.uniform(1.5, 3., nHits)
+    v = rng.uniform(-math.pi, math.pi, nHits)
+    z = rng.choice([-1., 1.], nHits)*rng.uniform(0., 400., nHits)
+    z[:nHits//10] = rng.uniform(-1., 1., nHits//10)
+    # cone candidates of each cluster, with duplicates (as from the copies added for the phi wrap)
+    coneOffsets = np.r_[0, np.cumsum(rng.randint(0, 30, nHits))].astype(np.int64)
+    coneCandidates = np.clip(np.repeat(np.arange(nHits), np.diff(coneOffsets)) + rng.randint(-5, 60, coneOffsets[-1]), 0, nHits-1)
+    return x, y, rank, query, offsets, candidates, clusterIndex, nearestHigher, u, v, z, coneOffsets, coneCandidates
+
+# each backend against the NumPy kernels (the NumPy backend against itself, so that the test also runs without numba)
+class KernelConformanceTest(unittest.TestCase):
+    def checkBackends(self, check):
+        for backend in sorted(HGCalKernels.kernelBackends.keys()):
+            for seed in seeds:
+                check(HGCalKernels.getKernels("numpy"), HGCalKernels.getKernels(backend), makeKernelInputs(nHits, seed), "%s, seed %d" % (backend, seed))
+
+    def testSelectNearestHigher(self):
+        def check(reference, kernels, inputs, name):
+            x, y, rank, query, offsets, candidates = inputs[:6]
+            expected = reference.selectNearestHigher(x, y, rank, query, offsets, candidates)
+            result = kernels.selectNearestHigher(x, y, rank, query, offsets, candidates)
+            self.assertTrue(np.array_equal(expected[0], result[0]), "squared distances differ (%s)" % name)
+            self.assertTrue(np.array_equal(expected[1], result[1]), "ranks differ (%s)" % name)
+        self.checkBackends(check)
+
+    def testSelectNearestHigherEmpty(self):
+        empty = np.zeros(0, dtype=np.int64)
+        for backend in sorted(HGCalKernels.kernelBackends.keys()):
+            best, bestRank = HGCalKernels.getKernels(backend).selectNearestHigher(np.zeros(3), np.zeros(3), np.arange(3), empty, np.zeros(1, dtype=np.int64), empty)
+            self.assertEqual((len(best), len(bestRank)), (0, 0), backend)
+
+    def testPropagateClusterIndex(self):
+        def check(reference, kernels, inputs, name):
+            clusterIndex, nearestHigher = inputs[6:8]
+            expected = reference.propagateClusterIndex(clusterIndex, nearestHigher)
+            self.assertTrue(np.array_equal(expected, kernels.propagateClusterIndex(clusterIndex, nearestHigher)), "cluster indices differ (%s)" % name)
+        self.checkBackends(check)
+
+    def testAssignMultiClusters(self):
+        def check(reference, kernels, inputs, name):
+            u, v, z, coneOffsets, coneCandidates = inputs[8:]
+            for radius in multiclusterRadii:
+                for phiWrap in (False, True):
+                    expected = reference.assignMultiClusters(u, v, z, coneOffsets, coneCandidates, radius, phiWrap)
+                    result = kernels.assignMultiClusters(u, v, z, coneOffsets, coneCandidates, radius, phiWrap)
+                    self.assertTrue(np.array_equal(expected, result), "leaders differ (%s, radius %g, phiWrap %s)" % (name, radius, phiWrap))
+        self.checkBackends(check)
+
+    # the whole clustering of a synthetic event with pileup, the same 2D and multi-clusters with each backend
+    def testClustering(self):
+        generator = HGCalSynthetic.EventGenerator(nParticles = 5, pileupDensity = 0.01, seed = 7)
+        rHits = HGCalSynthetic.getRecHits(*(generator.generateEvents(1) + [0]))
+        results = {}
+        for backend in sorted(HGCalKernels.kernelBackends.keys()):
+            clusters = HGCalImagingAlgo.makeClusters(rHits, backend = backend)
+            multiClusters = HGCalImagingAlgo.makePreClusters(clusters, backend = backend)
+            results[backend] = ([hexels.clusterIndex for hexels in clusters], [hexels.delta for hexels in clusters],
+                                [(multi.energy, multi.eta, multi.phi, len(multi.thisCluster)) for multi in multiClusters])
+        for backend, (clusterIndex, delta, multiClusters) in results.items():
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(results["numpy"][0], clusterIndex)), "2D clusters differ (%s)" % backend)
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(results["numpy"][1], delta)), "delta differs (%s)" % backend)
+            self.assertEqual(results["numpy"][2], multiClusters, "multi-clusters differ (%s)" % backend)
+
+    def testUnknownBackend(self):
+        self.assertRaises(ValueError, HGCalKernels.getKernels, "cuda")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+##############################################################################
+# Test of the columnar ntuple reader HGCalNtupleReader: branch names of the
+# ntuple schema, batches from flat columns, and the uproot and PyROOT backends
+# on the same file (an ntuple given in HGCAL_TEST_NTUPLE, skipped otherwise)
+# run with: python -m unittest test_HGCalNtupleReader (or pytest)
+##############################################################################
+import os
+import unittest
+import numpy as np
+import HGCalNtupleReader
+
+## basic setup of the test inputs
+testNtuple = os.environ.get("HGCAL_TEST_NTUPLE", "")
+testEvents = 20
+testBatchSize = 7
+
+# ROOT is only needed for the comparison of the backends
+def hasROOT():
+    try:
+        import ROOT
+    except ImportError:
+        return False
+    return True
+
+class NtupleReaderTest(unittest.TestCase):
+    # the branches of the ana/hgc tree that are read
+    def testBranchNames(self):
+        branches = HGCalNtupleReader.getBranchNames()
+        self.assertEqual(branches, ["rechits_raw." + name for name in ["detid", "layer", "energy", "pt", "eta", "phi", "x", "y", "z"]] +
+                         ["simcluster." + name for name in ["pt", "eta", "phi", "energy", "hits"]])
+        self.assertEqual(HGCalNtupleReader.getMissingBranches(["rechits_raw", "simcluster"] + branches), [])
+        self.assertEqual(HGCalNtupleReader.getMissingBranches(branches[1:]), branches[:1])
+        self.assertRaises(KeyError, HGCalNtupleReader.checkBranches, "ntuple.root", "ana/hgc", branches[:1])
+
+    # two events, the first without SimClusters, the second with an empty SimCluster, and RECO 2D clusters read along
+    def testEventBatch(self):
+        rechits = dict((name, np.arange(5) + 10*index) for index, name in enumerate(HGCalNtupleReader.rechitColumns))
+        simClusters = dict((name, np.arange(2) + 0.5) for name in HGCalNtupleReader.simClusterColumns)
+        batch = HGCalNtupleReader.EventBatch(3, [2, 3], rechits, [0, 2], simClusters, [0, 2], [10, 12],
+                                             {"cluster2d": ([1, 2], {"energy": [1., 2., 3.], "layer": [4, 5, 6]})})
+        self.assertEqual((batch.firstEntry, batch.nEvents), (3, 2))
+        self.assertTrue(np.array_equal(batch.rechits["detid"][batch.getRecHitSlice(1)], [2, 3, 4]))
+        self.assertEqual([rHit.layer for rHit in batch.getRecHits(0)], [10, 11])
+        self.assertEqual(batch.getSimClusters(0), [])
+        offsets, hits = batch.getSimClusterHits(1)
+        self.assertTrue(np.array_equal(offsets, [0, 0, 2]) and np.array_equal(hits, [10, 12]))
+        self.assertEqual([len(simClus.hits) for simClus in batch.getSimClusters(1)], [0, 2])
+        self.assertTrue(np.array_equal(batch.collections["cluster2d"]["energy"][batch.getCollectionSlice("cluster2d", 1)], [2., 3.]))
+        self.assertEqual(batch.collections["cluster2d"]["layer"].dtype, np.int64)
+
+    def testUnknownBackend(self):
+        self.assertRaises(ValueError, HGCalNtupleReader.NtupleReader, [], backend="root_numpy")
+
+    # the same batches with both backends
+    @unittest.skipUnless(os.path.isfile(testNtuple) and hasROOT() and "uproot" in HGCalNtupleReader.readerBackends,
+                         "needs ROOT, uproot and an ntuple in HGCAL_TEST_NTUPLE")
+    def testBackends(self):
+        batches = dict((backend, list(HGCalNtupleReader.NtupleReader([testNtuple], batchSize=testBatchSize, backend=backend).iterBatches(testEvents)))
+                       for backend in ["uproot", "pyroot"])
+        self.assertEqual(len(batches["uproot"]), len(batches["pyroot"]))
+        for batchUproot, batchPyROOT in zip(batches["uproot"], batches["pyroot"]):
+            self.assertEqual((batchUproot.firstEntry, batchUproot.nEvents), (batchPyROOT.firstEntry, batchPyROOT.nEvents))
+            for name in ["rechitOffsets", "simClusterOffsets", "simClusterHitOffsets", "simClusterHits"]:
+                self.assertTrue(np.array_equal(getattr(batchUproot, name), getattr(batchPyROOT, name)), name)
+            for name in HGCalNtupleReader.rechitColumns:
+                self.assertTrue(np.array_equal(batchUproot.rechits[name], batchPyROOT.rechits[name]), "rechits_raw." + name)
+            for name in HGCalNtupleReader.simClusterColumns:
+                self.assertTrue(np.array_equal(batchUproot.simClusters[name], batchPyROOT.simClusters[name]), "simcluster." + name)
+
+if __name__ == '__main__':
+    unittest.main()